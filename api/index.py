@@ -1,229 +1,660 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
-import requests
+from pydantic import BaseModel
+from typing import List, Optional
+from fastapi.responses import StreamingResponse, JSONResponse, Response
+from starlette.background import BackgroundTask
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from email.utils import formatdate
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
+import asyncio
+import hashlib
+import importlib.util
+import io
+import ipaddress
+import httpx
 import urllib.parse
 import random
 import re
 import json
+import math
+import logging
+import os
+import secrets
+import shutil
+import struct
+import sys
+import threading
+import time
 
 app = FastAPI()
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+BROWSER_UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36"
 
-def extract_youtube_id(url: str):
+# Upstream endpoints, overridable so the app can be pointed at mirrors or at
+# local stand-ins when benchmarking.
+PIPED_INSTANCES = [u.strip() for u in os.environ.get("PIPED_INSTANCES", ",".join([
+    "https://pipedapi.kavin.rocks",
+    "https://api.piped.kotnn.me",
+    "https://piped-api.lunar.icu",
+    "https://pipedapi.drgns.space",
+    "https://api.piped.privacy.com.de"
+])).split(",") if u.strip()]
+COBALT_INSTANCES = [u.strip() for u in os.environ.get("COBALT_INSTANCES", ",".join([
+    "https://api.cobalt.tools/api/json",
+    "https://co.wuk.sh/api/json"
+])).split(",") if u.strip()]
+TIKWM_API_URL = os.environ.get("TIKWM_API_URL", "https://www.tikwm.com/api/")
+# Cobalt hands back a single stream, so its resolution is a deployment-wide
+# choice rather than a per-request one.
+COBALT_QUALITY = os.environ.get("COBALT_QUALITY", "720")
+
+# Piped racing: how many instances may be in flight at once, and how long an
+# attempt gets before we hedge by starting the next instance alongside it.
+PIPED_FANOUT = max(1, int(os.environ.get("PIPED_FANOUT", "3")))
+PIPED_HEDGE_DELAY = float(os.environ.get("PIPED_HEDGE_DELAY", "0.5"))
+# Per-attempt timeouts. Only an attempt that had its full timeout counts a
+# timeout against the instance's health; a shorter one was cut by the
+# client's deadline, which says nothing about the instance.
+PIPED_ATTEMPT_TIMEOUT = 2.5
+COBALT_ATTEMPT_TIMEOUT = 8
+
+# Overall /api/info budget in seconds. Clients may ask for less (or more, up
+# to the cap) with an X-Request-Deadline header or a `deadline` parameter;
+# the cap stays under the 60s function limit in vercel.json.
+INFO_DEFAULT_DEADLINE = float(os.environ.get("INFO_DEFAULT_DEADLINE", "25"))
+INFO_MAX_DEADLINE = float(os.environ.get("INFO_MAX_DEADLINE", "55"))
+INFO_MIN_DEADLINE = float(os.environ.get("INFO_MIN_DEADLINE", "3"))
+
+# POST /api/info/batch limits
+BATCH_MAX_URLS = int(os.environ.get("BATCH_MAX_URLS", "500"))
+BATCH_DEFAULT_CONCURRENCY = int(os.environ.get("BATCH_DEFAULT_CONCURRENCY", "8"))
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", "32"))
+
+# GET /api/playlist limits
+PLAYLIST_MAX_ENTRIES = int(os.environ.get("PLAYLIST_MAX_ENTRIES", "5000"))
+
+# Optional Piped instance registry (a JSON list of instances with `api_url`,
+# e.g. https://piped-instances.kavin.rocks/) refreshed on this interval.
+PIPED_REGISTRY_URL = os.environ.get("PIPED_REGISTRY_URL", "")
+PIPED_REGISTRY_INTERVAL = float(os.environ.get("PIPED_REGISTRY_INTERVAL", "3600"))
+
+# Instance health: EWMA smoothing factor, and how many consecutive failures
+# open an instance's circuit breaker and for how long.
+HEALTH_EWMA_ALPHA = 0.3
+BREAKER_THRESHOLD = int(os.environ.get("BREAKER_THRESHOLD", "3"))
+BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", "30"))
+
+# /api/info result cache. Entries live until their signed download URL
+# expires (minus a safety margin), or for the default TTL if it is unsigned.
+INFO_CACHE_SIZE = int(os.environ.get("INFO_CACHE_SIZE", "1024"))
+INFO_CACHE_DEFAULT_TTL = float(os.environ.get("INFO_CACHE_DEFAULT_TTL", "300"))
+INFO_CACHE_MAX_TTL = float(os.environ.get("INFO_CACHE_MAX_TTL", "21600"))
+INFO_CACHE_EXPIRY_MARGIN = 60
+# Optional shared tier behind the in-process cache, so several workers (or
+# instances) resolve each video once: "sqlite" for the workers on one host,
+# "kv" for a Redis REST endpoint such as Vercel KV, or "" for none.
+INFO_CACHE_BACKEND = os.environ.get("INFO_CACHE_BACKEND", "")
+INFO_CACHE_SQLITE_PATH = os.environ.get("INFO_CACHE_SQLITE_PATH", "/tmp/umii-info-cache.sqlite3")
+INFO_CACHE_COMPACT_INTERVAL = float(os.environ.get("INFO_CACHE_COMPACT_INTERVAL", "300"))
+KV_REST_API_URL = os.environ.get("KV_REST_API_URL", "")
+KV_REST_API_TOKEN = os.environ.get("KV_REST_API_TOKEN", "")
+
+# HTTP/2 needs the h2 package; look for it without importing it, httpx does
+# that itself when the first client is built.
+HTTP2_ENABLED = importlib.util.find_spec("h2") is not None
+
+# Download streaming: chunk sizes adapt to the observed throughput between
+# these bounds, aiming to hand the client one chunk per target interval.
+STREAM_MIN_CHUNK = 64 * 1024
+STREAM_MAX_CHUNK = 1024 * 1024
+STREAM_TARGET_INTERVAL = 0.25
+
+# Segmented downloads (opt-in with ?segments=N): the file is fetched as
+# pieces of SEGMENT_SIZE bytes over N connections. At most two pieces per
+# connection are held for reordering, which caps memory per download.
+SEGMENT_SIZE = int(os.environ.get("SEGMENT_SIZE", str(1024 * 1024)))
+DOWNLOAD_MAX_SEGMENTS = int(os.environ.get("DOWNLOAD_MAX_SEGMENTS", "8"))
+SEGMENT_RETRIES = 2
+# Per-input read-ahead when muxing separate video and audio streams
+MUX_PREFETCH_BYTES = int(os.environ.get("MUX_PREFETCH_BYTES", str(4 * 1024 * 1024)))
+
+# Download admission control. Each stream reserves the most it can buffer
+# (see download_buffer_need); streams beyond either limit wait in a bounded
+# queue and are shed with a 503 when it is full or the wait runs out, so a
+# spike can't slow every stream past the function's time limit. New streams
+# are held back while more than INFO_PRIORITY_THRESHOLD /api/info requests
+# are in flight, keeping the UI responsive.
+DOWNLOAD_MAX_STREAMS = int(os.environ.get("DOWNLOAD_MAX_STREAMS", "32"))
+DOWNLOAD_MAX_BUFFER_BYTES = int(os.environ.get("DOWNLOAD_MAX_BUFFER_BYTES", str(256 * 1024 * 1024)))
+DOWNLOAD_QUEUE_SIZE = int(os.environ.get("DOWNLOAD_QUEUE_SIZE", "64"))
+DOWNLOAD_QUEUE_WAIT = float(os.environ.get("DOWNLOAD_QUEUE_WAIT", "10"))
+DOWNLOAD_RETRY_AFTER = int(os.environ.get("DOWNLOAD_RETRY_AFTER", "5"))
+INFO_PRIORITY_THRESHOLD = int(os.environ.get("INFO_PRIORITY_THRESHOLD", "4"))
+
+# Per-client rate limits (tokens per second and bucket size), with separate
+# budgets for info lookups, downloads and thumbnails; a rate of 0 disables a
+# budget.
+# Clients are keyed by a known API key (X-API-Key) or else by address. Behind
+# a proxy, set TRUST_FORWARDED to take it from the last X-Forwarded-For
+# entry, the one the proxy itself added; it is on by default only on Vercel,
+# whose edge overwrites the header. Without a proxy the header is whatever
+# the client sends, so it must stay off.
+RATE_LIMIT_INFO_RATE = float(os.environ.get("RATE_LIMIT_INFO_RATE", "1"))
+RATE_LIMIT_INFO_BURST = float(os.environ.get("RATE_LIMIT_INFO_BURST", "30"))
+RATE_LIMIT_DOWNLOAD_RATE = float(os.environ.get("RATE_LIMIT_DOWNLOAD_RATE", "0.5"))
+RATE_LIMIT_DOWNLOAD_BURST = float(os.environ.get("RATE_LIMIT_DOWNLOAD_BURST", "20"))
+RATE_LIMIT_THUMBNAIL_RATE = float(os.environ.get("RATE_LIMIT_THUMBNAIL_RATE", "2"))
+RATE_LIMIT_THUMBNAIL_BURST = float(os.environ.get("RATE_LIMIT_THUMBNAIL_BURST", "60"))
+RATE_LIMIT_MAX_CLIENTS = int(os.environ.get("RATE_LIMIT_MAX_CLIENTS", "100000"))
+RATE_LIMIT_API_KEYS = {k.strip() for k in os.environ.get("RATE_LIMIT_API_KEYS", "").split(",") if k.strip()}
+TRUST_FORWARDED = os.environ.get("TRUST_FORWARDED", "1" if os.environ.get("VERCEL") else "0") == "1"
+
+# On-disk media cache for self-hosted deployments; disabled unless a
+# directory is configured. Entries are evicted least recently used first
+# once the byte budget is exceeded.
+MEDIA_CACHE_DIR = os.environ.get("MEDIA_CACHE_DIR", "")
+MEDIA_CACHE_BYTES = int(os.environ.get("MEDIA_CACHE_BYTES", str(10 * 1024 ** 3)))
+
+# Background download jobs for self-hosted deployments, where transfers may
+# outlast a request; disabled unless a directory is configured. A bounded
+# pool of workers fetches into it, retrying failed transfers from where they
+# stopped, and a journal there lets jobs carry on after a restart. Finished
+# and failed jobs are removed JOB_TTL seconds after they end. Jobs are kept
+# in process memory, so run a single worker process per directory; a second
+# one refuses to start.
+JOBS_DIR = os.environ.get("JOBS_DIR", "")
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", "256"))
+JOB_RETRIES = int(os.environ.get("JOB_RETRIES", "3"))
+JOB_RETRY_DELAY = float(os.environ.get("JOB_RETRY_DELAY", "2"))
+JOB_TTL = float(os.environ.get("JOB_TTL", "86400"))
+
+# /api/thumbnail: images are scaled down to the nearest of these widths and
+# recompressed on a small thread pool, then kept in an on-disk LRU (/tmp is
+# writable on Vercel). Resizing needs Pillow; without it the originals are
+# passed through.
+THUMBNAIL_WIDTHS = (160, 320, 480, 640, 960, 1280)
+THUMBNAIL_QUALITY = {"low": 50, "medium": 70, "high": 85}
+THUMBNAIL_CACHE_DIR = os.environ.get("THUMBNAIL_CACHE_DIR", "/tmp/umii-thumbnails")
+THUMBNAIL_CACHE_BYTES = int(os.environ.get("THUMBNAIL_CACHE_BYTES", str(256 * 1024 ** 2)))
+THUMBNAIL_MAX_SOURCE_BYTES = int(os.environ.get("THUMBNAIL_MAX_SOURCE_BYTES", str(10 * 1024 ** 2)))
+# Decoded size cap, checked before decoding: a small file can expand to
+# hundreds of MB (25 MP is 75 MB as RGB)
+THUMBNAIL_MAX_PIXELS = int(os.environ.get("THUMBNAIL_MAX_PIXELS", str(25_000_000)))
+THUMBNAIL_WORKERS = int(os.environ.get("THUMBNAIL_WORKERS", str(min(4, os.cpu_count() or 1))))
+PILLOW_AVAILABLE = importlib.util.find_spec("PIL") is not None
+
+_clients = {}
+
+def get_client(kind: str = "api") -> httpx.AsyncClient:
     """
-    Extracts the YouTube Video ID from various URL formats.
+    Returns a shared async HTTP client.
+    "api" is used by every provider: connections are pooled per origin and
+    kept alive between requests, and HTTP/2 is negotiated where the upstream
+    offers it. "media" is used to stream downloads and stays on HTTP/1.1, so
+    each transfer gets its own connection instead of sharing one multiplexed
+    (and per-connection throttled) CDN connection. Clients are bound to the
+    running event loop, so fresh ones are built if the loop changes.
     """
-    url = url.strip()
-    patterns = [
-        r'(?:v=|\/)([0-9A-Za-z_-]{11}).*',
-        r'(?:v=|\/)([0-9A-Za-z_-]{11})',
-        r'youtu\.be\/([0-9A-Za-z_-]{11})',
-        r'shorts\/([0-9A-Za-z_-]{11})',
-        r'^([0-9A-Za-z_-]{11})$'
-    ]
-    for pattern in patterns:
-        match = re.search(pattern, url)
-        if match:
-            return match.group(1)
-    return None
+    loop = asyncio.get_running_loop()
+    entry = _clients.get(kind)
+    if entry is None or entry[1] is not loop:
+        if kind == "media":
+            client = httpx.AsyncClient(
+                follow_redirects=True,
+                timeout=30,
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=10, keepalive_expiry=30),
+            )
+        else:
+            client = httpx.AsyncClient(
+                http2=HTTP2_ENABLED,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30),
+            )
+        entry = _clients[kind] = (client, loop)
+    return entry[0]
 
-def process_tiktok_tikwm(url: str):
-    try:
-        api_url = "https://www.tikwm.com/api/"
-        response = requests.post(api_url, data={'url': url, 'hd': 1}, timeout=5)
-        data = response.json()
-        if data.get("code") == 0:
-            res = data["data"]
-            return {
-                "id": res.get("id"),
-                "title": res.get("title") or "TikTok Video",
-                "thumbnail": res.get("cover"),
-                "duration": res.get("duration"),
-                "platform": "TikTok",
-                "download_url": res.get("play"),
-                "ext": "mp4"
-            }
-    except Exception as e:
-        print(f"TikTok Error: {e}")
-    return None
+@app.on_event("shutdown")
+async def close_clients():
+    loop = asyncio.get_running_loop()
+    for client, client_loop in _clients.values():
+        if client_loop is loop:
+            await client.aclose()
 
-def process_youtube_piped(url: str):
-    video_id = extract_youtube_id(url)
-    if not video_id: 
-        return None
-    
-    # Prioritize faster/less blocked instances
-    instances = [
-        "https://pipedapi.kavin.rocks",
-        "https://api.piped.kotnn.me",
-        "https://piped-api.lunar.icu",
-        "https://pipedapi.drgns.space",
-        "https://api.piped.privacy.com.de"
-    ]
-    
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36"
-    }
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# Requests carrying this value in X-Debug-Profile are profiled; profiling is
+# off when it is unset.
+DEBUG_PROFILE_TOKEN = os.environ.get("DEBUG_PROFILE_TOKEN", "")
+PROFILE_INTERVAL = 0.005
+SERVER_TIMING_MAX_SPANS = 40
 
-    for base_url in instances:
-        try:
-            print(f"Trying Piped Instance: {base_url}")
-            # Reduced timeout to 2.5s to fail fast and try next
-            api_endpoint = f"{base_url}/streams/{video_id}"
-            response = requests.get(api_endpoint, headers=headers, timeout=2.5)
-            
-            if response.status_code == 200:
-                data = response.json()
-                if "error" in data: continue
-
-                streams = data.get("videoStreams", [])
-                # Prefer mp4, non-videoOnly
-                best_stream = next((s for s in streams if s.get("format") == "MPEG-4" and not s.get("videoOnly")), None)
-                
-                if not best_stream and streams:
-                    best_stream = streams[0]
-                    
-                if best_stream:
-                    return {
-                        "id": video_id,
-                        "title": data.get("title") or "YouTube Video",
-                        "thumbnail": data.get("thumbnailUrl"),
-                        "duration": data.get("duration"),
-                        "platform": "YouTube",
-                        "download_url": best_stream.get("url"),
-                        "ext": "mp4"
-                    }
-        except Exception as e:
-            print(f"Instance {base_url} failed: {str(e)}")
-            continue
-            
-    return None
+log = logging.getLogger("umii")
 
-def process_cobalt(url: str, backup=False):
-    # Primary and Backup Cobalt instances
-    api_url = "https://co.wuk.sh/api/json" if backup else "https://api.cobalt.tools/api/json"
-    
-    headers = {
-        "Accept": "application/json", 
-        "Content-Type": "application/json",
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36"
-    }
-    
-    payload = {
-        "url": url, 
-        "vCodec": "h264", 
-        "vQuality": "720",
-        "filenamePattern": "basic",
-        "isAudioOnly": False
-    }
-    
-    try:
-        print(f"Trying Cobalt ({'Backup' if backup else 'Primary'})...")
-        response = requests.post(api_url, json=payload, headers=headers, timeout=8)
-        data = response.json()
-        
-        # Cobalt success check
-        if data.get("status") in ["stream", "redirect"] or "url" in data:
-            return {
-                "id": f"dl-{random.randint(1000, 9999)}",
-                "title": data.get("text") or data.get("filename") or "Downloaded Video",
-                "thumbnail": "https://images.unsplash.com/photo-1611162617213-7d7a39e9b1d7?auto=format&fit=crop&w=300",
-                "duration": None,
-                "platform": "Social Media",
-                "download_url": data.get("url"),
-                "ext": "mp4"
-            }
-    except Exception as e:
-        print(f"Cobalt {'Backup' if backup else 'Primary'} Error: {e}")
-        
-    return None
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line: time, level, event, request id and fields."""
 
-@app.get("/api/info")
-async def info(url: str = Query(..., description="The URL to process")):
-    if not url:
-        raise HTTPException(status_code=400, detail="URL is required")
-    
-    print(f"Processing URL: {url}")
-    result = None
-    
-    # 1. TikTok Logic
-    if "tiktok.com" in url:
-        result = process_tiktok_tikwm(url)
-        if not result:
-            result = process_cobalt(url) # Fallback to Cobalt for TikTok
-    
-    # 2. YouTube Logic
-    elif "youtube.com" in url or "youtu.be" in url:
-        # Try Piped first
-        result = process_youtube_piped(url)
-        # If Piped fails, try Cobalt Primary
-        if not result:
-            result = process_cobalt(url, backup=False)
-        # If Cobalt Primary fails, try Cobalt Backup
-        if not result:
-            result = process_cobalt(url, backup=True)
-    
-    # 3. General Fallback (Instagram, Twitter, etc.)
-    else:
-        result = process_cobalt(url, backup=False)
-        if not result:
-            result = process_cobalt(url, backup=True)
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"ts": round(record.created, 3), "level": record.levelname.lower(), "event": record.getMessage()}
+        entry.update(getattr(record, "fields", {}))
+        return json.dumps(entry, default=str)
 
-    if not result:
-        # Return 400 with detail so frontend displays the error message
-        return JSONResponse(status_code=400, content={
-            "detail": "Extraction failed. The platform might be blocking requests or the link is private."
-        })
-        
-    return result
+if not log.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(JsonLogFormatter())
+    log.addHandler(_handler)
+    log.setLevel(LOG_LEVEL)
+    log.propagate = False
 
-@app.get("/api/download")
-async def download(
-    url: str = Query(..., description="Direct video URL"), 
-    title: str = Query("video"),
-    ext: str = Query("mp4")
-):
+def log_event(event: str, level: int = logging.INFO, **fields):
+    if log.isEnabledFor(level):
+        trace = TRACE.get()
+        if trace is not None:
+            fields["request_id"] = trace.id
+        log.log(level, event, extra={"fields": fields})
+
+class Trace:
+    """
+    Timing spans of one request. The trace lives in a context variable, so
+    tasks spawned while handling the request (racing Piped attempts, the
+    coalesced extraction) add their spans to it too.
+    """
+    __slots__ = ("id", "start", "spans")
+
+    def __init__(self):
+        self.id = secrets.token_hex(6)
+        self.start = time.monotonic()
+        self.spans = []
+
+    def add(self, name: str, start: float, end: float, desc: str = None):
+        self.spans.append((name, start - self.start, end - start, desc))
+
+    def server_timing(self) -> str:
+        entries = []
+        for name, _, duration, desc in self.spans[:SERVER_TIMING_MAX_SPANS]:
+            entry = f"{name};dur={duration * 1000:.1f}"
+            if desc:
+                entry += ';desc="' + str(desc).replace("\\", "\\\\").replace('"', '\\"') + '"'
+            entries.append(entry)
+        entries.append(f"total;dur={(time.monotonic() - self.start) * 1000:.1f}")
+        return ", ".join(entries)
+
+    def as_list(self) -> list:
+        return [{"name": name, "at_ms": round(at * 1000, 1), "dur_ms": round(duration * 1000, 1), "desc": desc}
+                for name, at, duration, desc in self.spans]
+
+TRACE = ContextVar("trace", default=None)
+
+@contextmanager
+def span(name: str, desc: str = None):
+    start = time.monotonic()
     try:
-        # Some CDNs reject requests without a User-Agent
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
-            'Referer': 'https://www.youtube.com/'
-        }
-        
-        # Increase timeout for large files
-        r = requests.get(url, stream=True, headers=headers, timeout=30)
-        r.raise_for_status()
-        
-        clean_title = re.sub(r'[^\w\-_\. ]', '_', title)[:100]
-        safe_filename = urllib.parse.quote(f"{clean_title}.{ext}")
-        
-        return StreamingResponse(
-            r.iter_content(chunk_size=1024*1024),
-            media_type=r.headers.get("Content-Type", "video/mp4"),
-            headers={
-                "Content-Disposition": f"attachment; filename*=UTF-8''{safe_filename}"
+        yield
+    finally:
+        trace = TRACE.get()
+        if trace is not None:
+            trace.add(name, start, time.monotonic(), desc)
+
+# httpcore trace events -> span names. DNS resolution happens inside the
+# TCP connect, so it is part of "connect".
+HTTP_PHASES = {"connect_tcp": "connect", "start_tls": "tls", "receive_response_headers": "ttfb"}
+
+def http_phases(prefix: str, desc: str = None) -> dict:
+    """
+    Request extensions that record connect, TLS and time-to-first-byte
+    spans for one upstream call. Reused connections skip the first two.
+    """
+    trace = TRACE.get()
+    if trace is None:
+        return {}
+    started = {}
+
+    async def hook(event: str, info: dict):
+        step, _, state = event.rpartition(".")
+        phase = HTTP_PHASES.get(step.rpartition(".")[2])
+        if phase is None:
+            return
+        if state == "started":
+            started[phase] = time.monotonic()
+        elif phase in started:
+            trace.add(f"{prefix}.{phase}", started.pop(phase), time.monotonic(), desc)
+
+    return {"trace": hook}
+
+class StackSampler:
+    """
+    Sampling profiler for one request. A helper thread records the event
+    loop thread's stack every PROFILE_INTERVAL; since the loop is shared,
+    samples include whatever else it was running at the time.
+    """
+
+    def __init__(self):
+        self.thread_id = threading.get_ident()
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(PROFILE_INTERVAL):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.samples[";".join(reversed(stack))] += 1
+
+    def stop(self, top: int = 20) -> list:
+        self._stop.set()
+        self._thread.join()
+        return [{"stack": stack, "samples": count} for stack, count in self.samples.most_common(top)]
+
+class ServerTimingMiddleware:
+    """
+    Traces each API request: spans go out in a Server-Timing header (those
+    recorded before the response starts) and in a structured log line when
+    the request finishes. X-Debug-Profile with DEBUG_PROFILE_TOKEN also
+    attaches sampled stacks to the log line.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        trace = Trace()
+        token = TRACE.set(trace)
+        sampler = None
+        if DEBUG_PROFILE_TOKEN:
+            for name, value in scope["headers"]:
+                if name == b"x-debug-profile" and secrets.compare_digest(value, DEBUG_PROFILE_TOKEN.encode()):
+                    sampler = StackSampler()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", trace.server_timing().encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            fields = {
+                "method": scope["method"],
+                "path": scope["path"],
+                "status": status,
+                "dur_ms": round((time.monotonic() - trace.start) * 1000, 1),
+                "spans": trace.as_list(),
             }
-        )
-    except Exception as e:
-        print(f"Download Proxy Error: {e}")
-        raise HTTPException(status_code=500, detail="Failed to proxy download. Source link might have expired.")from fastapi import FastAPI, HTTPException, Query
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
-import requests
-import urllib.parse
-import random
-import re
-import json
+            if sampler:
+                fields["profile"] = sampler.stop()
+            log_event("request", **fields)
+            TRACE.reset(token)
 
-app = FastAPI()
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25)
+TTFB_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        # Per-bucket counts; made cumulative only when rendered
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+class Metrics:
+    """
+    Counters, gauges and histograms rendered in the Prometheus text format.
+    Updates all happen on the event loop thread, so they are plain dict and
+    integer operations without locks. Families may instead be collected from
+    existing stats at scrape time, which costs the hot path nothing.
+    """
+
+    def __init__(self):
+        self.families = {}
+        self.values = {}
+        self.histograms = {}
+
+    def register(self, name: str, kind: str, help: str, labels: tuple = (), buckets: tuple = None, collect=None):
+        self.families[name] = (kind, help, labels, buckets, collect)
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1):
+        key = (name, labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name: str, labels: tuple, value: float):
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram(self.families[name][3])
+        histogram.observe(value)
+
+    def render(self) -> str:
+        lines = []
+        for name, (kind, help, labels, buckets, collect) in self.families.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "histogram":
+                for (family, values), histogram in self.histograms.items():
+                    if family != name:
+                        continue
+                    pairs = list(zip(labels, values))
+                    total = 0
+                    for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                        total += count
+                        lines.append(f"{name}_bucket{render_labels(pairs + [('le', bound)])} {total}")
+                    lines.append(f"{name}_sum{render_labels(pairs)} {histogram.sum}")
+                    lines.append(f"{name}_count{render_labels(pairs)} {total}")
+                continue
+            samples = collect() if collect else [(values, value) for (family, values), value in self.values.items() if family == name]
+            for values, value in samples:
+                lines.append(f"{name}{render_labels(list(zip(labels, values)))} {value}")
+        return "\n".join(lines) + "\n"
+
+def render_labels(pairs: list) -> str:
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+METRICS = Metrics()
+METRICS.register("umii_provider_requests_total", "counter", "Extraction attempts per provider by outcome.", ("provider", "outcome"))
+METRICS.register("umii_provider_latency_seconds", "histogram", "Extraction latency per provider.", ("provider",), LATENCY_BUCKETS)
+METRICS.register("umii_instance_requests_total", "counter", "Requests per Piped/Cobalt instance by outcome.", ("pool", "instance", "outcome"))
+METRICS.register("umii_instance_latency_seconds", "histogram", "Request latency per Piped/Cobalt instance.", ("pool", "instance"), LATENCY_BUCKETS)
+METRICS.register("umii_downloads_in_flight", "gauge", "Download bodies currently streaming.", ())
+METRICS.register("umii_proxied_bytes_total", "counter", "Bytes relayed to clients by /api/download.", ())
+METRICS.register("umii_download_ttfb_seconds", "histogram", "Time from a download request to its first body byte.", (), TTFB_BUCKETS)
+METRICS.values[("umii_downloads_in_flight", ())] = 0
+METRICS.values[("umii_proxied_bytes_total", ())] = 0
+
+def timed_provider(name: str):
+    """
+    Records latency and outcome ("success", "failure", "cancelled") of a
+    provider, as a metric and as a span of the current request.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        async def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            outcome = "failure"
+            try:
+                result = await fn(*args, **kwargs)
+                if result:
+                    outcome = "success"
+                return result
+            except asyncio.CancelledError:
+                outcome = "cancelled"
+                raise
+            finally:
+                end = time.monotonic()
+                trace = TRACE.get()
+                if trace is not None:
+                    trace.add(name, start, end, outcome)
+                METRICS.observe("umii_provider_latency_seconds", (name,), end - start)
+                METRICS.inc("umii_provider_requests_total", (name, outcome))
+        return wrapper
+    return decorator
+
+class Deadline:
+    """
+    A point in time shared by every stage of one request.
+    Stages take their timeouts from what is left, so the fallback chain as
+    a whole finishes within the budget the client asked for.
+    """
+
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self, cap: float, shares: int = 1) -> float:
+        """The stage's usual timeout, or its share of what is left if less."""
+        return min(cap, self.remaining() / max(shares, 1))
+
+    def split(self, shares: int) -> "Deadline":
+        """A sub-deadline covering one of `shares` equal parts of what is left."""
+        return Deadline(self.remaining() / max(shares, 1))
+
+class InstanceHealth:
+    __slots__ = ("url", "latency", "success", "failures", "state", "opened_at")
+
+    def __init__(self, url: str):
+        self.url = url
+        # Optimistic priors so unseen instances get tried
+        self.latency = 1.0
+        self.success = 1.0
+        self.failures = 0
+        self.state = "closed"
+        self.opened_at = 0.0
+
+    def score(self) -> float:
+        """
+        Latency scaled by the success rate; lower is better. The rate is
+        squared so a recent failure outweighs being a little faster.
+        """
+        return self.latency / max(self.success, 0.05) ** 2
+
+class InstancePool:
+    """
+    Orders a provider's upstream instances by observed health.
+    Each instance keeps an EWMA of its latency and success rate, and callers
+    try instances by lowest expected cost first. After BREAKER_THRESHOLD
+    consecutive failures an instance's breaker opens and it is skipped. Once
+    BREAKER_COOLDOWN has passed it is probed in the background (half-open)
+    and only rejoins the rotation if the probe succeeds. With a registry URL
+    the instance list is also refreshed in the background on a schedule.
+    """
+
+    def __init__(self, name: str, urls: list, probe_url, registry_url: str = "", registry_interval: float = 3600):
+        self.name = name
+        self.instances = {url: InstanceHealth(url) for url in urls}
+        self.probe_url = probe_url
+        self.registry_url = registry_url
+        self.registry_interval = registry_interval
+        self._registry_due = 0.0
+        self._tasks = set()
+
+    def ranked(self) -> list:
+        now = time.monotonic()
+        if self.registry_url and now >= self._registry_due:
+            self._registry_due = now + self.registry_interval
+            self._spawn(self._refresh())
+
+        available = []
+        for health in list(self.instances.values()):
+            if health.state == "open" and now - health.opened_at >= BREAKER_COOLDOWN:
+                health.state = "half_open"
+                self._spawn(self._probe(health))
+            if health.state == "closed":
+                available.append(health)
+        # Stable sort keeps the configured order among equal scores
+        available.sort(key=InstanceHealth.score)
+        return [health.url for health in available]
+
+    def record(self, url: str, ok: bool, latency: float):
+        health = self.instances.get(url)
+        if health is None:
+            return
+        METRICS.observe("umii_instance_latency_seconds", (self.name, url), latency)
+        METRICS.inc("umii_instance_requests_total", (self.name, url, "success" if ok else "failure"))
+        health.latency += HEALTH_EWMA_ALPHA * (latency - health.latency)
+        health.success += HEALTH_EWMA_ALPHA * ((1.0 if ok else 0.0) - health.success)
+        if ok:
+            health.failures = 0
+            return
+        health.failures += 1
+        if health.state == "closed" and health.failures >= BREAKER_THRESHOLD:
+            health.state = "open"
+            health.opened_at = time.monotonic()
+            log_event("circuit_opened", logging.WARNING, pool=self.name, instance=url)
+
+    def stats(self) -> list:
+        return [{
+            "url": h.url,
+            "state": h.state,
+            "latency_ewma": round(h.latency, 3),
+            "success_ewma": round(h.success, 3),
+            "consecutive_failures": h.failures,
+        } for h in self.instances.values()]
+
+    def _spawn(self, coro):
+        # Keep a reference so background tasks are not garbage collected
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _probe(self, health: InstanceHealth):
+        start = time.monotonic()
+        try:
+            response = await get_client().get(self.probe_url(health.url), timeout=5)
+            ok = response.status_code < 500
+        except Exception:
+            ok = False
+        health.latency += HEALTH_EWMA_ALPHA * (time.monotonic() - start - health.latency)
+        if ok:
+            health.state = "closed"
+            health.failures = 0
+            log_event("circuit_closed", pool=self.name, instance=health.url)
+        else:
+            health.state = "open"
+            health.opened_at = time.monotonic()
+
+    async def _refresh(self):
+        try:
+            response = await get_client().get(self.registry_url, timeout=10)
+            entries = response.json()
+            urls = [(e.get("api_url") if isinstance(e, dict) else e) for e in entries]
+            urls = [u.rstrip("/") for u in urls if isinstance(u, str) and u.startswith("http")]
+        except Exception as e:
+            log_event("registry_refresh_failed", logging.WARNING, pool=self.name, error=str(e))
+            return
+        if urls:
+            # Known instances keep their health history
+            self.instances = {u: self.instances.get(u) or InstanceHealth(u) for u in urls}
+
+def cobalt_probe_url(api_url: str) -> str:
+    parts = urllib.parse.urlsplit(api_url)
+    return f"{parts.scheme}://{parts.netloc}/api/serverInfo"
+
+PIPED_POOL = InstancePool("piped", PIPED_INSTANCES, lambda base: f"{base}/healthcheck",
+                          registry_url=PIPED_REGISTRY_URL, registry_interval=PIPED_REGISTRY_INTERVAL)
+COBALT_POOL = InstancePool("cobalt", COBALT_INSTANCES, cobalt_probe_url)
 
 app.add_middleware(
     CORSMiddleware,
@@ -231,33 +662,214 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Content-Length", "Content-Range", "Accept-Ranges", "ETag", "Last-Modified", "Server-Timing", "Retry-After"],
 )
+app.add_middleware(ServerTimingMiddleware)
+
+class Platform:
+    """
+    A site we can extract from: the hosts it owns, compiled patterns that
+    pull its canonical video ID out of a URL on each host, and the provider
+    chain that resolves its links.
+    """
+
+    def __init__(self, name: str, hosts: dict, chain):
+        self.name = name
+        self.hosts = hosts
+        self.chain = chain
+
+    def match_id(self, host: str, target: str):
+        for pattern in self.hosts.get(host, ()):
+            match = pattern.search(target)
+            if match:
+                return match.group(1)
+        return None
+
+# host -> Platform. Hosts are stored without "www."/"m." style prefixes;
+# lookups fall back to parent domains, so subdomains need no entry.
+PLATFORM_HOSTS = {}
+
+def register_platform(name: str, hosts: dict):
+    """
+    Registers a provider chain for a platform. `hosts` maps each host the
+    platform handles to the compiled patterns that find a video ID in
+    "path?query" on that host. New platforms plug in here without any
+    change to the dispatch in `info`.
+    """
+    def decorator(chain):
+        platform = Platform(name, hosts, chain)
+        for host in hosts:
+            PLATFORM_HOSTS[host] = platform
+        return chain
+    return decorator
+
+BARE_YOUTUBE_ID = re.compile(r'^[0-9A-Za-z_-]{11}$')
+# Optional scheme and the authority; "path?query" is whatever follows
+URL_AUTHORITY = re.compile(r'^(?:[A-Za-z][A-Za-z0-9+.-]*://)?([^/?#]*)')
+
+@lru_cache(maxsize=4096)
+def route(url: str):
+    """
+    Parses a URL once and finds the platform that owns its host.
+    Returns (platform, host, video_id); platform is None for unknown hosts
+    and video_id is None when no pattern matched. Results are memoized, so
+    the cache key, dispatch and provider lookups share one parse.
+    """
+    url = url.strip()
+    if len(url) == 11 and BARE_YOUTUBE_ID.match(url):
+        platform = PLATFORM_HOSTS["youtube.com"]
+        return platform, "youtube.com", url
+
+    match = URL_AUTHORITY.match(url)
+    host = match.group(1).lower()
+    target = url[match.end():]
+    if "@" in host or ":" in host:
+        host = host.rpartition("@")[2].partition(":")[0]
+    if host.startswith("www."):
+        host = host[4:]
+    # Exact host first, then each parent domain ("m.youtube.com" -> "youtube.com")
+    while host:
+        platform = PLATFORM_HOSTS.get(host)
+        if platform:
+            return platform, host, platform.match_id(host, target)
+        _, _, host = host.partition(".")
+        if "." not in host:
+            break
+    return None, None, None
 
 def extract_youtube_id(url: str):
     """
     Extracts the YouTube Video ID from various URL formats.
     """
-    url = url.strip()
-    patterns = [
-        r'(?:v=|\/)([0-9A-Za-z_-]{11}).*',
-        r'(?:v=|\/)([0-9A-Za-z_-]{11})',
-        r'youtu\.be\/([0-9A-Za-z_-]{11})',
-        r'shorts\/([0-9A-Za-z_-]{11})',
-        r'^([0-9A-Za-z_-]{11})$'
-    ]
-    for pattern in patterns:
-        match = re.search(pattern, url)
-        if match:
-            return match.group(1)
+    platform, _, video_id = route(url)
+    if platform and platform.name == "youtube":
+        return video_id
+    return None
+
+PLAYLIST_PARAM = re.compile(r'[?&]list=([0-9A-Za-z_-]{10,})')
+CHANNEL_PATH = re.compile(r'^/(channel/UC[0-9A-Za-z_-]{22}|c/[^/?#]+|user/[^/?#]+|@[^/?#]+)')
+
+def extract_youtube_collection(url: str):
+    """
+    Finds a playlist or channel in a YouTube URL.
+    Returns ("playlist", playlist_id), ("channel", piped_path) or None.
+    """
+    platform, _, _ = route(url)
+    if not platform or platform.name != "youtube":
+        return None
+    target = url.strip()[URL_AUTHORITY.match(url.strip()).end():]
+    match = PLAYLIST_PARAM.search(target)
+    if match:
+        return "playlist", match.group(1)
+    match = CHANNEL_PATH.match(target)
+    if match:
+        path = match.group(1)
+        # Piped serves handles at /@/{handle}
+        return "channel", "@/" + path[1:] if path.startswith("@") else path
     return None
 
-def process_tiktok_tikwm(url: str):
+def format_entry(id, url, ext, height, bitrate, codec, size, audio_only=False, video_only=False) -> dict:
+    return {
+        "id": id,
+        "url": url,
+        "ext": ext,
+        "height": height,
+        "bitrate": bitrate,
+        "codec": codec,
+        "size": size,
+        "audio_only": audio_only,
+        "video_only": video_only,
+    }
+
+def rank_formats(formats: list) -> list:
+    # Best first: video before audio, taller first, streams with sound
+    # before video-only ones of the same height, then higher bitrate
+    return sorted(formats, key=lambda f: (f["audio_only"], -(f["height"] or 0), f["video_only"], -(f["bitrate"] or 0)))
+
+def piped_formats(data: dict) -> list:
+    """
+    Flattens a Piped /streams answer into ranked format entries. Sizes come
+    from contentLength when Piped knows it, otherwise bitrate x duration.
+    """
+    duration = data.get("duration") or 0
+    formats = []
+    for stream in data.get("videoStreams", []) + data.get("audioStreams", []):
+        if not stream.get("url"):
+            continue
+        kind, _, subtype = (stream.get("mimeType") or "").split(";")[0].partition("/")
+        audio_only = kind == "audio"
+        ext = "m4a" if audio_only and subtype == "mp4" else subtype or "mp4"
+        bitrate = stream.get("bitrate") or None
+        size = stream.get("contentLength") or (bitrate * duration // 8 if bitrate and duration else None)
+        formats.append(format_entry(
+            str(stream.get("itag")), stream["url"], ext,
+            None if audio_only else stream.get("height") or None,
+            bitrate, stream.get("codec"), size or None,
+            audio_only=audio_only, video_only=bool(stream.get("videoOnly")) and not audio_only,
+        ))
+    return rank_formats(formats)
+
+def tikwm_formats(res: dict) -> list:
+    """
+    tikwm offers an HD and an SD rendition plus the soundtrack. It reports
+    sizes but no resolution, so bitrates are derived from size and duration.
+    """
+    duration = res.get("duration") or 0
+    formats = []
+    for id, url_field, size_field, ext in (("hd", "hdplay", "hd_size", "mp4"), ("sd", "play", "size", "mp4"), ("audio", "music", None, "mp3")):
+        if not res.get(url_field):
+            continue
+        size = res.get(size_field) if size_field else None
+        bitrate = size * 8 // duration if size and duration else None
+        formats.append(format_entry(id, res[url_field], ext, None, bitrate, None, size or None, audio_only=id == "audio"))
+    return formats
+
+def pick_format(formats: list, quality: int = None, max_bitrate: int = None, video_only: bool = False):
+    """
+    Picks the cheapest stream with sound (or, with `video_only`, without
+    it, for muxing) that satisfies the target: at
+    least `quality` lines (unknown heights count as satisfying) within
+    `max_bitrate` bits/s. With only a bitrate cap, the best stream under it
+    wins. When nothing satisfies the target the nearest miss is returned;
+    with no target, the best MP4 for compatibility. None if nothing plays.
+    """
+    playable = [f for f in formats if not f["audio_only"] and f["video_only"] == video_only]
+    if not playable:
+        return None
+    cost = lambda f: f["bitrate"] or f["size"] or 0
+    under = [f for f in playable if not max_bitrate or (f["bitrate"] and f["bitrate"] <= max_bitrate)]
+    if quality:
+        meets = [f for f in under if (f["height"] or quality) >= quality]
+        if meets:
+            return min(meets, key=cost)
+        return max(under or playable, key=lambda f: (f["height"] or 0, -cost(f)))
+    if max_bitrate:
+        return max(under, key=cost) if under else min(playable, key=cost)
+    return next((f for f in playable if f["ext"] == "mp4"), playable[0])
+
+def with_target(result: dict, quality: int = None, max_bitrate: int = None) -> dict:
+    # Cached results are shared, so the selection goes into a copy
+    chosen = pick_format(result.get("formats") or [], quality, max_bitrate) if quality or max_bitrate else None
+    if not chosen:
+        return result
+    return {**result, "download_url": chosen["url"], "ext": chosen["ext"]}
+
+@timed_provider("tikwm")
+async def process_tiktok_tikwm(url: str, deadline: Deadline = None):
+    deadline = deadline or Deadline(INFO_DEFAULT_DEADLINE)
+    if deadline.expired():
+        return None
     try:
-        api_url = "https://www.tikwm.com/api/"
-        response = requests.post(api_url, data={'url': url, 'hd': 1}, timeout=5)
-        data = response.json()
+        response = await get_client().post(
+            TIKWM_API_URL, data={'url': url, 'hd': 1}, timeout=deadline.timeout(5),
+            extensions=http_phases("tikwm")
+        )
+        with span("tikwm.parse"):
+            data = response.json()
         if data.get("code") == 0:
             res = data["data"]
+            with span("normalize"):
+                formats = tikwm_formats(res)
             return {
                 "id": res.get("id"),
                 "title": res.get("title") or "TikTok Video",
@@ -265,68 +877,114 @@ def process_tiktok_tikwm(url: str):
                 "duration": res.get("duration"),
                 "platform": "TikTok",
                 "download_url": res.get("play"),
-                "ext": "mp4"
+                "ext": "mp4",
+                "formats": formats
             }
     except Exception as e:
-        print(f"TikTok Error: {e}")
+        log_event("provider_error", logging.WARNING, provider="tikwm", error=str(e))
     return None
 
-def process_youtube_piped(url: str):
+@timed_provider("piped")
+async def process_youtube_piped(url: str, deadline: Deadline = None):
     video_id = extract_youtube_id(url)
     if not video_id: 
         return None
-    
-    # Prioritize faster/less blocked instances
-    instances = [
-        "https://pipedapi.kavin.rocks",
-        "https://api.piped.kotnn.me",
-        "https://piped-api.lunar.icu",
-        "https://pipedapi.drgns.space",
-        "https://api.piped.privacy.com.de"
-    ]
-    
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36"
-    }
+    deadline = deadline or Deadline(INFO_DEFAULT_DEADLINE)
+
+    headers = {"User-Agent": BROWSER_UA}
+
+    # Race the instances: keep up to PIPED_FANOUT requests in flight, start a
+    # new one whenever an attempt fails or has been silent for the hedge
+    # delay, and return the first usable answer.
+    queue = PIPED_POOL.ranked()
+    pending = set()
+    try:
+        while (queue or pending) and not deadline.expired():
+            if queue and len(pending) < PIPED_FANOUT:
+                pending.add(asyncio.create_task(fetch_piped_streams(queue.pop(0), video_id, headers, deadline.timeout(PIPED_ATTEMPT_TIMEOUT))))
+            # Only wait the hedge delay while there is something left to start
+            can_hedge = queue and len(pending) < PIPED_FANOUT
+            wait_for = deadline.timeout(PIPED_HEDGE_DELAY) if can_hedge else deadline.remaining()
+            done, pending = await asyncio.wait(pending, timeout=wait_for, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                if result:
+                    return result
+    finally:
+        # Cancel the losing attempts so their connections go back to the pool
+        for task in pending:
+            task.cancel()
 
-    for base_url in instances:
-        try:
-            print(f"Trying Piped Instance: {base_url}")
-            # Reduced timeout to 2.5s to fail fast and try next
-            api_endpoint = f"{base_url}/streams/{video_id}"
-            response = requests.get(api_endpoint, headers=headers, timeout=2.5)
-            
-            if response.status_code == 200:
-                data = response.json()
-                if "error" in data: continue
-
-                streams = data.get("videoStreams", [])
-                # Prefer mp4, non-videoOnly
-                best_stream = next((s for s in streams if s.get("format") == "MPEG-4" and not s.get("videoOnly")), None)
-                
-                if not best_stream and streams:
-                    best_stream = streams[0]
-                    
-                if best_stream:
-                    return {
-                        "id": video_id,
-                        "title": data.get("title") or "YouTube Video",
-                        "thumbnail": data.get("thumbnailUrl"),
-                        "duration": data.get("duration"),
-                        "platform": "YouTube",
-                        "download_url": best_stream.get("url"),
-                        "ext": "mp4"
-                    }
-        except Exception as e:
-            print(f"Instance {base_url} failed: {str(e)}")
-            continue
-            
     return None
 
-def process_cobalt(url: str, backup=False):
-    # Primary and Backup Cobalt instances
-    api_url = "https://co.wuk.sh/api/json" if backup else "https://api.cobalt.tools/api/json"
-    
+def piped_answer(response: httpx.Response):
+    """
+    Splits a Piped answer into (data, healthy): the JSON body if it is a
+    usable result, else None, and whether the instance itself is working.
+    Piped reports a problem with one video or listing (private, removed, a
+    bogus ID) as a JSON {"error": ...} with status 200 or 500; that is a
+    healthy instance saying no, and counting it would let anyone open the
+    breakers by asking for a bad ID. Only answers that are not JSON count
+    against the instance, unless they are 4xx.
+    """
+    try:
+        data = response.json()
+    except ValueError:
+        return None, 400 <= response.status_code < 500
+    if response.status_code != 200 or not isinstance(data, dict) or "error" in data:
+        return None, True
+    return data, True
+
+async def fetch_piped_streams(base_url: str, video_id: str, headers: dict, timeout: float = PIPED_ATTEMPT_TIMEOUT):
+    # Cancelled attempts (lost races) are not recorded either way
+    start = time.monotonic()
+    ok = False
+    counted = True
+    try:
+        log_event("provider_attempt", logging.DEBUG, provider="piped", instance=base_url)
+        # Reduced timeout (PIPED_ATTEMPT_TIMEOUT) to fail fast and try next
+        api_endpoint = f"{base_url}/streams/{video_id}"
+        with span("piped.attempt", base_url):
+            response = await get_client().get(
+                api_endpoint, headers=headers, timeout=timeout,
+                extensions=http_phases("piped", base_url)
+            )
+
+        with span("piped.parse", base_url):
+            data, ok = piped_answer(response)
+        if data is not None:
+            with span("normalize"):
+                formats = piped_formats(data)
+                # Best stream with audio; a video-only one beats nothing at all
+                best_stream = pick_format(formats) or next((f for f in formats if not f["audio_only"]), None)
+
+            if best_stream:
+                return {
+                    "id": video_id,
+                    "title": data.get("title") or "YouTube Video",
+                    "thumbnail": data.get("thumbnailUrl"),
+                    "duration": data.get("duration"),
+                    "platform": "YouTube",
+                    "download_url": best_stream["url"],
+                    "ext": best_stream["ext"],
+                    "formats": formats
+                }
+    except asyncio.CancelledError:
+        counted = False
+        raise
+    except Exception as e:
+        counted = not isinstance(e, httpx.TimeoutException) or timeout >= PIPED_ATTEMPT_TIMEOUT
+        log_event("provider_error", logging.WARNING, provider="piped", instance=base_url, error=str(e))
+    finally:
+        if counted:
+            PIPED_POOL.record(base_url, ok, time.monotonic() - start)
+
+    return None
+
+@timed_provider("cobalt")
+async def process_cobalt(url: str, deadline: Deadline = None):
+    deadline = deadline or Deadline(INFO_DEFAULT_DEADLINE)
+
     headers = {
         "Accept": "application/json", 
         "Content-Type": "application/json",
@@ -336,530 +994,2498 @@ def process_cobalt(url: str, backup=False):
     payload = {
         "url": url, 
         "vCodec": "h264", 
-        "vQuality": "720",
+        "vQuality": COBALT_QUALITY,
         "filenamePattern": "basic",
         "isAudioOnly": False
     }
-    
-    try:
-        print(f"Trying Cobalt ({'Backup' if backup else 'Primary'})...")
-        response = requests.post(api_url, json=payload, headers=headers, timeout=8)
-        data = response.json()
-        
-        # Cobalt success check
-        if data.get("status") in ["stream", "redirect"] or "url" in data:
-            return {
-                "id": f"dl-{random.randint(1000, 9999)}",
-                "title": data.get("text") or data.get("filename") or "Downloaded Video",
-                "thumbnail": "https://images.unsplash.com/photo-1611162617213-7d7a39e9b1d7?auto=format&fit=crop&w=300",
-                "duration": None,
-                "platform": "Social Media",
-                "download_url": data.get("url"),
-                "ext": "mp4"
-            }
-    except Exception as e:
-        print(f"Cobalt {'Backup' if backup else 'Primary'} Error: {e}")
-        
-    return None
 
-@app.get("/api/info")
-async def info(url: str = Query(..., description="The URL to process")):
-    if not url:
-        raise HTTPException(status_code=400, detail="URL is required")
-    
-    print(f"Processing URL: {url}")
-    result = None
-    
-    # 1. TikTok Logic
-    if "tiktok.com" in url:
-        result = process_tiktok_tikwm(url)
-        if not result:
-            result = process_cobalt(url) # Fallback to Cobalt for TikTok
-    
-    # 2. YouTube Logic
-    elif "youtube.com" in url or "youtu.be" in url:
-        # Try Piped first
-        result = process_youtube_piped(url)
-        # If Piped fails, try Cobalt Primary
-        if not result:
-            result = process_cobalt(url, backup=False)
-        # If Cobalt Primary fails, try Cobalt Backup
-        if not result:
-            result = process_cobalt(url, backup=True)
-    
-    # 3. General Fallback (Instagram, Twitter, etc.)
-    else:
-        result = process_cobalt(url, backup=False)
-        if not result:
-            result = process_cobalt(url, backup=True)
+    # Healthiest Cobalt instance first; each attempt gets an equal share of
+    # the time left for the instances that have not been tried yet
+    instances = COBALT_POOL.ranked()
+    for attempt, api_url in enumerate(instances):
+        if deadline.expired():
+            break
+        timeout = deadline.timeout(COBALT_ATTEMPT_TIMEOUT, shares=len(instances) - attempt)
+        start = time.monotonic()
+        ok = False
+        counted = True
+        try:
+            log_event("provider_attempt", logging.DEBUG, provider="cobalt", instance=api_url)
+            with span("cobalt.attempt", api_url):
+                response = await get_client().post(
+                    api_url, json=payload, headers=headers, timeout=timeout,
+                    extensions=http_phases("cobalt", api_url)
+                )
+            with span("cobalt.parse", api_url):
+                data = response.json()
+            # Any well-formed JSON answer means the instance itself is healthy
+            ok = response.status_code < 500
+
+            # Cobalt success check
+            if data.get("status") in ["stream", "redirect"] or "url" in data:
+                return {
+                    "id": f"dl-{random.randint(1000, 9999)}",
+                    "title": data.get("text") or data.get("filename") or "Downloaded Video",
+                    "thumbnail": "https://images.unsplash.com/photo-1611162617213-7d7a39e9b1d7?auto=format&fit=crop&w=300",
+                    "duration": None,
+                    "platform": "Social Media",
+                    "download_url": data.get("url"),
+                    "ext": "mp4"
+                }
+        except asyncio.CancelledError:
+            counted = False
+            raise
+        except Exception as e:
+            counted = not isinstance(e, httpx.TimeoutException) or timeout >= COBALT_ATTEMPT_TIMEOUT
+            log_event("provider_error", logging.WARNING, provider="cobalt", instance=api_url, error=str(e))
+        finally:
+            if counted:
+                COBALT_POOL.record(api_url, ok, time.monotonic() - start)
+
+    return None
+
+class TTLCache:
+    """
+    LRU mapping whose entries also expire at their own deadline.
+    Bounded to `maxsize` entries; the least recently used entry is evicted
+    first. Counters are kept so the cache can be sized from real traffic.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key):
+        """Like get, for lookups that aren't cache traffic: counters and recency are left alone."""
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+    def set(self, key, value, ttl: float):
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+INFO_CACHE = TTLCache(INFO_CACHE_SIZE)
+
+class SingleFlight:
+    """
+    Lets concurrent callers with the same key share one in-flight call.
+    The call runs as its own task, so a caller that disconnects does not
+    cancel the work for the others; every caller receives the same result
+    or exception.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key, fn):
+        task = self._calls.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._calls),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
+
+INFO_FLIGHTS = SingleFlight()
+
+class CacheBackend:
+    """
+    A shared cache tier. Values are JSON-serializable; lookups return
+    (value, seconds left) or None. `get_or_set` is atomic: it stores the
+    value only if no live entry exists and returns whichever entry won, so
+    racing workers all end up with the same result.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get(self, key: str):
+        raise NotImplementedError
+
+    async def get_or_set(self, key: str, value, ttl: float):
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {"backend": type(self).__name__, "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+class SQLiteCache(CacheBackend):
+    """
+    Shared tier in a local SQLite database, for the workers on one host.
+    WAL mode lets readers carry on while a worker writes. Queries run in
+    worker threads, each with its own connection; expiry uses wall-clock
+    time since it is compared across processes. Expired rows are deleted
+    every `compact_interval` seconds by whichever worker notices first.
+    """
+
+    def __init__(self, path: str, compact_interval: float = INFO_CACHE_COMPACT_INTERVAL):
+        super().__init__()
+        self.path = path
+        self.compact_interval = compact_interval
+        self._next_compact = time.time() + compact_interval
+        self._local = threading.local()
 
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            # Imported here so deployments without the SQLite tier skip it
+            import sqlite3
+            # Autocommit mode; transactions are opened explicitly
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)")
+            self._local.db = db
+        return db
+
+    def _get(self, key: str):
+        now = time.time()
+        row = self._db().execute("SELECT value, expires FROM results WHERE key = ? AND expires > ?", (key, now)).fetchone()
+        return (json.loads(row[0]), row[1] - now) if row else None
+
+    def _get_or_set(self, key: str, value, ttl: float):
+        db = self._db()
+        now = time.time()
+        # IMMEDIATE takes the write lock up front, so check-then-insert is atomic
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT value, expires FROM results WHERE key = ? AND expires > ?", (key, now)).fetchone()
+            if row:
+                found = (json.loads(row[0]), row[1] - now)
+            else:
+                db.execute("INSERT OR REPLACE INTO results (key, value, expires) VALUES (?, ?, ?)", (key, json.dumps(value), now + ttl))
+                found = (value, ttl)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        if now >= self._next_compact:
+            self._next_compact = now + self.compact_interval
+            self._compact(now)
+        return found
+
+    def _compact(self, now: float):
+        self.evictions += self._db().execute("DELETE FROM results WHERE expires <= ?", (now,)).rowcount
+        self._db().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    async def get(self, key: str):
+        found = await asyncio.to_thread(self._get, key)
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return found
+
+    async def get_or_set(self, key: str, value, ttl: float):
+        return await asyncio.to_thread(self._get_or_set, key, value, ttl)
+
+class RedisRESTCache(CacheBackend):
+    """
+    Shared tier in Redis over the Upstash REST protocol, which Vercel KV
+    exposes, so every instance of a deployment shares results. Commands
+    run as one MULTI/EXEC transaction per call; Redis expires the keys.
+    """
+
+    def __init__(self, url: str, token: str, prefix: str = "umii:info:"):
+        super().__init__()
+        self.url = url.rstrip("/")
+        self.token = token
+        self.prefix = prefix
+
+    async def _transaction(self, commands: list) -> list:
+        response = await get_client().post(
+            f"{self.url}/multi-exec", json=commands,
+            headers={"Authorization": f"Bearer {self.token}"}, timeout=2
+        )
+        response.raise_for_status()
+        results = []
+        for item in response.json():
+            if "error" in item:
+                raise ValueError(item["error"])
+            results.append(item.get("result"))
+        return results
+
+    async def get(self, key: str):
+        key = self.prefix + key
+        value, pttl = await self._transaction([["GET", key], ["PTTL", key]])
+        if value is None or pttl is None or pttl <= 0:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value), pttl / 1000
+
+    async def get_or_set(self, key: str, value, ttl: float):
+        key = self.prefix + key
+        _, stored, pttl = await self._transaction([
+            ["SET", key, json.dumps(value), "NX", "PX", str(max(int(ttl * 1000), 1))],
+            ["GET", key],
+            ["PTTL", key],
+        ])
+        if stored is None:
+            return value, ttl
+        return json.loads(stored), pttl / 1000 if pttl and pttl > 0 else ttl
+
+class TieredCache:
+    """
+    The in-process TTLCache in front of an optional shared backend. Callers
+    check memory themselves (resolve does), then ask `get_shared`, which
+    keeps what it finds in memory for its remaining lifetime; stores go
+    through the backend's get-or-set, so
+    every worker serves the winning result. `on_fill(key, value, ttl)` sees
+    each value entering memory. Backend errors are logged and count as
+    misses, so a broken shared tier only costs the sharing.
+    """
+
+    def __init__(self, memory: TTLCache, shared: CacheBackend = None, on_fill=None):
+        self.memory = memory
+        self.shared = shared
+        self.on_fill = on_fill
+
+    def _fill(self, key: str, value, ttl: float):
+        self.memory.set(key, value, ttl)
+        if self.on_fill:
+            self.on_fill(key, value, ttl)
+
+    async def get_shared(self, key: str):
+        if self.shared is None:
+            return None
+        try:
+            found = await self.shared.get(key)
+        except Exception as e:
+            log_event("shared_cache_error", logging.WARNING, op="get", error=str(e))
+            return None
+        if found is None:
+            return None
+        value, ttl = found
+        self._fill(key, value, ttl)
+        return value
+
+    async def get_or_set(self, key: str, value, ttl: float):
+        if self.shared is not None and ttl > 0:
+            try:
+                value, ttl = await self.shared.get_or_set(key, value, ttl)
+            except Exception as e:
+                log_event("shared_cache_error", logging.WARNING, op="get_or_set", error=str(e))
+        self._fill(key, value, ttl)
+        return value
+
+def shared_backend():
+    if INFO_CACHE_BACKEND == "sqlite":
+        return SQLiteCache(INFO_CACHE_SQLITE_PATH)
+    if INFO_CACHE_BACKEND == "kv" and KV_REST_API_URL:
+        return RedisRESTCache(KV_REST_API_URL, KV_REST_API_TOKEN)
+    return None
+
+# download_url -> canonical key of the video it was issued for. Only links we
+# handed out can fill the media cache, so a client can't file arbitrary
+# bytes under someone else's video.
+MEDIA_IDENTITIES = TTLCache(INFO_CACHE_SIZE * 16)
+
+# Query parameters that never change which video a link points to
+TRACKING_PARAMS = {"si", "feature", "igshid", "igsh", "fbclid", "gclid", "is_from_webapp", "sender_device", "_r", "_t"}
+
+def canonical_key(url: str) -> str:
+    """
+    Maps the many URL shapes of one video onto a single cache key.
+    Links on a registered platform collapse to the platform's video ID
+    (YouTube's 11-character ID, TikTok's numeric ID); anything else, TikTok
+    share links included, is keyed by the URL with the host lowercased and
+    tracking parameters removed.
+    """
+    url = url.strip()
+    platform, _, video_id = route(url)
+    if video_id:
+        return f"{platform.name}:{video_id}"
+
+    parts = urllib.parse.urlsplit(url if "://" in url else f"https://{url}")
+    host = parts.netloc.lower().removeprefix("www.").removeprefix("m.")
+    query = sorted(
+        (k, v) for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+        if k not in TRACKING_PARAMS and not k.startswith("utm_")
+    )
+    key = f"url:{host}{parts.path.rstrip('/')}"
+    return f"{key}?{urllib.parse.urlencode(query)}" if query else key
+
+def result_ttl(result: dict) -> float:
+    """
+    Seconds a result may be served from cache: until its signed download URL
+    expires (googlevideo `expire=`, TikTok CDN `x-expires=`), less a margin
+    so clients never receive a link that dies mid-download.
+    """
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(result.get("download_url") or "").query)
+    for name in ("expire", "expires", "x-expires"):
+        value = query.get(name)
+        if value and value[0].isdigit():
+            remaining = int(value[0]) - time.time() - INFO_CACHE_EXPIRY_MARGIN
+            return min(remaining, INFO_CACHE_MAX_TTL)
+    return INFO_CACHE_DEFAULT_TTL
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match uses weak comparison: W/ prefixes are ignored
+    if if_none_match.strip() == "*":
+        return True
+    tags = (tag.strip() for tag in if_none_match.split(","))
+    return etag.removeprefix("W/") in (tag.removeprefix("W/") for tag in tags)
+
+def cacheable_json(request: Request, body: dict) -> Response:
+    """
+    Renders a result with HTTP caching headers, so the edge CDN and browsers
+    can answer repeat lookups without invoking the function. Shared caches
+    may keep it for as long as its signed links stay valid (s-maxage from
+    result_ttl); browsers revalidate every time, which the edge answers with
+    a 304 while its copy is fresh. The ETag is a hash of the exact bytes sent.
+    """
+    response = JSONResponse(content=body)
+    ttl = int(result_ttl(body))
+    if ttl <= 0:
+        response.headers["Cache-Control"] = "no-store"
+        return response
+    etag = '"' + hashlib.sha256(response.body).hexdigest()[:32] + '"'
+    headers = {
+        "Cache-Control": f"public, max-age=0, must-revalidate, s-maxage={ttl}",
+        "ETag": etag,
+        "Vary": "Accept-Encoding",
+    }
+    if etag_matches(request.headers.get("If-None-Match", ""), etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return response
+
+YOUTUBE_ID = r'([0-9A-Za-z_-]{11})(?=[/?&#]|$)'
+
+@register_platform("youtube", {
+    "youtube.com": [
+        re.compile(r'^/watch\?(?:.*&)?v=' + YOUTUBE_ID),
+        re.compile(r'^/(?:shorts|embed|live|v|e)/' + YOUTUBE_ID),
+    ],
+    "youtube-nocookie.com": [re.compile(r'^/embed/' + YOUTUBE_ID)],
+    "youtu.be": [re.compile(r'^/' + YOUTUBE_ID)],
+})
+async def youtube_chain(url: str, deadline: Deadline):
+    # Try Piped first
+    result = await process_youtube_piped(url, deadline.split(2))
+    # If Piped fails, walk the Cobalt instances
     if not result:
-        # Return 400 with detail so frontend displays the error message
+        result = await process_cobalt(url, deadline)
+    return result
+
+@register_platform("tiktok", {
+    "tiktok.com": [re.compile(r'^/(?:@[^/]+/video|v)/(\d+)')],
+    # Share links only carry a short code; tikwm resolves them
+    "vm.tiktok.com": [],
+    "vt.tiktok.com": [],
+})
+async def tiktok_chain(url: str, deadline: Deadline):
+    result = await process_tiktok_tikwm(url, deadline.split(2))
+    if not result:
+        result = await process_cobalt(url, deadline) # Fallback to Cobalt for TikTok
+    return result
+
+async def extract(url: str, deadline: Deadline):
+    """
+    Runs the provider fallback chain for a URL within the deadline,
+    returning None if every provider failed or time ran out. A first stage
+    with a fallback behind it gets half of the remaining budget, so the
+    fallback always has time left to run. Hosts without a registered
+    platform (Instagram, Twitter, etc.) go straight to Cobalt.
+    """
+    log_event("extract", url=url)
+    platform, _, _ = route(url)
+    chain = platform.chain if platform else process_cobalt
+    return await chain(url, deadline)
+
+def remember_media(key: str, result: dict, ttl: float):
+    if result.get("download_url"):
+        MEDIA_IDENTITIES.set(result["download_url"], key, ttl)
+    # Each format is its own media; "key#format" also lets a download
+    # find its way back to the info result to pick a sibling format
+    for fmt in result.get("formats") or ():
+        MEDIA_IDENTITIES.set(fmt["url"], f"{key}#{fmt['id']}", ttl)
+
+RESULTS = TieredCache(INFO_CACHE, shared_backend(), on_fill=remember_media)
+
+async def extract_and_cache(key: str, url: str, deadline: Deadline):
+    # Another worker may already have resolved it; resolve() has already
+    # missed in memory, so only the shared tier is asked
+    result = await RESULTS.get_shared(key)
+    if result is None:
+        result = await extract(url, deadline)
+        if result:
+            result = await RESULTS.get_or_set(key, result, result_ttl(result))
+    return result
+
+class RateLimiter:
+    """
+    Token buckets per client, kept GCRA-style as a single float per client:
+    the time at which its bucket will be full again. Buckets sit in an LRU
+    ordered by last use. Full buckets at its front are swept away a few per
+    call (a missing bucket is a full one), and past `max_clients` the least
+    recently used is dropped, so memory stays bounded however many distinct
+    addresses show up.
+    """
+
+    def __init__(self, name: str, rate: float, burst: float, max_clients: int):
+        self.name = name
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self.burst = max(burst, 1)
+        self.max_clients = max_clients
+        self._full_at = OrderedDict()
+        self.limited = 0
+        self.evicted = 0
+
+    def take(self, client: str, cost: float = 1) -> float:
+        """
+        Charges `cost` tokens and returns 0, or returns the seconds until a
+        token is available. Requests costing more than the balance are let
+        through while at least one token is left, putting the bucket in
+        debt, so large batches pay with later requests instead of never
+        fitting.
+        """
+        if not self.interval:
+            return 0.0
+        now = time.monotonic()
+        self._sweep(now)
+        full_at = max(self._full_at.pop(client, now), now)
+        wait = (full_at - now) - (self.burst - 1) * self.interval
+        if wait > 0:
+            self._full_at[client] = full_at
+            self.limited += 1
+            return wait
+        self._full_at[client] = full_at + cost * self.interval
+        if len(self._full_at) > self.max_clients:
+            self._full_at.popitem(last=False)
+            self.evicted += 1
+        return 0.0
+
+    def charge(self, client: str, cost: float = 1):
+        # Unconditional debt, for work already under way
+        if self.interval:
+            now = time.monotonic()
+            self._full_at[client] = max(self._full_at.pop(client, now), now) + cost * self.interval
+
+    def _sweep(self, now: float):
+        for _ in range(8):
+            if not self._full_at:
+                return
+            client, full_at = next(iter(self._full_at.items()))
+            if full_at > now:
+                return
+            del self._full_at[client]
+
+    def stats(self) -> dict:
+        return {"clients": len(self._full_at), "limited": self.limited, "evicted": self.evicted}
+
+INFO_LIMITER = RateLimiter("info", RATE_LIMIT_INFO_RATE, RATE_LIMIT_INFO_BURST, RATE_LIMIT_MAX_CLIENTS)
+DOWNLOAD_LIMITER = RateLimiter("download", RATE_LIMIT_DOWNLOAD_RATE, RATE_LIMIT_DOWNLOAD_BURST, RATE_LIMIT_MAX_CLIENTS)
+THUMBNAIL_LIMITER = RateLimiter("thumbnail", RATE_LIMIT_THUMBNAIL_RATE, RATE_LIMIT_THUMBNAIL_BURST, RATE_LIMIT_MAX_CLIENTS)
+
+METRICS.register("umii_rate_limited_total", "counter", "Requests refused by a rate limit.", ("budget",),
+                 collect=lambda: [((l.name,), l.limited) for l in (INFO_LIMITER, DOWNLOAD_LIMITER, THUMBNAIL_LIMITER)])
+METRICS.register("umii_rate_limit_clients", "gauge", "Clients with a tracked (not full) bucket.", ("budget",),
+                 collect=lambda: [((l.name,), len(l._full_at)) for l in (INFO_LIMITER, DOWNLOAD_LIMITER, THUMBNAIL_LIMITER)])
+
+def client_key(request: Request) -> str:
+    """
+    The identity a request is rate limited under. IPv6 clients are keyed by
+    their /64, which a single host can otherwise rotate through freely.
+    """
+    api_key = request.headers.get("X-API-Key")
+    if api_key and api_key in RATE_LIMIT_API_KEYS:
+        return f"key:{api_key}"
+    forwarded = request.headers.get("X-Forwarded-For", "") if TRUST_FORWARDED else ""
+    # Entries to the left of the last one come from the client and can't be trusted
+    address = forwarded.split(",")[-1].strip() or (request.client.host if request.client else "")
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return address
+    if ip.version == 6:
+        return str(ipaddress.ip_network(f"{ip}/64", strict=False))
+    return address
+
+def rate_limited(limiter: RateLimiter, request: Request, cost: float = 1):
+    """A 429 response if the client is over its budget, otherwise None."""
+    wait = limiter.take(client_key(request), cost)
+    if not wait:
+        return None
+    return JSONResponse(
+        status_code=429,
+        content={"detail": "Too many requests. Please wait a moment and try again."},
+        headers={"Retry-After": str(math.ceil(wait))}
+    )
+
+EXTRACTION_FAILED = "Extraction failed. The platform might be blocking requests or the link is private."
+EXTRACTION_TIMED_OUT = "Timed out while extracting. The platforms are responding slowly, please try again."
+
+async def resolve(url: str, budget: Deadline):
+    """
+    Resolves a URL through the cache, then a shared (coalesced) extraction.
+    Returns None if extraction failed or the budget ran out.
+    """
+    key = canonical_key(url)
+    result = INFO_CACHE.get(key)
+    if result is None:
+        try:
+            # The shared extraction runs on the server's own budget, not the
+            # first caller's, so a caller with a short deadline can't cut it
+            # short for the others; each caller waits only its own budget.
+            with span("extract", key):
+                result = await asyncio.wait_for(
+                    INFO_FLIGHTS.do(key, lambda: extract_and_cache(key, url, Deadline(INFO_MAX_DEADLINE))),
+                    timeout=budget.remaining()
+                )
+        except asyncio.TimeoutError:
+            result = None
+    return result
+
+def request_deadline(request: Request, deadline: float = None) -> Deadline:
+    """
+    Builds the request's deadline from the `deadline` parameter or the
+    X-Request-Deadline header (seconds), falling back to the server default.
+    """
+    seconds = deadline
+    if seconds is None:
+        try:
+            seconds = float(request.headers.get("X-Request-Deadline", ""))
+        except ValueError:
+            seconds = None
+    if seconds is None or seconds <= 0:
+        seconds = INFO_DEFAULT_DEADLINE
+    return Deadline(min(max(seconds, INFO_MIN_DEADLINE), INFO_MAX_DEADLINE))
+
+@app.get("/api/info")
+async def info(
+    request: Request,
+    url: str = Query(..., description="The URL to process"),
+    deadline: float = Query(None, description="Overall time budget in seconds"),
+    quality: int = Query(None, ge=1, description="Minimum resolution (lines) for download_url"),
+    max_bitrate: int = Query(None, ge=1, description="Bitrate cap in bits/s for download_url")
+):
+    if not url:
+        raise HTTPException(status_code=400, detail="URL is required")
+
+    limited = rate_limited(INFO_LIMITER, request)
+    if limited:
+        return limited
+
+    budget = request_deadline(request, deadline)
+    with DOWNLOAD_GATE.interactive():
+        result = await resolve(url, budget)
+
+    if not result and budget.expired():
+        return JSONResponse(status_code=504, content={"detail": EXTRACTION_TIMED_OUT})
+
+    if not result and extract_youtube_id(url) is None and extract_youtube_collection(url):
         return JSONResponse(status_code=400, content={
-            "detail": "Extraction failed. The platform might be blocking requests or the link is private."
+            "detail": "This is a playlist or channel link. Use /api/playlist to list its videos."
         })
-        
-    return result
+
+    if not result:
+        # Return 400 with detail so frontend displays the error message
+        return JSONResponse(status_code=400, content={"detail": EXTRACTION_FAILED})
+
+    return cacheable_json(request, with_target(result, quality, max_bitrate))
+
+class BatchRequest(BaseModel):
+    urls: List[str]
+    concurrency: Optional[int] = None
+
+async def stream_batch(urls: list, concurrency: int):
+    """
+    Resolves URLs with at most `concurrency` in flight and yields one NDJSON
+    line per URL as soon as it finishes, in completion order. Each line
+    carries the URL's index in the request so clients can match it up.
+    Every URL gets a full default budget from the moment it starts.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def resolve_one(index: int, url: str):
+        item = {"index": index, "url": url}
+        if not url or not url.strip():
+            return {**item, "ok": False, "error": "URL is required"}
+        async with semaphore:
+            budget = Deadline(INFO_DEFAULT_DEADLINE)
+            try:
+                result = await resolve(url, budget)
+            except Exception as e:
+                log_event("batch_item_error", logging.WARNING, index=index, error=str(e))
+                result = None
+        if result:
+            return {**item, "ok": True, "result": result}
+        return {**item, "ok": False, "error": EXTRACTION_TIMED_OUT if budget.expired() else EXTRACTION_FAILED}
+
+    tasks = [asyncio.create_task(resolve_one(i, url)) for i, url in enumerate(urls)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield json.dumps(await next_done) + "\n"
+    finally:
+        # Client went away: stop the work that has not finished yet
+        for task in tasks:
+            task.cancel()
+
+@app.post("/api/info/batch")
+async def info_batch(request: Request, body: BatchRequest):
+    if not body.urls:
+        raise HTTPException(status_code=400, detail="At least one URL is required")
+    if len(body.urls) > BATCH_MAX_URLS:
+        raise HTTPException(status_code=400, detail=f"A batch may contain at most {BATCH_MAX_URLS} URLs")
+
+    # Every URL is a lookup against the same budget as /api/info
+    limited = rate_limited(INFO_LIMITER, request, cost=len(body.urls))
+    if limited:
+        return limited
+
+    concurrency = min(max(body.concurrency or BATCH_DEFAULT_CONCURRENCY, 1), BATCH_MAX_CONCURRENCY)
+    return StreamingResponse(stream_batch(body.urls, concurrency), media_type="application/x-ndjson")
+
+async def fetch_piped_page(path: str, params: dict = None):
+    """
+    GETs a Piped API path from the healthiest instance that answers.
+    Pagination tokens are YouTube continuations, so any instance can serve
+    the next page if the previous one goes away mid-listing.
+    """
+    headers = {"User-Agent": BROWSER_UA}
+    for base_url in PIPED_POOL.ranked():
+        start = time.monotonic()
+        ok = False
+        try:
+            response = await get_client().get(f"{base_url}{path}", params=params, headers=headers, timeout=8)
+            data, ok = piped_answer(response)
+            if data is not None:
+                return data
+        except Exception as e:
+            log_event("provider_error", logging.WARNING, provider="piped", instance=base_url, path=path, error=str(e))
+        finally:
+            PIPED_POOL.record(base_url, ok, time.monotonic() - start)
+    return None
+
+async def iter_collection_pages(kind: str, ref: str):
+    """
+    Yields (page_data, entries) for a playlist or channel, one Piped page
+    at a time, following `nextpage` tokens until the listing ends.
+    """
+    if kind == "playlist":
+        data = await fetch_piped_page(f"/playlists/{ref}")
+        next_path = f"/nextpage/playlists/{ref}"
+    else:
+        data = await fetch_piped_page(f"/{ref}")
+        next_path = f"/nextpage/channel/{data.get('id')}" if data else None
+    if data is None:
+        raise HTTPException(status_code=502, detail="Could not load the playlist. It might be private or the instances are down.")
+
+    while True:
+        entries = []
+        for item in data.get("relatedStreams") or []:
+            if item.get("type", "stream") != "stream":
+                continue
+            video_id = extract_youtube_id(f"https://www.youtube.com{item.get('url', '')}")
+            if video_id:
+                entries.append({
+                    "id": video_id,
+                    "title": item.get("title") or "YouTube Video",
+                    "thumbnail": item.get("thumbnail"),
+                    "duration": item.get("duration"),
+                    "uploader": item.get("uploaderName"),
+                    "url": f"https://www.youtube.com/watch?v={video_id}",
+                })
+        yield data, entries
+
+        token = data.get("nextpage")
+        if not token:
+            return
+        data = await fetch_piped_page(next_path, params={"nextpage": token})
+        if data is None:
+            raise HTTPException(status_code=502, detail="Lost the playlist midway. Please try again.")
+
+async def stream_collection(kind: str, pages, first_page: tuple, resolve_streams: bool, concurrency: int, limit: int, charge=None):
+    """
+    Streams a playlist or channel as NDJSON: a header line, then one line per
+    video as pages arrive, then a closing line. With `resolve_streams` each
+    video is also resolved like /api/info, at most `concurrency` at a time,
+    and its line is written when its resolution finishes. The next page is
+    fetched while earlier entries are still resolving. `charge` is called
+    once per resolved entry.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def resolve_entry(entry: dict):
+        if charge:
+            charge()
+        async with semaphore:
+            budget = Deadline(INFO_DEFAULT_DEADLINE)
+            try:
+                result = await resolve(entry["url"], budget)
+            except Exception as e:
+                log_event("playlist_entry_error", logging.WARNING, id=entry["id"], error=str(e))
+                result = None
+        if result:
+            return {**entry, "result": result}
+        return {**entry, "error": EXTRACTION_TIMED_OUT if budget.expired() else EXTRACTION_FAILED}
+
+    count = 0
+    header_sent = False
+    pending = set()
+    page_task = asyncio.get_running_loop().create_future()
+    page_task.set_result(first_page)
+    try:
+        while page_task or pending:
+            done, _ = await asyncio.wait(pending | ({page_task} if page_task else set()), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task is not page_task:
+                    pending.discard(task)
+                    yield json.dumps({"type": "entry", **task.result()}) + "\n"
+                    continue
+
+                page_task = None
+                try:
+                    data, entries = task.result()
+                except StopAsyncIteration:
+                    continue
+                except HTTPException as e:
+                    yield json.dumps({"type": "error", "detail": e.detail}) + "\n"
+                    continue
+
+                # From the first page's metadata, even if it lists no videos
+                if not header_sent:
+                    header_sent = True
+                    yield json.dumps({
+                        "type": kind,
+                        "title": data.get("name"),
+                        "thumbnail": data.get("thumbnailUrl") or data.get("avatarUrl"),
+                        "uploader": data.get("uploader") or data.get("name"),
+                        "video_count": data.get("videos"),
+                    }) + "\n"
+                for entry in entries[:limit - count]:
+                    count += 1
+                    entry = {"index": count - 1, **entry}
+                    if resolve_streams:
+                        pending.add(asyncio.create_task(resolve_entry(entry)))
+                    else:
+                        yield json.dumps({"type": "entry", **entry}) + "\n"
+                if count < limit:
+                    page_task = asyncio.ensure_future(pages.__anext__())
+
+        yield json.dumps({"type": "end", "count": count}) + "\n"
+    finally:
+        if page_task:
+            page_task.cancel()
+        for task in pending:
+            task.cancel()
+
+@app.get("/api/playlist")
+async def playlist(
+    request: Request,
+    url: str = Query(..., description="A YouTube playlist or channel URL"),
+    resolve_streams: bool = Query(False, alias="resolve", description="Also resolve each video's download link"),
+    concurrency: int = Query(BATCH_DEFAULT_CONCURRENCY, ge=1, le=BATCH_MAX_CONCURRENCY),
+    limit: int = Query(PLAYLIST_MAX_ENTRIES, ge=1, le=PLAYLIST_MAX_ENTRIES)
+):
+    collection = extract_youtube_collection(url)
+    if not collection:
+        raise HTTPException(status_code=400, detail="Not a YouTube playlist or channel URL")
+    kind, ref = collection
+
+    limited = rate_limited(INFO_LIMITER, request)
+    if limited:
+        return limited
+    # Resolved entries are billed as they go, since the count isn't known yet
+    client = client_key(request)
+    charge = (lambda: INFO_LIMITER.charge(client)) if resolve_streams else None
+
+    # The first page is loaded before responding so a bad link still gets a
+    # proper error status; later pages stream as they arrive.
+    pages = iter_collection_pages(kind, ref)
+    first_page = await pages.__anext__()
+    return StreamingResponse(
+        stream_collection(kind, pages, first_page, resolve_streams, concurrency, limit, charge),
+        media_type="application/x-ndjson"
+    )
+
+@app.get("/api/stats")
+async def stats():
+    return {
+        "info_cache": INFO_CACHE.stats(),
+        "shared_cache": RESULTS.shared.stats() if RESULTS.shared else None,
+        "info_flights": INFO_FLIGHTS.stats(),
+        "instances": {"piped": PIPED_POOL.stats(), "cobalt": COBALT_POOL.stats()},
+        "media_cache": MEDIA_CACHE.stats() if MEDIA_CACHE else None,
+        "thumbnail_cache": _thumbnail_cache.stats() if _thumbnail_cache else None,
+        "jobs": JOBS.stats() if JOBS else None,
+        "downloads": DOWNLOAD_GATE.stats(),
+        "rate_limits": {l.name: l.stats() for l in (INFO_LIMITER, DOWNLOAD_LIMITER, THUMBNAIL_LIMITER)},
+    }
+
+def cache_samples(attr: str):
+    def collect():
+        caches = [("info", INFO_CACHE)] + ([("shared", RESULTS.shared)] if RESULTS.shared else [])
+        caches += [("media", MEDIA_CACHE)] if MEDIA_CACHE else []
+        caches += [("thumbnail", _thumbnail_cache)] if _thumbnail_cache else []
+        return [((name,), getattr(cache, attr)) for name, cache in caches]
+    return collect
+
+def hit_ratio_samples():
+    return [(labels, hits / (hits + misses) if hits + misses else 0.0)
+            for (labels, hits), (_, misses) in zip(cache_samples("hits")(), cache_samples("misses")())]
+
+def circuit_samples():
+    return [((pool.name, h.url), int(h.state != "closed"))
+            for pool in (PIPED_POOL, COBALT_POOL) for h in pool.instances.values()]
+
+METRICS.register("umii_cache_hits_total", "counter", "Cache lookups that hit.", ("cache",), collect=cache_samples("hits"))
+METRICS.register("umii_cache_misses_total", "counter", "Cache lookups that missed.", ("cache",), collect=cache_samples("misses"))
+METRICS.register("umii_cache_evictions_total", "counter", "Entries evicted to stay within the cache bound.", ("cache",), collect=cache_samples("evictions"))
+METRICS.register("umii_cache_hit_ratio", "gauge", "Hits over lookups since start.", ("cache",), collect=hit_ratio_samples)
+METRICS.register("umii_info_coalesced_total", "counter", "/api/info lookups that joined an extraction already in flight.", (), collect=lambda: [((), INFO_FLIGHTS.coalesced)])
+METRICS.register("umii_instance_circuit_open", "gauge", "1 while an instance's circuit breaker is open or half-open.", ("pool", "instance"), collect=circuit_samples)
+
+@app.get("/api/metrics")
+async def metrics():
+    # Bytes proxied per second is rate(umii_proxied_bytes_total[1m])
+    return Response(METRICS.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+async def metered(body, started: float, ticket=None):
+    """
+    Counts a download body's bytes, time to first byte and in-flight time,
+    and gives back its admission ticket as soon as the body ends.
+    """
+    METRICS.inc("umii_downloads_in_flight")
+    try:
+        first = True
+        async for chunk in body:
+            if first:
+                METRICS.observe("umii_download_ttfb_seconds", (), time.monotonic() - started)
+                first = False
+            METRICS.inc("umii_proxied_bytes_total", (), len(chunk))
+            yield chunk
+    finally:
+        METRICS.inc("umii_downloads_in_flight", (), -1)
+        if ticket:
+            ticket.release()
+        # Let the wrapped body run its own cleanup now rather than at GC
+        await body.aclose()
+
+async def stream_upstream(response: httpx.Response):
+    """
+    Relays an upstream body to the client with bounded memory.
+    The generator only reads from the upstream once the previous chunk has
+    been handed to the server, so a slow client throttles the upstream read
+    instead of piling bytes up in memory. Network reads that reach the
+    adaptive chunk size are passed through as they are; smaller ones are
+    held back and joined, so the server is not woken for every few KB.
+    """
+    pending = []
+    filled = 0
+    chunk_size = STREAM_MIN_CHUNK
+    last_flush = time.monotonic()
+
+    async for data in response.aiter_raw():
+        if not data:
+            continue
+        pending.append(data)
+        filled += len(data)
+        if filled < chunk_size:
+            continue
+
+        yield pending[0] if len(pending) == 1 else b"".join(pending)
+        # Time since the last flush covers both the upstream read and the
+        # client write, so it tracks whichever side is the bottleneck.
+        now = time.monotonic()
+        rate = filled / max(now - last_flush, 1e-3)
+        chunk_size = int(min(max(rate * STREAM_TARGET_INTERVAL, STREAM_MIN_CHUNK), STREAM_MAX_CHUNK))
+        last_flush = now
+        pending = []
+        filled = 0
+
+    if pending:
+        yield b"".join(pending)
+
+# Upstream headers relayed on downloads. Validators are included so the
+# browser can send them back in If-Range when it resumes.
+PASSTHROUGH_HEADERS = ["Content-Length", "Content-Range", "Accept-Ranges", "ETag", "Last-Modified", "Content-Encoding"]
+
+def if_range_matches(if_range: str, upstream_headers) -> bool:
+    """
+    Evaluates an If-Range validator against the upstream representation
+    (RFC 9110 13.1.5): an entity tag must match strongly, a date must equal
+    Last-Modified exactly.
+    """
+    if_range = if_range.strip()
+    if if_range.startswith('"'):
+        etag = upstream_headers.get("ETag", "")
+        return etag == if_range
+    if if_range.startswith("W/"):
+        return False
+    return upstream_headers.get("Last-Modified") == if_range
+
+async def open_upstream(url: str, headers: dict):
+    client = get_client("media")
+    r = await client.send(client.build_request("GET", url, headers=headers), stream=True)
+    # 416 is a valid answer to a Range request, not a failure
+    if r.is_error and r.status_code != 416:
+        await r.aclose()
+        r.raise_for_status()
+    return r
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class DiskLRU:
+    """
+    Content-addressed file cache under a byte budget.
+    Entries are named by the SHA-256 of their key and written to a temp file
+    first; only a complete file is renamed into place and indexed, so a
+    partially written entry can never be served. Recency is kept in file
+    mtimes (touched on every hit) and mirrored in memory; the least recently
+    used entries are deleted once the budget is exceeded.
+
+    Several processes on one host may share the directory. Each writes its
+    temp files under tmp/<pid>, and only the temp directories of processes
+    that are gone are cleared. Entries written by others are picked up on
+    lookup, and a store rebuilds the index from the directory once
+    RESCAN_INTERVAL seconds have passed since the last rebuild, so the
+    budget holds for the directory as a whole (overshooting by at most what
+    the other processes store in between).
+
+    commit() is a coroutine: the rename, the rescan and the unlinks run in a
+    worker thread, while the index itself is only changed on the event loop.
+    """
+
+    RESCAN_INTERVAL = 60
+
+    def __init__(self, root: str, budget: int, suffix: str = ""):
+        self.root = root
+        self.budget = budget
+        self.suffix = suffix
+        self.tmp = os.path.join(root, "tmp", str(os.getpid()))
+        os.makedirs(self.tmp, exist_ok=True)
+        self._remove_stale_temp()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Evicted but maybe not unlinked yet; lookups treat them as gone
+        self._removing = set()
+        self._load(self._scan())
+        self._remove(self._evict())
+
+    def _remove_stale_temp(self):
+        parent = os.path.dirname(self.tmp)
+        for name in os.listdir(parent):
+            if name.isdigit() and pid_alive(int(name)):
+                continue
+            path = os.path.join(parent, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.unlink(path)
+
+    def _scan(self) -> list:
+        # (mtime, name, size) of every entry, least recently used first
+        entries = []
+        for entry in os.scandir(self.root):
+            try:
+                if entry.is_file():
+                    st = entry.stat()
+                    entries.append((st.st_mtime, entry.name, st.st_size))
+            except FileNotFoundError:
+                # Evicted by another process mid-scan
+                pass
+        return sorted(entries)
+
+    def _load(self, entries: list):
+        self._index = OrderedDict((name, size) for _, name, size in entries if name not in self._removing)
+        self.size = sum(self._index.values())
+        self._scanned_at = time.monotonic()
+
+    def name(self, key: str) -> str:
+        return hashlib.sha256(key.encode()).hexdigest() + self.suffix
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, self.name(key))
+
+    def get(self, key: str):
+        """Returns the path of a complete entry, or None."""
+        name = self.name(key)
+        path = os.path.join(self.root, name)
+        if name in self._removing:
+            self.misses += 1
+            return None
+        if name not in self._index:
+            # Another process sharing the directory may have stored it
+            try:
+                self._index[name] = os.path.getsize(path)
+            except FileNotFoundError:
+                self.misses += 1
+                return None
+            self.size += self._index[name]
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self.size -= self._index.pop(name)
+            self.misses += 1
+            return None
+        self._index.move_to_end(name)
+        self.hits += 1
+        return path
+
+    def open_temp(self):
+        path = os.path.join(self.tmp, secrets.token_hex(8))
+        return path, open(path, "wb")
+
+    def _install(self, temp_path: str, name: str) -> int:
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, os.path.join(self.root, name))
+        return size
+
+    async def commit(self, key: str, temp_path: str):
+        name = self.name(key)
+        size = await asyncio.to_thread(self._install, temp_path, name)
+        self._removing.discard(name)
+        self.size += size - self._index.pop(name, 0)
+        self._index[name] = size
+        if time.monotonic() - self._scanned_at > self.RESCAN_INTERVAL:
+            # Claimed before the scan so concurrent commits don't start another
+            self._scanned_at = time.monotonic()
+            self._load(await asyncio.to_thread(self._scan))
+        victims = self._evict()
+        if victims:
+            self._removing.update(victims)
+            try:
+                await asyncio.to_thread(self._remove, victims)
+            finally:
+                self._removing.difference_update(victims)
+
+    def _evict(self) -> list:
+        # Drops entries from the index down to the budget; the caller unlinks them
+        victims = []
+        while self.size > self.budget and self._index:
+            name, size = self._index.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            victims.append(name)
+        return victims
+
+    def _remove(self, names: list):
+        for name in names:
+            try:
+                os.unlink(os.path.join(self.root, name))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._index),
+            "bytes": self.size,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+MEDIA_CACHE = DiskLRU(MEDIA_CACHE_DIR, MEDIA_CACHE_BYTES, ".media") if MEDIA_CACHE_DIR else None
+
+async def tee_to_cache(cache: DiskLRU, key: str, chunks, expected: int):
+    """
+    Passes a body through while writing it to a cache temp file, and files
+    it under `key` only if exactly `expected` bytes arrived. Disk writes run
+    in a worker thread so they never block the event loop.
+    """
+    temp_path, f = cache.open_temp()
+    written = 0
+    try:
+        async for chunk in chunks:
+            await asyncio.to_thread(f.write, chunk)
+            written += len(chunk)
+            yield chunk
+        await asyncio.to_thread(f.close)
+        if written == expected:
+            await cache.commit(key, temp_path)
+    finally:
+        f.close()
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+
+class CachedFileResponse(Response):
+    """
+    Serves a cached file with Range and If-Range support.
+    On servers offering the ASGI zero-copy extension the body goes out with
+    sendfile; otherwise it is read in chunks from a worker thread.
+    """
+
+    def __init__(self, path: str, request: Request, media_type: str, headers: dict):
+        st = os.stat(path)
+        self.path = path
+        self.size = st.st_size
+        self.start, self.end = 0, self.size - 1
+        validators = {
+            "ETag": f'"{os.path.basename(path)[:32]}-{self.size}"',
+            "Last-Modified": formatdate(st.st_mtime, usegmt=True),
+        }
+        status = 200
+        range_header = request.headers.get("Range")
+        if_range = request.headers.get("If-Range")
+        if range_header and (not if_range or if_range_matches(if_range, validators)):
+            span = parse_byte_range(range_header, self.size)
+            if span is None:
+                status = 416
+            elif span:
+                status = 206
+                self.start, self.end = span
+        super().__init__(status_code=status, media_type=media_type, headers={**headers, **validators, "Accept-Ranges": "bytes"})
+        if status == 416:
+            self.headers["Content-Range"] = f"bytes */{self.size}"
+            self.headers["Content-Length"] = "0"
+        else:
+            if status == 206:
+                self.headers["Content-Range"] = f"bytes {self.start}-{self.end}/{self.size}"
+            self.headers["Content-Length"] = str(self.end - self.start + 1)
+
+    async def send_file(self, scope, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        count = self.end - self.start + 1 if self.status_code != 416 else 0
+        with open(self.path, "rb") as f:
+            if count and "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send({"type": "http.response.zerocopysend", "file": f.fileno(), "offset": self.start, "count": count})
+                return
+            f.seek(self.start)
+            while count > 0:
+                chunk = await asyncio.to_thread(f.read, min(STREAM_MAX_CHUNK, count))
+                if not chunk:
+                    break
+                count -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        # Always a final message, so empty files and short reads end the response too
+        await send({"type": "http.response.body", "body": b""})
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await self.send_file(scope, send)
+        finally:
+            if self.background is not None:
+                await self.background()
+
+def parse_byte_range(range_header: str, size: int):
+    """
+    Parses a single "bytes=" range against a file size. Returns (start, end),
+    None when unsatisfiable, or () for shapes we don't serve (multiple
+    ranges), which are answered with the full file.
+    """
+    match = re.match(r'^bytes=(\d*)-(\d*)$', range_header.strip())
+    if not match or not (match.group(1) or match.group(2)):
+        return ()
+    if match.group(1):
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    else:
+        start, end = max(size - int(match.group(2)), 0), size - 1
+    if start >= size or start > end:
+        return None
+    return start, end
+
+RANGE_SPEC = re.compile(r'^bytes=(\d+)-(\d*)$')
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+async def read_piece(r: httpx.Response, expected: int) -> bytes:
+    buffer = bytearray()
+    async for data in r.aiter_raw():
+        buffer += data
+    if len(buffer) != expected:
+        raise ValueError(f"short piece: got {len(buffer)} of {expected} bytes")
+    return bytes(buffer)
+
+async def stream_segments(url: str, headers: dict, first: httpx.Response, start: int, end: int, connections: int):
+    """
+    Streams bytes start..end of a URL fetched as SEGMENT_SIZE pieces over
+    `connections` parallel range requests, reassembled in order. `first` is
+    the already open response for the first piece.
+    Workers only start pieces within a window of 2 * connections past the
+    next piece to send, so a slow client stalls the fetch instead of
+    growing the reorder buffer.
+    """
+    count = (end - start) // SEGMENT_SIZE + 1
+    window = 2 * connections
+    ready = {}
+    state = {"next": 1, "sent": 0, "error": None}
+    changed = asyncio.Condition()
+
+    piece_headers = dict(headers)
+    etag = first.headers.get("ETag", "")
+    if etag and not etag.startswith("W/"):
+        # A changed file answers 200 instead of 206, which fails the piece
+        piece_headers["If-Range"] = etag
+
+    def bounds(index: int):
+        lo = start + index * SEGMENT_SIZE
+        return lo, min(lo + SEGMENT_SIZE - 1, end)
+
+    async def fetch(index: int) -> bytes:
+        lo, hi = bounds(index)
+        for attempt in range(SEGMENT_RETRIES + 1):
+            try:
+                client = get_client("media")
+                request = client.build_request("GET", url, headers={**piece_headers, "Range": f"bytes={lo}-{hi}"})
+                r = await client.send(request, stream=True)
+                try:
+                    if r.status_code != 206:
+                        raise ValueError(f"piece {index} answered {r.status_code}")
+                    return await read_piece(r, hi - lo + 1)
+                finally:
+                    await r.aclose()
+            except Exception as e:
+                if attempt == SEGMENT_RETRIES:
+                    raise
+                log_event("segment_retry", logging.WARNING, index=index, attempt=attempt + 1, error=str(e))
+
+    async def worker():
+        try:
+            while True:
+                async with changed:
+                    while state["next"] < count and state["next"] >= state["sent"] + window:
+                        await changed.wait()
+                    if state["next"] >= count:
+                        return
+                    index = state["next"]
+                    state["next"] += 1
+                data = await fetch(index)
+                async with changed:
+                    ready[index] = data
+                    changed.notify_all()
+        except Exception as e:
+            async with changed:
+                state["error"] = state["error"] or e
+                changed.notify_all()
+
+    async def first_piece():
+        try:
+            lo, hi = bounds(0)
+            data = await read_piece(first, hi - lo + 1)
+        except Exception as e:
+            data = None
+            state["error"] = state["error"] or e
+        finally:
+            await first.aclose()
+        async with changed:
+            if data is not None:
+                ready[0] = data
+            changed.notify_all()
+
+    tasks = [asyncio.create_task(first_piece())]
+    tasks += [asyncio.create_task(worker()) for _ in range(min(connections, count - 1))]
+    try:
+        while state["sent"] < count:
+            async with changed:
+                while state["sent"] not in ready:
+                    if state["error"]:
+                        raise state["error"]
+                    await changed.wait()
+                data = ready.pop(state["sent"])
+                state["sent"] += 1
+                changed.notify_all()
+            yield data
+    finally:
+        for task in tasks:
+            task.cancel()
+
+class BoxReader:
+    """
+    Reads ISO BMFF boxes off a streamed upstream body. A background task
+    prefetches up to MUX_PREFETCH_BYTES so both inputs of a mux keep
+    downloading while the other one is being sent.
+    """
+
+    def __init__(self, response: httpx.Response):
+        self.queue = asyncio.Queue(max(1, MUX_PREFETCH_BYTES // STREAM_MIN_CHUNK))
+        self.buffer = bytearray()
+        self.done = False
+        self.task = asyncio.create_task(self._fill(response))
+
+    async def _fill(self, response: httpx.Response):
+        try:
+            async for chunk in response.aiter_bytes(STREAM_MIN_CHUNK):
+                await self.queue.put(chunk)
+            await self.queue.put(None)
+        except Exception as e:
+            await self.queue.put(e)
+
+    async def _more(self) -> bool:
+        if self.done:
+            return False
+        chunk = await self.queue.get()
+        if isinstance(chunk, Exception):
+            raise chunk
+        if chunk is None:
+            self.done = True
+            return False
+        self.buffer += chunk
+        return True
+
+    async def read(self, n: int) -> bytes:
+        while len(self.buffer) < n:
+            if not await self._more():
+                raise ValueError("stream ended inside a box")
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    async def chunks(self, n: int):
+        """Yields the next n bytes (all that is left if n is None) as they arrive."""
+        while n is None or n > 0:
+            if not self.buffer and not await self._more():
+                if n is None:
+                    return
+                raise ValueError("stream ended inside a box")
+            take = len(self.buffer) if n is None else min(n, len(self.buffer))
+            data = bytes(self.buffer[:take])
+            del self.buffer[:take]
+            if n is not None:
+                n -= take
+            yield data
+
+    async def box(self):
+        """
+        Reads the next box header. Returns (type, header bytes, payload
+        size), with a payload size of None for a box running to the end of
+        the stream, or None at the end of the stream.
+        """
+        while len(self.buffer) < 8:
+            if not await self._more():
+                if self.buffer:
+                    raise ValueError("stream ended inside a box header")
+                return None
+        size, kind = struct.unpack_from(">I4s", self.buffer)
+        header = await self.read(16 if size == 1 else 8)
+        if size == 1:
+            size = struct.unpack_from(">Q", header, 8)[0]
+        return kind.decode("latin-1"), header, None if size == 0 else size - len(header)
+
+    async def skip(self, n: int):
+        async for _ in self.chunks(n):
+            pass
+
+    def close(self):
+        self.task.cancel()
+
+def mp4_boxes(data, start: int, end: int):
+    while start + 8 <= end:
+        size, kind = struct.unpack_from(">I4s", data, start)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", data, start + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - start
+        yield kind.decode("latin-1"), start, header, size
+        start += size
+
+def mp4_find(data, path: list, start: int = 0, end: int = None):
+    """Returns (payload start, box end) of the first box along `path`, or None."""
+    for kind, offset, header, size in mp4_boxes(data, start, len(data) if end is None else end):
+        if kind == path[0]:
+            if len(path) == 1:
+                return offset + header, offset + size
+            return mp4_find(data, path[1:], offset + header, offset + size)
+    return None
+
+def mp4_get(data, path: list) -> bytearray:
+    # Whole box, header included, along `path`
+    parent = mp4_find(data, path[:-1]) if len(path) > 1 else (0, len(data))
+    for kind, offset, header, size in mp4_boxes(data, *(parent or (0, 0))):
+        if kind == path[-1]:
+            return bytearray(data[offset:offset + size])
+    raise ValueError(f"missing {'/'.join(path)} box")
+
+def mp4_field(data, path: list, v0: int, v1: int, start: int = 0, end: int = None):
+    # Offset of a field in a full box, given its offset after version/flags
+    # in version 0 and version 1 layouts
+    found = mp4_find(data, path, start, end)
+    if not found:
+        return None, 0
+    version = data[found[0]]
+    return found[0] + 4 + (v1 if version == 1 else v0), version
+
+def mp4_box(kind: str, payload: bytes) -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), kind.encode()) + payload
+
+class MuxInput:
+    """One fragmented MP4 input of a mux: its reader, track and timescale."""
+
+    def __init__(self, reader: BoxReader, track_id: int):
+        self.reader = reader
+        self.track_id = track_id
+        self.ftyp = b""
+        self.moov = None
+        self.timescale = 1
+        self.fragment = None
+
+    async def read_init(self):
+        while self.moov is None:
+            box = await self.reader.box()
+            if box is None or box[2] is None:
+                raise ValueError("no moov box before the media data")
+            kind, header, size = box
+            if kind == "ftyp":
+                self.ftyp = header + await self.reader.read(size)
+            elif kind == "moov":
+                self.moov = bytearray(header + await self.reader.read(size))
+            else:
+                await self.reader.skip(size)
+        if not mp4_find(self.moov, ["moov", "mvex"]):
+            raise ValueError("input is not a fragmented MP4")
+        offset, version = mp4_field(self.moov, ["moov", "trak", "mdia", "mdhd"], 8, 16)
+        self.timescale = struct.unpack_from(">I", self.moov, offset)[0]
+
+    def movie_timescale(self) -> int:
+        offset, _ = mp4_field(self.moov, ["moov", "mvhd"], 8, 16)
+        return struct.unpack_from(">I", self.moov, offset)[0]
+
+    def trak(self, movie_timescale: int) -> bytearray:
+        """This input's track, renumbered and with durations in the output movie timescale."""
+        trak = mp4_get(self.moov, ["moov", "trak"])
+        scale = movie_timescale / self.movie_timescale()
+        offset, version = mp4_field(trak, ["trak", "tkhd"], 8, 16)
+        struct.pack_into(">I", trak, offset, self.track_id)
+        duration = offset + 8
+        fmt = ">Q" if version == 1 else ">I"
+        struct.pack_into(fmt, trak, duration, int(struct.unpack_from(fmt, trak, duration)[0] * scale))
+        found = mp4_find(trak, ["trak", "edts", "elst"])
+        if found:
+            version = trak[found[0]]
+            fmt = ">Q" if version == 1 else ">I"
+            entry = found[0] + 8
+            for _ in range(struct.unpack_from(">I", trak, found[0] + 4)[0]):
+                struct.pack_into(fmt, trak, entry, int(struct.unpack_from(fmt, trak, entry)[0] * scale))
+                entry += 20 if version == 1 else 12
+        return trak
+
+    def trex(self) -> bytearray:
+        trex = mp4_get(self.moov, ["moov", "mvex", "trex"])
+        struct.pack_into(">I", trex, 12, self.track_id)
+        return trex
+
+    async def next_fragment(self):
+        """
+        Reads up to the next moof and its mdat header, leaving the mdat
+        payload on the stream. Returns (decode time in seconds, moof, mdat
+        header, mdat payload size) or None at the end.
+        """
+        moof = None
+        while True:
+            box = await self.reader.box()
+            if box is None:
+                return None
+            kind, header, size = box
+            if kind == "moof" and size is not None:
+                moof = bytearray(header + await self.reader.read(size))
+            elif kind == "mdat" and moof is not None:
+                break
+            elif size is None:
+                return None
+            else:
+                await self.reader.skip(size)
+
+        offset, version = mp4_field(moof, ["moof", "traf", "tfdt"], 0, 0)
+        decode_time = 0
+        if offset is not None:
+            decode_time = struct.unpack_from(">Q" if version == 1 else ">I", moof, offset)[0]
+        found = mp4_find(moof, ["moof", "traf", "tfhd"])
+        if int.from_bytes(moof[found[0] + 1:found[0] + 4], "big") & 0x1:
+            # An absolute base offset points into the original file
+            raise ValueError("track fragment uses an explicit base data offset")
+        struct.pack_into(">I", moof, found[0] + 4, self.track_id)
+        return decode_time / self.timescale, moof, header, size
+
+def merged_init(video: MuxInput, audio: MuxInput) -> bytes:
+    # One movie with the video track as 1 and the audio track as 2, and
+    # both tracks' fragment defaults
+    timescale = video.movie_timescale()
+    mvhd = mp4_get(video.moov, ["moov", "mvhd"])
+    struct.pack_into(">I", mvhd, len(mvhd) - 4, 3)  # next_track_ID
+    moov = mp4_box("moov", bytes(mvhd) + video.trak(timescale) + audio.trak(timescale) + mp4_box("mvex", bytes(video.trex() + audio.trex())))
+    return video.ftyp + moov
+
+async def stream_mux(video: MuxInput, audio: MuxInput):
+    """
+    Interleaves the fragments of two fragmented MP4 inputs into one
+    fragmented MP4, earliest decode time first. Fragment boxes are passed
+    through with their track and sequence numbers rewritten; media data is
+    relayed as it arrives, so memory stays at a fragment header plus the
+    prefetch buffers whatever the video length.
+    """
+    try:
+        yield merged_init(video, audio)
+        sequence = 0
+        video.fragment = await video.next_fragment()
+        audio.fragment = await audio.next_fragment()
+        while video.fragment or audio.fragment:
+            if not audio.fragment or (video.fragment and video.fragment[0] <= audio.fragment[0]):
+                source = video
+            else:
+                source = audio
+            _, moof, mdat_header, size = source.fragment
+            sequence += 1
+            offset, _ = mp4_field(moof, ["moof", "mfhd"], 0, 0)
+            struct.pack_into(">I", moof, offset, sequence)
+            yield bytes(moof) + mdat_header
+            async for chunk in source.reader.chunks(size):
+                yield chunk
+            source.fragment = await source.next_fragment()
+    finally:
+        video.reader.close()
+        audio.reader.close()
+
+def mux_formats(formats: list, quality: int = None, max_bitrate: int = None):
+    """
+    The video-only MP4 stream for the target (see pick_format) and the best
+    MP4 audio stream, or None if the video has no such pair.
+    """
+    video = pick_format([f for f in formats if f["ext"] == "mp4"], quality, max_bitrate, video_only=True)
+    audio = [f for f in formats if f["audio_only"] and f["ext"] == "m4a"]
+    if not video or not audio:
+        return None
+    return video, max(audio, key=lambda f: f["bitrate"] or 0)
+
+async def open_mux(video_url: str, audio_url: str, headers: dict) -> StreamingResponse:
+    """
+    Opens both streams concurrently and reads their init segments before
+    answering, so unusable inputs fail with a 502 instead of a broken file.
+    """
+    responses = await asyncio.gather(open_upstream(video_url, headers), open_upstream(audio_url, headers), return_exceptions=True)
+    opened = [r for r in responses if isinstance(r, httpx.Response)]
+
+    async def close():
+        for r in opened:
+            await r.aclose()
+
+    inputs = []
+    try:
+        for r in responses:
+            if not isinstance(r, httpx.Response):
+                raise r
+            if r.status_code != 200:
+                raise ValueError(f"upstream answered {r.status_code}")
+        inputs = [MuxInput(BoxReader(r), track_id) for track_id, r in enumerate(responses, 1)]
+        await asyncio.gather(*(i.read_init() for i in inputs))
+    except Exception as e:
+        for i in inputs:
+            i.reader.close()
+        await close()
+        log_event("mux_error", logging.WARNING, error=str(e))
+        raise HTTPException(status_code=502, detail="Could not combine the video and audio streams.")
+    return StreamingResponse(stream_mux(*inputs), media_type="video/mp4", background=BackgroundTask(close))
+
+class Overloaded(Exception):
+    pass
+
+class AdmissionTicket:
+    __slots__ = ("gate", "need", "released")
+
+    def __init__(self, gate: "AdmissionGate", need: int):
+        self.gate = gate
+        self.need = need
+        self.released = False
+
+    def release(self):
+        # Called from every path that can end a stream; only the first counts
+        if not self.released:
+            self.released = True
+            self.gate.release(self.need)
+
+class AdmissionGate:
+    """
+    Admits downloads while both the stream count and the reserved buffer
+    bytes are within their limits. Others wait first-come first-served in
+    a bounded queue; when it is full or the wait times out, Overloaded is
+    raised. Interactive requests register with `interactive()`, and no new
+    download is admitted while more than INFO_PRIORITY_THRESHOLD of them
+    are in flight.
+    """
+
+    def __init__(self, max_streams: int, max_bytes: int, max_queue: int, wait: float):
+        self.max_streams = max_streams
+        self.max_bytes = max_bytes
+        self.max_queue = max_queue
+        self.wait = wait
+        self.active = 0
+        self.reserved = 0
+        self.interactive_requests = 0
+        self.waiters = deque()
+        self.admitted = 0
+        self.shed = 0
+
+    def _fits(self, need: int) -> bool:
+        return (self.active < self.max_streams
+                and self.reserved + need <= self.max_bytes
+                and self.interactive_requests <= INFO_PRIORITY_THRESHOLD)
+
+    def _take(self, need: int) -> AdmissionTicket:
+        self.active += 1
+        self.reserved += need
+        self.admitted += 1
+        return AdmissionTicket(self, need)
+
+    async def acquire(self, need: int) -> AdmissionTicket:
+        # A single stream bigger than the whole budget can still run alone
+        need = min(need, self.max_bytes)
+        if not self.waiters and self._fits(need):
+            return self._take(need)
+        if len(self.waiters) >= self.max_queue:
+            self.shed += 1
+            raise Overloaded()
+        future = asyncio.get_running_loop().create_future()
+        entry = (need, future)
+        self.waiters.append(entry)
+        try:
+            return await asyncio.wait_for(future, self.wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # Admitted just as the wait ended: hand the slot back
+                future.result().release()
+            if entry in self.waiters:
+                self.waiters.remove(entry)
+            self._grant()
+            if isinstance(e, asyncio.TimeoutError):
+                self.shed += 1
+                raise Overloaded()
+            raise
+
+    def release(self, need: int):
+        self.active -= 1
+        self.reserved -= need
+        self._grant()
+
+    def _grant(self):
+        while self.waiters:
+            need, future = self.waiters[0]
+            if future.done():
+                self.waiters.popleft()
+                continue
+            if not self._fits(need):
+                break
+            self.waiters.popleft()
+            future.set_result(self._take(need))
+
+    @contextmanager
+    def interactive(self):
+        self.interactive_requests += 1
+        try:
+            yield
+        finally:
+            self.interactive_requests -= 1
+            self._grant()
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "reserved_bytes": self.reserved,
+            "queued": len(self.waiters),
+            "interactive": self.interactive_requests,
+            "admitted": self.admitted,
+            "shed": self.shed,
+        }
+
+DOWNLOAD_GATE = AdmissionGate(DOWNLOAD_MAX_STREAMS, DOWNLOAD_MAX_BUFFER_BYTES, DOWNLOAD_QUEUE_SIZE, DOWNLOAD_QUEUE_WAIT)
+
+METRICS.register("umii_download_active", "gauge", "Admitted download streams.", collect=lambda: [((), DOWNLOAD_GATE.active)])
+METRICS.register("umii_download_reserved_bytes", "gauge", "Buffer bytes reserved by admitted downloads.", collect=lambda: [((), DOWNLOAD_GATE.reserved)])
+METRICS.register("umii_download_queued", "gauge", "Downloads waiting for admission.", collect=lambda: [((), len(DOWNLOAD_GATE.waiters))])
+METRICS.register("umii_download_shed_total", "counter", "Downloads turned away with a 503.", collect=lambda: [((), DOWNLOAD_GATE.shed)])
+
+def download_buffer_need(segments: int, mux: bool) -> int:
+    # The most a download holds in memory: the mux read-ahead for both
+    # inputs, the segment reorder window, or one relay chunk
+    if mux:
+        return 2 * MUX_PREFETCH_BYTES + STREAM_MAX_CHUNK
+    if segments > 1:
+        return (2 * segments + 1) * SEGMENT_SIZE
+    return STREAM_MAX_CHUNK
 
 @app.get("/api/download")
 async def download(
+    request: Request,
     url: str = Query(..., description="Direct video URL"), 
     title: str = Query("video"),
-    ext: str = Query("mp4")
+    ext: str = Query("mp4"),
+    segments: int = Query(1, ge=1, le=DOWNLOAD_MAX_SEGMENTS, description="Parallel connections for the transfer"),
+    quality: int = Query(None, ge=1, description="Minimum resolution (lines); the cheapest stream meeting it is sent"),
+    max_bitrate: int = Query(None, ge=1, description="Bitrate cap in bits/s"),
+    mux: bool = Query(False, description="Combine separate video and audio streams (higher resolutions)")
 ):
+    started = time.monotonic()
+    limited = rate_limited(DOWNLOAD_LIMITER, request)
+    if limited:
+        return limited
+
     try:
-        # Some CDNs reject requests without a User-Agent
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
-            'Referer': 'https://www.youtube.com/'
-        }
-        
-        # Increase timeout for large files
-        r = requests.get(url, stream=True, headers=headers, timeout=30)
-        r.raise_for_status()
-        
-        clean_title = re.sub(r'[^\w\-_\. ]', '_', title)[:100]
-        safe_filename = urllib.parse.quote(f"{clean_title}.{ext}")
-        
-        return StreamingResponse(
-            r.iter_content(chunk_size=1024*1024),
-            media_type=r.headers.get("Content-Type", "video/mp4"),
-            headers={
-                "Content-Disposition": f"attachment; filename*=UTF-8''{safe_filename}"
-            }
+        ticket = await DOWNLOAD_GATE.acquire(download_buffer_need(segments, mux))
+    except Overloaded:
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "The server is busy with other downloads. Please try again shortly."},
+            headers={"Retry-After": str(DOWNLOAD_RETRY_AFTER)}
         )
-    except Exception as e:
-        print(f"Download Proxy Error: {e}")
-        raise HTTPException(status_code=500, detail="Failed to proxy download. Source link might have expired.")from fastapi import FastAPI, HTTPException, Query
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
-import requests
-import urllib.parse
-import random
-import re
-import json
 
-app = FastAPI()
+    try:
+        response = await proxy_download(request, url, title, ext, segments, quality, max_bitrate, mux, ticket, started)
+    except BaseException:
+        ticket.release()
+        raise
+    # Streams release their ticket when the body ends; this covers the rest
+    # (and bodies that never start because the client went away)
+    background = response.background
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+    async def finish():
+        try:
+            if background is not None:
+                await background()
+        finally:
+            ticket.release()
 
-def extract_youtube_id(url: str):
+    response.background = BackgroundTask(finish)
+    return response
+
+def choose_download(url: str, ext: str, quality: int, max_bitrate: int, mux: bool):
     """
-    Extracts the YouTube Video ID from various URL formats.
+    Applies a quality target to a download link. Returns (url, ext,
+    identity, pair): the link to fetch and its canonical identity, or a
+    (video, audio) format pair to mux, in which case ext is "mp4".
     """
-    url = url.strip()
-    patterns = [
-        r'(?:v=|\/)([0-9A-Za-z_-]{11}).*',
-        r'(?:v=|\/)([0-9A-Za-z_-]{11})',
-        r'youtu\.be\/([0-9A-Za-z_-]{11})',
-        r'shorts\/([0-9A-Za-z_-]{11})',
-        r'^([0-9A-Za-z_-]{11})$'
-    ]
-    for pattern in patterns:
-        match = re.search(pattern, url)
-        if match:
-            return match.group(1)
-    return None
+    # Links we issued map to a canonical video, which keys the media cache
+    # and lets a quality target pick another format of the same video
+    identity = MEDIA_IDENTITIES.get(url)
+    result = INFO_CACHE.peek(identity.partition("#")[0]) if identity and (quality or max_bitrate or mux) else None
+    pair = mux_formats(result.get("formats") or [], quality, max_bitrate) if result and mux else None
+    if pair:
+        return url, "mp4", identity, pair
+    if result:
+        chosen = pick_format(result.get("formats") or [], quality, max_bitrate)
+        if chosen:
+            url, ext = chosen["url"], chosen["ext"]
+            identity = MEDIA_IDENTITIES.get(url)
+    return url, ext, identity, None
 
-def process_tiktok_tikwm(url: str):
-    try:
-        api_url = "https://www.tikwm.com/api/"
-        response = requests.post(api_url, data={'url': url, 'hd': 1}, timeout=5)
-        data = response.json()
-        if data.get("code") == 0:
-            res = data["data"]
-            return {
-                "id": res.get("id"),
-                "title": res.get("title") or "TikTok Video",
-                "thumbnail": res.get("cover"),
-                "duration": res.get("duration"),
-                "platform": "TikTok",
-                "download_url": res.get("play"),
-                "ext": "mp4"
-            }
-    except Exception as e:
-        print(f"TikTok Error: {e}")
-    return None
+def attachment(title: str, ext: str) -> dict:
+    clean_title = re.sub(r'[^\w\-_\. ]', '_', title)[:100]
+    safe_filename = urllib.parse.quote(f"{clean_title}.{ext}")
+    return {"Content-Disposition": f"attachment; filename*=UTF-8''{safe_filename}"}
 
-def process_youtube_piped(url: str):
-    video_id = extract_youtube_id(url)
-    if not video_id: 
-        return None
-    
-    # Prioritize faster/less blocked instances
-    instances = [
-        "https://pipedapi.kavin.rocks",
-        "https://api.piped.kotnn.me",
-        "https://piped-api.lunar.icu",
-        "https://pipedapi.drgns.space",
-        "https://api.piped.privacy.com.de"
-    ]
-    
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36"
-    }
+def download_media_type(ext: str) -> str:
+    return f"video/{ext}" if ext != "mp3" else "audio/mpeg"
 
-    for base_url in instances:
-        try:
-            print(f"Trying Piped Instance: {base_url}")
-            # Reduced timeout to 2.5s to fail fast and try next
-            api_endpoint = f"{base_url}/streams/{video_id}"
-            response = requests.get(api_endpoint, headers=headers, timeout=2.5)
-            
-            if response.status_code == 200:
-                data = response.json()
-                if "error" in data: continue
-
-                streams = data.get("videoStreams", [])
-                # Prefer mp4, non-videoOnly
-                best_stream = next((s for s in streams if s.get("format") == "MPEG-4" and not s.get("videoOnly")), None)
-                
-                if not best_stream and streams:
-                    best_stream = streams[0]
-                    
-                if best_stream:
-                    return {
-                        "id": video_id,
-                        "title": data.get("title") or "YouTube Video",
-                        "thumbnail": data.get("thumbnailUrl"),
-                        "duration": data.get("duration"),
-                        "platform": "YouTube",
-                        "download_url": best_stream.get("url"),
-                        "ext": "mp4"
-                    }
-        except Exception as e:
-            print(f"Instance {base_url} failed: {str(e)}")
-            continue
-            
-    return None
+async def proxy_download(request: Request, url: str, title: str, ext: str, segments: int,
+                         quality: int, max_bitrate: int, mux: bool, ticket: AdmissionTicket, started: float):
+    # `started` is when the request arrived, so time to first byte includes
+    # any wait for admission
+    range_header = request.headers.get("Range")
+    if_range = request.headers.get("If-Range")
 
-def process_cobalt(url: str, backup=False):
-    # Primary and Backup Cobalt instances
-    api_url = "https://co.wuk.sh/api/json" if backup else "https://api.cobalt.tools/api/json"
-    
-    headers = {
-        "Accept": "application/json", 
-        "Content-Type": "application/json",
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36"
-    }
-    
-    payload = {
-        "url": url, 
-        "vCodec": "h264", 
-        "vQuality": "720",
-        "filenamePattern": "basic",
-        "isAudioOnly": False
-    }
-    
-    try:
-        print(f"Trying Cobalt ({'Backup' if backup else 'Primary'})...")
-        response = requests.post(api_url, json=payload, headers=headers, timeout=8)
-        data = response.json()
-        
-        # Cobalt success check
-        if data.get("status") in ["stream", "redirect"] or "url" in data:
-            return {
-                "id": f"dl-{random.randint(1000, 9999)}",
-                "title": data.get("text") or data.get("filename") or "Downloaded Video",
-                "thumbnail": "https://images.unsplash.com/photo-1611162617213-7d7a39e9b1d7?auto=format&fit=crop&w=300",
-                "duration": None,
-                "platform": "Social Media",
-                "download_url": data.get("url"),
-                "ext": "mp4"
-            }
-    except Exception as e:
-        print(f"Cobalt {'Backup' if backup else 'Primary'} Error: {e}")
-        
-    return None
+    # Segmented mode needs a single "bytes=a-" or "bytes=a-b" range (or none);
+    # other shapes are passed through on one connection.
+    wanted = RANGE_SPEC.match(range_header) if range_header else None
+    segmented = segments > 1 and (range_header is None or wanted is not None)
+    start = int(wanted.group(1)) if wanted else 0
+    end = int(wanted.group(2)) if wanted and wanted.group(2) else None
 
-@app.get("/api/info")
-async def info(url: str = Query(..., description="The URL to process")):
-    if not url:
-        raise HTTPException(status_code=400, detail="URL is required")
-    
-    print(f"Processing URL: {url}")
-    result = None
-    
-    # 1. TikTok Logic
-    if "tiktok.com" in url:
-        result = process_tiktok_tikwm(url)
-        if not result:
-            result = process_cobalt(url) # Fallback to Cobalt for TikTok
-    
-    # 2. YouTube Logic
-    elif "youtube.com" in url or "youtu.be" in url:
-        # Try Piped first
-        result = process_youtube_piped(url)
-        # If Piped fails, try Cobalt Primary
-        if not result:
-            result = process_cobalt(url, backup=False)
-        # If Cobalt Primary fails, try Cobalt Backup
-        if not result:
-            result = process_cobalt(url, backup=True)
-    
-    # 3. General Fallback (Instagram, Twitter, etc.)
-    else:
-        result = process_cobalt(url, backup=False)
-        if not result:
-            result = process_cobalt(url, backup=True)
+    url, ext, identity, pair = choose_download(url, ext, quality, max_bitrate, mux)
+    disposition = attachment(title, ext)
 
-    if not result:
-        # Return 400 with detail so frontend displays the error message
-        return JSONResponse(status_code=400, content={
-            "detail": "Extraction failed. The platform might be blocking requests or the link is private."
-        })
-        
-    return result
+    if pair:
+        # Piped's high resolutions are video-only; they are muxed with the
+        # audio on the fly. Links without such a pair download as usual.
+        response = await open_mux(pair[0]["url"], pair[1]["url"], {'User-Agent': BROWSER_UA, 'Referer': 'https://www.youtube.com/'})
+        response.headers.update(disposition)
+        response.body_iterator = metered(response.body_iterator, started, ticket)
+        return response
+
+    if not MEDIA_CACHE:
+        identity = None
+    media_key = f"{identity}:{ext}" if identity else None
+    if media_key:
+        cached = MEDIA_CACHE.get(media_key)
+        if cached:
+            return CachedFileResponse(cached, request, download_media_type(ext), disposition)
+
+    def first_piece_range():
+        last = start + SEGMENT_SIZE - 1
+        return f"bytes={start}-{min(last, end) if end is not None else last}"
 
-@app.get("/api/download")
-async def download(
-    url: str = Query(..., description="Direct video URL"), 
-    title: str = Query("video"),
-    ext: str = Query("mp4")
-):
     try:
         # Some CDNs reject requests without a User-Agent
         headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
+            'User-Agent': BROWSER_UA,
             'Referer': 'https://www.youtube.com/'
         }
-        
-        # Increase timeout for large files
-        r = requests.get(url, stream=True, headers=headers, timeout=30)
-        r.raise_for_status()
-        
-        clean_title = re.sub(r'[^\w\-_\. ]', '_', title)[:100]
-        safe_filename = urllib.parse.quote(f"{clean_title}.{ext}")
-        
+        if range_header:
+            headers["Range"] = range_header
+        if segmented:
+            # The first piece doubles as the probe for size and range support
+            headers["Range"] = first_piece_range()
+
+        r = await open_upstream(url, headers)
+
+        # CDNs commonly ignore If-Range, so it is evaluated here: if the
+        # client's copy is stale, a partial body would corrupt it and the
+        # full representation must be sent instead.
+        if r.status_code in (206, 416) and if_range and not if_range_matches(if_range, r.headers):
+            await r.aclose()
+            range_header = None
+            start, end = 0, None
+            if segmented:
+                headers["Range"] = first_piece_range()
+            else:
+                del headers["Range"]
+            r = await open_upstream(url, headers)
+    except Exception as e:
+        log_event("download_error", logging.WARNING, error=str(e))
+        raise HTTPException(status_code=500, detail="Failed to proxy download. Source link might have expired.")
+
+    response_headers = dict(disposition)
+    # Bytes are relayed undecoded, so lengths, ranges and the encoding all
+    # describe exactly what we send.
+    for name in PASSTHROUGH_HEADERS:
+        if name in r.headers:
+            response_headers[name] = r.headers[name]
+
+    if r.status_code == 416:
+        await r.aclose()
+        return Response(status_code=416, headers={"Content-Range": r.headers.get("Content-Range", "bytes */*")})
+
+    content_range = CONTENT_RANGE.match(r.headers.get("Content-Range", ""))
+    if segmented and r.status_code == 206 and not (content_range and "Content-Encoding" not in r.headers):
+        # The probe's partial answer can't be reassembled; fetch what the
+        # client actually asked for on a single connection instead.
+        await r.aclose()
+        segmented = False
+        if range_header:
+            headers["Range"] = range_header
+        else:
+            del headers["Range"]
+        try:
+            r = await open_upstream(url, headers)
+        except Exception as e:
+            log_event("download_error", logging.WARNING, error=str(e))
+            raise HTTPException(status_code=500, detail="Failed to proxy download. Source link might have expired.")
+        response_headers = dict(disposition)
+        for name in PASSTHROUGH_HEADERS:
+            if name in r.headers:
+                response_headers[name] = r.headers[name]
+
+    if segmented and r.status_code == 206:
+        total = int(content_range.group(3))
+        end = min(end if end is not None else total - 1, total - 1)
+        response_headers["Content-Length"] = str(end - start + 1)
+        response_headers["Accept-Ranges"] = "bytes"
+        if range_header:
+            response_headers["Content-Range"] = f"bytes {start}-{end}/{total}"
+        else:
+            response_headers.pop("Content-Range", None)
+        body = stream_segments(url, headers, r, start, end, segments)
+        if media_key and not range_header:
+            body = tee_to_cache(MEDIA_CACHE, media_key, body, total)
         return StreamingResponse(
-            r.iter_content(chunk_size=1024*1024),
+            metered(body, started, ticket),
+            status_code=206 if range_header else 200,
             media_type=r.headers.get("Content-Type", "video/mp4"),
-            headers={
-                "Content-Disposition": f"attachment; filename*=UTF-8''{safe_filename}"
-            }
+            headers=response_headers,
+            background=BackgroundTask(r.aclose)
         )
-    except Exception as e:
-        print(f"Download Proxy Error: {e}")
-        raise HTTPException(status_code=500, detail="Failed to proxy download. Source link might have expired.")from fastapi import FastAPI, HTTPException, Query
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
-import requests
-import urllib.parse
-import random
-import re
-import json
 
-app = FastAPI()
+    # Upstreams without range support answer the probe with the full body,
+    # which is simply passed through.
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+    body = stream_upstream(r)
+    length = r.headers.get("Content-Length", "")
+    if media_key and r.status_code == 200 and length.isdigit() and "Content-Encoding" not in r.headers:
+        # Fill the cache as the bytes pass through to the client
+        body = tee_to_cache(MEDIA_CACHE, media_key, body, int(length))
 
-def extract_youtube_id(url: str):
-    """
-    Extracts the YouTube Video ID from various URL formats.
-    """
-    url = url.strip()
-    patterns = [
-        r'(?:v=|\/)([0-9A-Za-z_-]{11}).*',
-        r'(?:v=|\/)([0-9A-Za-z_-]{11})',
-        r'youtu\.be\/([0-9A-Za-z_-]{11})',
-        r'shorts\/([0-9A-Za-z_-]{11})',
-        r'^([0-9A-Za-z_-]{11})$'
-    ]
-    for pattern in patterns:
-        match = re.search(pattern, url)
-        if match:
-            return match.group(1)
-    return None
+    return StreamingResponse(
+        metered(body, started, ticket),
+        status_code=r.status_code,
+        media_type=r.headers.get("Content-Type", "video/mp4"),
+        headers=response_headers,
+        # Runs after the body is sent or the client disconnects
+        background=BackgroundTask(r.aclose)
+    )
 
-def process_tiktok_tikwm(url: str):
-    try:
-        api_url = "https://www.tikwm.com/api/"
-        response = requests.post(api_url, data={'url': url, 'hd': 1}, timeout=5)
-        data = response.json()
-        if data.get("code") == 0:
-            res = data["data"]
-            return {
-                "id": res.get("id"),
-                "title": res.get("title") or "TikTok Video",
-                "thumbnail": res.get("cover"),
-                "duration": res.get("duration"),
-                "platform": "TikTok",
-                "download_url": res.get("play"),
-                "ext": "mp4"
-            }
-    except Exception as e:
-        print(f"TikTok Error: {e}")
+THUMBNAIL_FLIGHTS = SingleFlight()
+THUMBNAIL_FAILED = "Could not load the thumbnail."
+
+# Leading bytes -> media type, for serving originals as what they are
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF8", "image/gif"),
+    (b"RIFF", "image/webp"),
+]
+
+def image_type(data: bytes) -> Optional[str]:
+    for signature, media_type in IMAGE_SIGNATURES:
+        if data.startswith(signature) and (media_type != "image/webp" or data[8:12] == b"WEBP"):
+            return media_type
     return None
 
-def process_youtube_piped(url: str):
-    video_id = extract_youtube_id(url)
-    if not video_id: 
+_thumbnail_pool = None
+_thumbnail_cache = None
+_thumbnail_cache_opened = False
+
+def thumbnail_cache() -> Optional[DiskLRU]:
+    # Opened on the first request rather than at import, so cold starts
+    # skip the directory scan; a directory that can't be used only costs
+    # the caching
+    global _thumbnail_cache, _thumbnail_cache_opened
+    if not _thumbnail_cache_opened:
+        _thumbnail_cache_opened = True
+        if THUMBNAIL_CACHE_DIR:
+            try:
+                _thumbnail_cache = DiskLRU(THUMBNAIL_CACHE_DIR, THUMBNAIL_CACHE_BYTES, ".img")
+            except OSError as e:
+                log_event("thumbnail_cache_unavailable", logging.WARNING, error=str(e))
+    return _thumbnail_cache
+
+def thumbnail_pool() -> ThreadPoolExecutor:
+    # Built on first use. Pillow releases the GIL while it decodes, resizes
+    # and encodes, so the workers really run in parallel.
+    global _thumbnail_pool
+    if _thumbnail_pool is None:
+        _thumbnail_pool = ThreadPoolExecutor(THUMBNAIL_WORKERS, thread_name_prefix="thumbnail")
+    return _thumbnail_pool
+
+@lru_cache(maxsize=None)
+def webp_supported() -> bool:
+    from PIL import features
+    return bool(features.check("webp"))
+
+def render_thumbnail(data: bytes, width: int, fmt: str, quality: int) -> bytes:
+    """Scales an image down to `width` (never up) and encodes it. Runs on the thumbnail pool."""
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as source:
+        # JPEGs can decode straight at 1/2, 1/4 or 1/8 scale, still at least `width` wide
+        source.draft("RGB", (width, 1))
+        # Nothing is decoded until here, and draft() has already shrunk the size
+        if source.width * source.height > THUMBNAIL_MAX_PIXELS:
+            raise ValueError(f"image too large ({source.width}x{source.height})")
+        image = ImageOps.exif_transpose(source)
+        if image.width > width:
+            image.thumbnail((width, image.height), Image.LANCZOS, reducing_gap=3.0)
+        if fmt == "jpeg" and image.mode != "RGB":
+            image = image.convert("RGB")
+        elif image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info or "A" in image.getbands() else "RGB")
+        out = io.BytesIO()
+        if fmt == "webp":
+            image.save(out, "WEBP", quality=quality, method=4)
+        else:
+            image.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+        return out.getvalue()
+
+async def fetch_image(url: str) -> bytes:
+    async with get_client().stream(
+        "GET", url, headers={"User-Agent": BROWSER_UA}, timeout=10, extensions=http_phases("thumbnail")
+    ) as response:
+        if response.status_code != 200:
+            raise ValueError(f"upstream answered {response.status_code}")
+        chunks = []
+        size = 0
+        async for chunk in response.aiter_bytes():
+            size += len(chunk)
+            if size > THUMBNAIL_MAX_SOURCE_BYTES:
+                raise ValueError("image too large")
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+def write_temp(cache: DiskLRU, body: bytes) -> str:
+    temp_path, f = cache.open_temp()
+    with f:
+        f.write(body)
+    return temp_path
+
+def read_entry(path: str) -> Optional[bytes]:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        # Evicted since the lookup
         return None
-    
-    # Prioritize faster/less blocked instances
-    instances = [
-        "https://pipedapi.kavin.rocks",
-        "https://api.piped.kotnn.me",
-        "https://piped-api.lunar.icu",
-        "https://pipedapi.drgns.space",
-        "https://api.piped.privacy.com.de"
-    ]
-    
+
+async def build_thumbnail(key: str, url: str, width: int, fmt: str, quality: int) -> bytes:
+    with span("thumbnail.fetch"):
+        data = await fetch_image(url)
+    if fmt == "original":
+        if image_type(data) is None:
+            raise ValueError("not an image")
+        body = data
+    else:
+        with span("thumbnail.render", f"{width}px {fmt}"):
+            body = await asyncio.get_running_loop().run_in_executor(
+                thumbnail_pool(), render_thumbnail, data, width, fmt, quality
+            )
+    cache = thumbnail_cache()
+    if cache:
+        await cache.commit(key, await asyncio.to_thread(write_temp, cache, body))
+    return body
+
+@app.get("/api/thumbnail")
+async def thumbnail(
+    request: Request,
+    url: str = Query(..., description="Source image URL"),
+    width: int = Query(480, ge=1, description="Width in pixels, rounded up to a supported size"),
+    fmt: str = Query("auto", alias="format", pattern="^(auto|webp|jpeg)$",
+                     description="Output format; auto picks WebP when the browser accepts it"),
+    quality: str = Query("medium", pattern="^(low|medium|high)$")
+):
+    if not url.startswith(("http://", "https://")):
+        raise HTTPException(status_code=400, detail="A http(s) image URL is required")
+
+    limited = rate_limited(THUMBNAIL_LIMITER, request)
+    if limited:
+        return limited
+
+    width = next((w for w in THUMBNAIL_WIDTHS if w >= width), THUMBNAIL_WIDTHS[-1])
+    vary = fmt == "auto"
+    if not PILLOW_AVAILABLE:
+        fmt = "original"
+    elif fmt == "auto":
+        fmt = "webp" if "image/webp" in request.headers.get("Accept", "") else "jpeg"
+    if fmt == "webp" and not webp_supported():
+        fmt = "jpeg"
+
+    # Every parameter is in the key, so a key always names the same bytes:
+    # the ETag can be answered before any work, and browsers and the edge may
+    # keep the response for good.
+    key = f"{url}|{width}|{fmt}|{quality}"
     headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36"
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "ETag": '"' + hashlib.sha256(key.encode()).hexdigest()[:32] + '"',
     }
+    if vary:
+        headers["Vary"] = "Accept"
+    if etag_matches(request.headers.get("If-None-Match", ""), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
 
-    for base_url in instances:
+    body = None
+    cache = thumbnail_cache()
+    path = cache.get(key) if cache else None
+    if path:
+        body = await asyncio.to_thread(read_entry, path)
+    if body is None:
         try:
-            print(f"Trying Piped Instance: {base_url}")
-            # Reduced timeout to 2.5s to fail fast and try next
-            api_endpoint = f"{base_url}/streams/{video_id}"
-            response = requests.get(api_endpoint, headers=headers, timeout=2.5)
-            
-            if response.status_code == 200:
-                data = response.json()
-                if "error" in data: continue
-
-                streams = data.get("videoStreams", [])
-                # Prefer mp4, non-videoOnly
-                best_stream = next((s for s in streams if s.get("format") == "MPEG-4" and not s.get("videoOnly")), None)
-                
-                if not best_stream and streams:
-                    best_stream = streams[0]
-                    
-                if best_stream:
-                    return {
-                        "id": video_id,
-                        "title": data.get("title") or "YouTube Video",
-                        "thumbnail": data.get("thumbnailUrl"),
-                        "duration": data.get("duration"),
-                        "platform": "YouTube",
-                        "download_url": best_stream.get("url"),
-                        "ext": "mp4"
-                    }
+            body = await THUMBNAIL_FLIGHTS.do(
+                key, lambda: build_thumbnail(key, url, width, fmt, THUMBNAIL_QUALITY[quality])
+            )
         except Exception as e:
-            print(f"Instance {base_url} failed: {str(e)}")
-            continue
-            
-    return None
+            log_event("thumbnail_failed", logging.WARNING, url=url, error=str(e))
+            return JSONResponse(status_code=502, content={"detail": THUMBNAIL_FAILED})
 
-def process_cobalt(url: str, backup=False):
-    # Primary and Backup Cobalt instances
-    api_url = "https://co.wuk.sh/api/json" if backup else "https://api.cobalt.tools/api/json"
-    
-    headers = {
-        "Accept": "application/json", 
-        "Content-Type": "application/json",
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36"
-    }
-    
-    payload = {
-        "url": url, 
-        "vCodec": "h264", 
-        "vQuality": "720",
-        "filenamePattern": "basic",
-        "isAudioOnly": False
-    }
-    
-    try:
-        print(f"Trying Cobalt ({'Backup' if backup else 'Primary'})...")
-        response = requests.post(api_url, json=payload, headers=headers, timeout=8)
-        data = response.json()
-        
-        # Cobalt success check
-        if data.get("status") in ["stream", "redirect"] or "url" in data:
-            return {
-                "id": f"dl-{random.randint(1000, 9999)}",
-                "title": data.get("text") or data.get("filename") or "Downloaded Video",
-                "thumbnail": "https://images.unsplash.com/photo-1611162617213-7d7a39e9b1d7?auto=format&fit=crop&w=300",
-                "duration": None,
-                "platform": "Social Media",
-                "download_url": data.get("url"),
-                "ext": "mp4"
-            }
-    except Exception as e:
-        print(f"Cobalt {'Backup' if backup else 'Primary'} Error: {e}")
-        
-    return None
+    media_type = image_type(body) if fmt == "original" else f"image/{fmt}"
+    return Response(content=body, media_type=media_type, headers=headers)
 
-@app.get("/api/info")
-async def info(url: str = Query(..., description="The URL to process")):
-    if not url:
-        raise HTTPException(status_code=400, detail="URL is required")
-    
-    print(f"Processing URL: {url}")
-    result = None
-    
-    # 1. TikTok Logic
-    if "tiktok.com" in url:
-        result = process_tiktok_tikwm(url)
-        if not result:
-            result = process_cobalt(url) # Fallback to Cobalt for TikTok
-    
-    # 2. YouTube Logic
-    elif "youtube.com" in url or "youtu.be" in url:
-        # Try Piped first
-        result = process_youtube_piped(url)
-        # If Piped fails, try Cobalt Primary
-        if not result:
-            result = process_cobalt(url, backup=False)
-        # If Cobalt Primary fails, try Cobalt Backup
-        if not result:
-            result = process_cobalt(url, backup=True)
-    
-    # 3. General Fallback (Instagram, Twitter, etc.)
-    else:
-        result = process_cobalt(url, backup=False)
-        if not result:
-            result = process_cobalt(url, backup=True)
+class Job:
+    """One background download. Everything but the running task is journaled."""
+    __slots__ = ("id", "sources", "title", "ext", "status", "attempts", "bytes", "total",
+                 "validator", "error", "created", "updated", "task")
+    JOURNALED = __slots__[:-1]
 
-    if not result:
-        # Return 400 with detail so frontend displays the error message
-        return JSONResponse(status_code=400, content={
-            "detail": "Extraction failed. The platform might be blocking requests or the link is private."
-        })
-        
-    return result
+    def __init__(self, id: str, sources: list, title: str, ext: str):
+        self.id = id
+        # One URL, or a video and an audio URL to mux
+        self.sources = sources
+        self.title = title
+        self.ext = ext
+        self.status = "queued"
+        self.attempts = 0
+        self.bytes = 0
+        self.total = None
+        # Strong ETag or Last-Modified of the upstream file, checked on resume
+        self.validator = None
+        self.error = None
+        self.created = self.updated = time.time()
+        self.task = None
 
-@app.get("/api/download")
-async def download(
-    url: str = Query(..., description="Direct video URL"), 
-    title: str = Query("video"),
-    ext: str = Query("mp4")
-):
-    try:
-        # Some CDNs reject requests without a User-Agent
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
-            'Referer': 'https://www.youtube.com/'
+    @classmethod
+    def from_record(cls, record: dict) -> "Job":
+        job = cls(record["id"], record["sources"], record["title"], record["ext"])
+        for name in cls.JOURNALED:
+            if name in record:
+                setattr(job, name, record[name])
+        return job
+
+    def record(self) -> dict:
+        return {name: getattr(self, name) for name in self.JOURNALED}
+
+    def view(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "title": self.title,
+            "ext": self.ext,
+            "bytes": self.bytes,
+            "total": self.total,
+            "progress": round(self.bytes / self.total, 4) if self.total else None,
+            "attempts": self.attempts,
+            "error": self.error,
+            "created": self.created,
+            "updated": self.updated,
+            "file": f"/api/jobs/{self.id}/file" if self.status == "done" else None,
         }
-        
-        # Increase timeout for large files
-        r = requests.get(url, stream=True, headers=headers, timeout=30)
-        r.raise_for_status()
-        
-        clean_title = re.sub(r'[^\w\-_\. ]', '_', title)[:100]
-        safe_filename = urllib.parse.quote(f"{clean_title}.{ext}")
-        
-        return StreamingResponse(
-            r.iter_content(chunk_size=1024*1024),
-            media_type=r.headers.get("Content-Type", "video/mp4"),
-            headers={
-                "Content-Disposition": f"attachment; filename*=UTF-8''{safe_filename}"
-            }
+
+class JobQueue:
+    """
+    Background downloads into a directory, for self-hosted deployments.
+    Jobs wait in a FIFO queue for one of `workers` workers. A failed
+    transfer is retried with exponential backoff, resuming from its partial
+    file with a Range request when the upstream file is unchanged; client
+    errors other than 429 (an expired link, say) fail at once. Every state
+    change is appended to journal.jsonl, which is replayed and compacted at
+    startup: queued and interrupted jobs run again, finished ones stay
+    downloadable until they expire.
+
+    Jobs live in this process's memory, so a directory belongs to a single
+    process: an exclusive lock on journal.lock is taken before the replay,
+    and a second process pointed at the same directory fails to start
+    rather than replaying and compacting the journal under the first.
+    """
+
+    def __init__(self, root: str, workers: int, queue_size: int, retries: int, retry_delay: float, ttl: float):
+        self.files = os.path.join(root, "files")
+        self.journal_path = os.path.join(root, "journal.jsonl")
+        self.workers = workers
+        self.queue_size = queue_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.ttl = ttl
+        self.jobs = {}
+        self._queue = None
+        self._loop = None
+        self._tasks = set()
+        os.makedirs(self.files, exist_ok=True)
+        self._lock = self._acquire(os.path.join(root, "journal.lock"))
+        self._replay()
+        self._journal = open(self.journal_path, "a")
+
+    @staticmethod
+    def _acquire(path: str):
+        # Imported here so the API still loads on hosts without it when jobs are off
+        import fcntl
+        # Held open for the life of the process; the kernel drops the lock on exit
+        f = open(path, "a+")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.seek(0)
+            owner = f.read().strip()
+            f.close()
+            owner = f"pid {owner}" if owner else "another process"
+            raise RuntimeError(f"JOBS_DIR {os.path.dirname(path)} is in use by {owner}; "
+                               "background jobs need a single worker process per directory") from None
+        f.truncate(0)
+        f.write(str(os.getpid()))
+        f.flush()
+        return f
+
+    def _replay(self):
+        records = {}
+        try:
+            with open(self.journal_path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn last line from a crash
+                        continue
+                    records[record["id"]] = record
+        except FileNotFoundError:
+            pass
+        for record in records.values():
+            if record["status"] == "deleted":
+                continue
+            job = Job.from_record(record)
+            if job.status == "running":
+                # Interrupted; it picks up from its partial file
+                job.status = "queued"
+            self.jobs[job.id] = job
+        temp_path = self.journal_path + ".tmp"
+        with open(temp_path, "w") as f:
+            for job in self.jobs.values():
+                f.write(json.dumps(job.record()) + "\n")
+        os.replace(temp_path, self.journal_path)
+        for name in os.listdir(self.files):
+            if name.partition(".")[0] not in self.jobs:
+                os.unlink(os.path.join(self.files, name))
+
+    def _write(self, job: Job):
+        job.updated = time.time()
+        self._journal.write(json.dumps(job.record()) + "\n")
+        self._journal.flush()
+
+    def path(self, job: Job, partial: bool = False) -> str:
+        return os.path.join(self.files, job.id + (".part" if partial else ""))
+
+    def start(self):
+        """Starts the workers on the running loop, oldest queued jobs first."""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        for job in sorted(self.jobs.values(), key=lambda j: j.created):
+            if job.status == "queued":
+                self._queue.put_nowait(job)
+        for _ in range(self.workers):
+            self._spawn(self._worker())
+        self._spawn(self._expire())
+
+    def _spawn(self, coro):
+        # Keep a reference so background tasks are not garbage collected
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def submit(self, sources: list, title: str, ext: str) -> Job:
+        self.start()
+        if self._queue.qsize() >= self.queue_size:
+            raise Overloaded()
+        job = Job(secrets.token_urlsafe(12), sources, title, ext)
+        self.jobs[job.id] = job
+        self._write(job)
+        self._queue.put_nowait(job)
+        return job
+
+    def delete(self, job: Job):
+        if job.task:
+            job.task.cancel()
+        job.status = "deleted"
+        self.jobs.pop(job.id, None)
+        for path in (self.path(job), self.path(job, partial=True)):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        self._write(job)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            # Deleted while it waited
+            if job.status != "queued":
+                continue
+            job.task = asyncio.create_task(self._run(job))
+            # wait() rather than await, so a cancelled job doesn't stop the worker
+            await asyncio.wait([job.task])
+            job.task = None
+
+    async def _run(self, job: Job):
+        job.status = "running"
+        self._write(job)
+        while True:
+            job.attempts += 1
+            try:
+                await self._fetch(job)
+            except Exception as e:
+                status = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else None
+                if job.attempts <= self.retries and not (status and status < 500 and status != 429):
+                    log_event("job_retry", logging.WARNING, job=job.id, attempt=job.attempts, error=str(e))
+                    self._write(job)
+                    await asyncio.sleep(self.retry_delay * 2 ** (job.attempts - 1) * random.uniform(0.5, 1.5))
+                    continue
+                job.status, job.error = "failed", str(e) or type(e).__name__
+                log_event("job_failed", logging.WARNING, job=job.id, attempts=job.attempts, error=job.error)
+            else:
+                os.replace(self.path(job, partial=True), self.path(job))
+                job.status, job.error = "done", None
+                log_event("job_done", job=job.id, bytes=job.bytes, attempts=job.attempts)
+            self._write(job)
+            return
+
+    async def _fetch(self, job: Job):
+        partial = self.path(job, partial=True)
+        headers = {'User-Agent': BROWSER_UA, 'Referer': 'https://www.youtube.com/'}
+        if len(job.sources) == 2:
+            # Muxed output is produced on the fly, so every attempt starts over
+            response = await open_mux(*job.sources, headers)
+            try:
+                await self._write_body(job, partial, response.body_iterator, 0)
+            finally:
+                await response.background()
+            return
+
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+        r = await open_upstream(job.sources[0], headers)
+        if offset and r.status_code == 416 and job.total and offset >= job.total:
+            # The partial file was already complete
+            await r.aclose()
+            job.bytes = offset
+            return
+        # Resume only onto the same file; CDNs commonly ignore If-Range, so
+        # the validator is compared here
+        resumed = r.status_code == 206 and (job.validator is None or if_range_matches(job.validator, r.headers))
+        if offset and not resumed:
+            await r.aclose()
+            offset = 0
+            del headers["Range"]
+            r = await open_upstream(job.sources[0], headers)
+        try:
+            etag = r.headers.get("ETag", "")
+            job.validator = etag if etag.startswith('"') else r.headers.get("Last-Modified")
+            match = CONTENT_RANGE.match(r.headers.get("Content-Range", ""))
+            length = r.headers.get("Content-Length", "")
+            if match:
+                job.total = int(match.group(3))
+            elif r.status_code == 200 and length.isdigit() and "Content-Encoding" not in r.headers:
+                job.total = int(length)
+            await self._write_body(job, partial, r.aiter_raw(), offset if r.status_code == 206 else 0)
+        finally:
+            await r.aclose()
+
+    async def _write_body(self, job: Job, path: str, chunks, offset: int):
+        f = open(path, "r+b" if offset else "wb")
+        job.bytes = offset
+        try:
+            f.seek(offset)
+            f.truncate()
+            async for chunk in chunks:
+                await asyncio.to_thread(f.write, chunk)
+                job.bytes += len(chunk)
+        finally:
+            await asyncio.to_thread(f.close)
+        if job.total and job.bytes != job.total:
+            raise ValueError(f"transfer ended at {job.bytes} of {job.total} bytes")
+
+    async def _expire(self):
+        while True:
+            await asyncio.sleep(min(self.ttl, 60))
+            cutoff = time.time() - self.ttl
+            for job in [j for j in self.jobs.values() if j.status in ("done", "failed") and j.updated < cutoff]:
+                self.delete(job)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "jobs": dict(Counter(job.status for job in self.jobs.values())),
+        }
+
+JOBS = JobQueue(JOBS_DIR, JOB_WORKERS, JOB_QUEUE_SIZE, JOB_RETRIES, JOB_RETRY_DELAY, JOB_TTL) if JOBS_DIR else None
+JOBS_DISABLED = "Background jobs are not enabled on this server."
+
+METRICS.register("umii_jobs", "gauge", "Background download jobs by status.", ("status",),
+                 collect=lambda: [((status,), n) for status, n in JOBS.stats()["jobs"].items()] if JOBS else [])
+
+@app.on_event("startup")
+async def start_jobs():
+    # Jobs left queued or running by the previous process resume right away
+    if JOBS:
+        JOBS.start()
+
+def find_job(job_id: str) -> Job:
+    if not JOBS:
+        raise HTTPException(status_code=404, detail=JOBS_DISABLED)
+    job = JOBS.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="No such job; finished jobs expire after a while.")
+    return job
+
+class JobRequest(BaseModel):
+    url: str
+    title: str = "video"
+    ext: str = "mp4"
+    quality: Optional[int] = None
+    max_bitrate: Optional[int] = None
+    mux: bool = False
+
+@app.post("/api/jobs")
+async def submit_job(request: Request, body: JobRequest):
+    if not JOBS:
+        raise HTTPException(status_code=404, detail=JOBS_DISABLED)
+    if not body.url.startswith(("http://", "https://")):
+        raise HTTPException(status_code=400, detail="A http(s) media URL is required")
+
+    limited = rate_limited(DOWNLOAD_LIMITER, request)
+    if limited:
+        return limited
+
+    url, ext, _, pair = choose_download(body.url, body.ext, body.quality, body.max_bitrate, body.mux)
+    sources = [pair[0]["url"], pair[1]["url"]] if pair else [url]
+    try:
+        job = JOBS.submit(sources, body.title, ext)
+    except Overloaded:
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "Too many downloads are queued. Please try again later."},
+            headers={"Retry-After": str(DOWNLOAD_RETRY_AFTER)}
         )
-    except Exception as e:
-        print(f"Download Proxy Error: {e}")
-        raise HTTPException(status_code=500, detail="Failed to proxy download. Source link might have expired.")
+    return JSONResponse(status_code=202, content=job.view())
+
+@app.get("/api/jobs/{job_id}")
+async def job_status(job_id: str):
+    return find_job(job_id).view()
+
+@app.get("/api/jobs/{job_id}/file")
+async def job_file(request: Request, job_id: str):
+    job = find_job(job_id)
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail=f"The job is {job.status}.")
+    return CachedFileResponse(JOBS.path(job), request, download_media_type(job.ext), attachment(job.title, job.ext))
+
+@app.delete("/api/jobs/{job_id}")
+async def delete_job(job_id: str):
+    job = find_job(job_id)
+    JOBS.delete(job)
+    return {"id": job.id, "status": job.status}
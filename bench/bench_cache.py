@@ -0,0 +1,135 @@
+"""
+Benchmark and contract check for the shared info cache backends.
+
+Runs the same workload against each backend in api/index.py: the SQLite
+tier on a scratch file, and the Redis REST tier against a local FakeKV
+(see fakes.py). For each it reports get/get_or_set latency (p50/p99) and
+checks the contract every backend must keep:
+
+  single_winner   racing get_or_set calls for one key all get the same value
+                  (for SQLite also across worker processes)
+  expiry          an entry is gone once its TTL has passed
+  remaining_ttl   a hit reports roughly the time the entry has left
+
+    python bench/bench_cache.py --operations 2000 --output cache.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from fakes import FakeKV
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "api"))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import index  # noqa: E402
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def sample_result(i):
+    return {
+        "title": f"Video {i}",
+        "download_url": f"https://cdn.example/{i}.mp4",
+        "formats": [{"id": str(n), "url": f"https://cdn.example/{i}-{n}.mp4", "height": 360 * n} for n in range(1, 4)],
+    }
+
+
+async def timed(calls):
+    latencies = []
+    for call in calls:
+        start = time.perf_counter()
+        await call()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "ops_per_s": round(len(latencies) / sum(latencies), 1),
+    }
+
+
+async def check_contract(backend, tag):
+    key = f"race-{tag}"
+    won = await asyncio.gather(*(backend.get_or_set(key, {"writer": n}, 60) for n in range(32)))
+    await backend.get_or_set(f"short-{tag}", {"v": 1}, 0.3)
+    _, ttl = await backend.get(key)
+    await asyncio.sleep(0.5)
+    return {
+        "single_winner": len({json.dumps(value) for value, _ in won}) == 1,
+        "expiry": await backend.get(f"short-{tag}") is None,
+        "remaining_ttl": 55 < ttl <= 60,
+    }
+
+
+async def bench_backend(backend, operations, tag):
+    keys = [f"{tag}-{i}" for i in range(operations)]
+    report = {
+        "get_or_set": await timed([lambda k=k, i=i: backend.get_or_set(k, sample_result(i), 600) for i, k in enumerate(keys)]),
+        "get_hit": await timed([lambda k=k: backend.get(k) for k in keys]),
+        "get_miss": await timed([lambda k=k: backend.get(k + "-missing") for k in keys]),
+    }
+    report["contract"] = await check_contract(backend, tag)
+    return report
+
+
+def race_worker(path, n, queue):
+    value, _ = asyncio.run(index.SQLiteCache(path).get_or_set("cross-process", {"writer": n}, 60))
+    queue.put(value["writer"])
+
+
+def cross_process_winner(path, workers):
+    queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=race_worker, args=(path, n, queue)) for n in range(workers)]
+    for process in processes:
+        process.start()
+    winners = {queue.get(timeout=30) for _ in processes}
+    for process in processes:
+        process.join()
+    return len(winners) == 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", default=["sqlite", "kv"], choices=["sqlite", "kv"])
+    parser.add_argument("--operations", type=int, default=1000, help="keys written and read per backend")
+    parser.add_argument("--workers", type=int, default=8, help="processes racing on one SQLite key")
+    parser.add_argument("--kv-latency", default="0", help="FakeKV response delay (see fakes.py)")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = {"config": vars(args)}
+    with tempfile.TemporaryDirectory() as scratch:
+        if "sqlite" in args.backends:
+            path = os.path.join(scratch, "cache.sqlite3")
+            report["sqlite"] = asyncio.run(bench_backend(index.SQLiteCache(path), args.operations, "sqlite"))
+            report["sqlite"]["contract"]["single_winner_across_processes"] = cross_process_winner(path, args.workers)
+            report["sqlite"]["file_kb"] = round(os.path.getsize(path) / 1024, 1)
+        if "kv" in args.backends:
+            kv = FakeKV(latency=args.kv_latency)
+            backend = index.RedisRESTCache(kv.url, kv.token)
+            report["kv"] = asyncio.run(bench_backend(backend, args.operations, "kv"))
+            report["kv"]["upstream_requests"] = kv.requests
+            kv.shutdown()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
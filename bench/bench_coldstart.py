@@ -0,0 +1,127 @@
+"""
+Cold-start benchmark: what a fresh serverless instance pays before its
+first answer.
+
+Each run starts a new interpreter that imports api/index.py and sends one
+/api/info request to the app in process (YouTube link, answered by a local
+FakePiped with no added latency, see fakes.py), then a second request for
+another video. It reports medians over the runs:
+
+  interpreter_ms   `python -c pass`, the floor no change to the app can lower
+  import_ms        importing the module (FastAPI included)
+  module_ms        the module's own share of the import, from -X importtime
+  first_info_ms    the first /api/info, which builds the HTTP client
+  warm_info_ms     the second /api/info, for comparison
+  total_ms         process start to the first response
+
+    python bench/bench_coldstart.py --runs 20 --output coldstart.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from fakes import FakeCDN, FakePiped
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = r"""
+import asyncio, json, sys, time
+start = time.perf_counter()
+import httpx
+import index
+imported = time.perf_counter()
+
+async def main():
+    transport = httpx.ASGITransport(app=index.app, client=("127.0.0.1", 1))
+    async with httpx.AsyncClient(transport=transport, base_url="http://app") as client:
+        timings = []
+        for video in ("coldstart01", "coldstart02"):
+            begin = time.perf_counter()
+            response = await client.get("/api/info", params={"url": "https://youtu.be/" + video})
+            assert response.status_code == 200, response.text
+            timings.append(time.perf_counter() - begin)
+        return timings
+
+first, warm = asyncio.run(main())
+print(json.dumps({"import": imported - start, "first_info": first, "warm_info": warm}))
+"""
+
+
+def median_ms(values):
+    return round(statistics.median(values) * 1000, 1)
+
+
+def module_self_ms(env):
+    """The module's own import time (excluding its dependencies) from -X importtime."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import index"],
+                            cwd=os.path.join(ROOT, "api"), env=env, capture_output=True, text=True)
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() == "index":
+            return int(parts[0].split(":")[1]) / 1000
+    return None
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    cdn = FakeCDN(size=1024)
+    piped = FakePiped(cdn=cdn.url)
+    env = {
+        **os.environ,
+        "PIPED_INSTANCES": piped.url,
+        "PIPED_REGISTRY_URL": "",
+        "LOG_LEVEL": "WARNING",
+    }
+
+    interpreter, imports, firsts, warms, totals, modules = [], [], [], [], [], []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        interpreter.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", CHILD], cwd=os.path.join(ROOT, "api"), env=env,
+                                capture_output=True, text=True, check=True)
+        totals.append(time.perf_counter() - start)
+        timings = json.loads(result.stdout.strip().splitlines()[-1])
+        imports.append(timings["import"])
+        firsts.append(timings["first_info"])
+        warms.append(timings["warm_info"])
+        modules.append(module_self_ms(env) / 1000)
+
+    report = {
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "runs": args.runs,
+        "interpreter_ms": median_ms(interpreter),
+        "import_ms": median_ms(imports),
+        "module_ms": median_ms(modules),
+        "first_info_ms": median_ms(firsts),
+        "warm_info_ms": median_ms(warms),
+        "total_ms": median_ms(totals),
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
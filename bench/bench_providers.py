@@ -0,0 +1,122 @@
+"""
+Concurrent /api/info throughput, before and after the async provider layer.
+
+Starts a local stand-in Piped instance with a fixed response latency, then
+drives `info` from two versions of api/index.py with N concurrent clients:
+
+  before  the last committed api/index.py that still used blocking `requests`
+  after   the working tree
+
+Upstream hosts in the old revision are not configurable, so its `requests`
+calls are rewritten to the local server. Each request uses a distinct video ID.
+
+    python bench/bench_providers.py --requests 200 --concurrency 50 --latency 0.1
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import types
+import urllib.parse
+
+import httpx
+import requests
+
+from fakes import FakePiped
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_module(name, source):
+    module = types.ModuleType(name)
+    module.__file__ = f"<{name}>"
+    exec(compile(source, module.__file__, "exec"), module.__dict__)
+    return module
+
+
+def load_before(local):
+    revs = subprocess.run(
+        ["git", "log", "--format=%H", "--", "api/index.py"], cwd=ROOT, capture_output=True, text=True, check=True,
+    ).stdout.split()
+    for rev in revs:
+        source = subprocess.run(
+            ["git", "show", f"{rev}:api/index.py"], cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout
+        if "import httpx" not in source:
+            break
+
+    def rewrite(fn):
+        def wrapper(url, *args, **kwargs):
+            parts = urllib.parse.urlsplit(url)
+            return fn(f"{local}{parts.path}", *args, **kwargs)
+        return wrapper
+
+    module = load_module("before", source)
+    module.requests = types.SimpleNamespace(get=rewrite(requests.get), post=rewrite(requests.post))
+    return module
+
+
+def load_after(local):
+    os.environ["PIPED_INSTANCES"] = local
+    spec = importlib.util.spec_from_file_location("after", os.path.join(ROOT, "api", "index.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+async def drive(module, total, concurrency):
+    transport = httpx.ASGITransport(app=module.app)
+    latencies = []
+    sem = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def one(i):
+            video_id = f"{i:011d}"
+            async with sem:
+                start = time.perf_counter()
+                response = await client.get("/api/info", params={"url": f"https://youtu.be/{video_id}"})
+                latencies.append(time.perf_counter() - start)
+                assert response.status_code == 200, response.text
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": total,
+        "seconds": round(elapsed, 3),
+        "req_per_s": round(total / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 1),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.1, help="upstream response latency in seconds")
+    args = parser.parse_args()
+
+    server = FakePiped(latency=args.latency)
+    local = f"http://127.0.0.1:{server.port}"
+    results = {}
+    for name, loader in (("before", load_before), ("after", load_after)):
+        module = loader(local)
+        server.connections = 0
+        results[name] = asyncio.run(drive(module, args.requests, args.concurrency))
+        results[name]["upstream_connections"] = server.connections
+    server.shutdown()
+
+    results["speedup"] = round(results["after"]["req_per_s"] / results["before"]["req_per_s"], 1)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
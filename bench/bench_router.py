@@ -0,0 +1,114 @@
+"""
+Micro-benchmark of URL dispatch: the old substring checks plus
+`extract_youtube_id` regex scan against the compiled host router.
+
+Runs both over a corpus of real-world URL shapes and reports the cost per
+URL: for the router both a cold parse and a memoized repeat lookup. Lists
+every URL where the two disagree on platform or video ID.
+
+    python bench/bench_router.py --rounds 20000
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api"))
+
+import index  # noqa: E402
+
+CORPUS = [
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=42s&list=PLFgquLnL59alCl_2TQvOiD5Vgm1hCaGSI&index=3",
+    "https://youtube.com/watch?feature=share&v=dQw4w9WgXcQ",
+    "https://m.youtube.com/watch?v=dQw4w9WgXcQ&pp=ygUJcmljayByb2xs",
+    "https://music.youtube.com/watch?v=dQw4w9WgXcQ&si=Gx2eDk1",
+    "https://youtu.be/dQw4w9WgXcQ",
+    "https://youtu.be/dQw4w9WgXcQ?si=5fOaV1cbzXvbK8Ju&t=10",
+    "youtu.be/dQw4w9WgXcQ",
+    "https://www.youtube.com/shorts/aqz-KE-bpKQ",
+    "https://youtube.com/shorts/aqz-KE-bpKQ?si=hV2OzZ5M1Lw",
+    "https://www.youtube.com/embed/dQw4w9WgXcQ?autoplay=1",
+    "https://www.youtube-nocookie.com/embed/dQw4w9WgXcQ?rel=0",
+    "https://www.youtube.com/live/jfKfPfyJRdk?feature=shared",
+    "dQw4w9WgXcQ",
+    "https://www.youtube.com/@LofiGirl/videos",
+    "https://www.youtube.com/channel/UCuAXFkgsw1L7xaCfnd5JJOw",
+    "https://www.youtube.com/c/ChannelName1",
+    "https://www.youtube.com/playlist?list=PLFgquLnL59alCl_2TQvOiD5Vgm1hCaGSI",
+    "https://www.tiktok.com/@scout2015/video/6718335390845095173",
+    "https://www.tiktok.com/@user.name/video/7234567890123456789?is_from_webapp=1&sender_device=pc",
+    "https://m.tiktok.com/v/6718335390845095173.html",
+    "https://vm.tiktok.com/ZMeAbCdEf/",
+    "https://www.instagram.com/reel/C1a2b3c4d5e/?igsh=MWQ1ZGUxMzBkMA==",
+    "https://www.instagram.com/p/CxYzAbCdEfG/",
+    "https://twitter.com/jack/status/20",
+    "https://x.com/elonmusk/status/1585841080431321088?s=20",
+    "https://www.facebook.com/watch/?v=10153231379946729",
+    "https://vimeo.com/76979871",
+    "https://example.com/files/abcdefghijk",
+]
+
+
+def legacy_extract_youtube_id(url):
+    url = url.strip()
+    patterns = [
+        r'(?:v=|\/)([0-9A-Za-z_-]{11}).*',
+        r'(?:v=|\/)([0-9A-Za-z_-]{11})',
+        r'youtu\.be\/([0-9A-Za-z_-]{11})',
+        r'shorts\/([0-9A-Za-z_-]{11})',
+        r'^([0-9A-Za-z_-]{11})$'
+    ]
+    for pattern in patterns:
+        match = re.search(pattern, url)
+        if match:
+            return match.group(1)
+    return None
+
+
+def legacy_dispatch(url):
+    if "tiktok.com" in url:
+        return "tiktok", None
+    if "youtube.com" in url or "youtu.be" in url:
+        return "youtube", legacy_extract_youtube_id(url)
+    return None, None
+
+
+def routed_dispatch(url, route=index.route):
+    platform, _, video_id = route(url)
+    name = platform.name if platform else None
+    return name, video_id if name == "youtube" else None
+
+
+def cold_dispatch(url):
+    return routed_dispatch(url, index.route.__wrapped__)
+
+
+def ns_per_url(fn, rounds):
+    seconds = timeit.timeit(lambda: [fn(u) for u in CORPUS], number=rounds)
+    return round(seconds / (rounds * len(CORPUS)) * 1e9)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=20000)
+    args = parser.parse_args()
+
+    results = {
+        "urls": len(CORPUS),
+        "rounds": args.rounds,
+        "legacy_ns_per_url": ns_per_url(legacy_dispatch, args.rounds),
+        "router_cold_ns_per_url": ns_per_url(cold_dispatch, args.rounds),
+        "router_memoized_ns_per_url": ns_per_url(routed_dispatch, args.rounds),
+    }
+    results["disagreements"] = [
+        {"url": u, "legacy": legacy_dispatch(u), "router": routed_dispatch(u)}
+        for u in CORPUS if legacy_dispatch(u) != routed_dispatch(u)
+    ]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+"""
+Throughput of /api/download on one connection versus ?segments=N.
+
+Starts a local CDN stand-in that serves a random file with Range support and
+throttles every connection to a fixed rate (as googlevideo does), runs the
+app under uvicorn, and downloads the file through the proxy with each
+segment count. Every transfer is checked against the file's SHA-256.
+
+    python bench/bench_segmented.py --size-mb 32 --rate-mbps 4 --segments 1 2 4 8
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+import httpx
+import uvicorn
+
+from fakes import FakeCDN
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "api"))
+
+
+def start_app():
+    import index
+
+    config = uvicorn.Config(index.app, host="127.0.0.1", port=0, log_level="warning")
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server.servers[0].sockets[0].getsockname()[1]
+
+
+async def download(app_port: int, cdn_port: int, segments: int):
+    digest = hashlib.sha256()
+    received = 0
+    params = {"url": f"http://127.0.0.1:{cdn_port}/video.mp4", "segments": segments}
+    async with httpx.AsyncClient(timeout=None) as client:
+        start = time.perf_counter()
+        async with client.stream("GET", f"http://127.0.0.1:{app_port}/api/download", params=params) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_raw():
+                digest.update(chunk)
+                received += len(chunk)
+        elapsed = time.perf_counter() - start
+    return received, digest.hexdigest(), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=float, default=32)
+    parser.add_argument("--rate-mbps", type=float, default=4, help="per-connection CDN rate in MB/s")
+    parser.add_argument("--segments", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    data = os.urandom(int(args.size_mb * 1024 * 1024))
+    expected = hashlib.sha256(data).hexdigest()
+    cdn = FakeCDN(data=data, rate=args.rate_mbps * 1024 * 1024)
+    app_port = start_app()
+
+    results = {"size_mb": args.size_mb, "per_connection_mbps": args.rate_mbps, "runs": []}
+    for segments in args.segments:
+        received, digest, elapsed = asyncio.run(download(app_port, cdn.port, segments))
+        results["runs"].append({
+            "segments": segments,
+            "seconds": round(elapsed, 2),
+            "mb_per_s": round(received / elapsed / 1024 / 1024, 2),
+            "intact": received == len(data) and digest == expected,
+        })
+    base = results["runs"][0]["mb_per_s"]
+    for run in results["runs"]:
+        run["speedup"] = round(run["mb_per_s"] / base, 2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
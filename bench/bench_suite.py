@@ -0,0 +1,235 @@
+"""
+Offline end-to-end benchmark of the API against local stand-in upstreams.
+
+Starts fake Piped, Cobalt and tikwm APIs and a CDN byte server (see
+fakes.py), runs the app under uvicorn in a subprocess pointed at them, and
+measures with N concurrent clients:
+
+  info      /api/info latency (p50/p95/p99) and throughput for YouTube links
+            (Piped), TikTok links (tikwm) and other links (Cobalt). Every
+            request uses a new video ID, so the cache never answers.
+  download  /api/download aggregate and per-client MB/s, and the server's
+            resident memory (peak sampled during the run, and the high
+            water mark), with every body checked against the file's SHA-256
+
+Results are JSON, so runs on two commits can be diffed:
+
+    python bench/bench_suite.py --clients 50 --output before.json
+    python bench/bench_suite.py --clients 50 --piped-latency lognormal:0.2:0.5 --piped-errors 0.1
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+
+from fakes import FakeCDN, FakeCobalt, FakePiped, FakeTikwm
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+INFO_URLS = {
+    "youtube": lambda i: f"https://youtu.be/{i:011d}",
+    "tiktok": lambda i: f"https://www.tiktok.com/@bench/video/{7000000000000000000 + i}",
+    "cobalt": lambda i: f"https://x.com/bench/status/{i}",
+}
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def rss_kb(pid, field="VmRSS"):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def start_app(env):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "index:app", "--app-dir", os.path.join(ROOT, "api"),
+         "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        env={**os.environ, **env},
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/api/stats", timeout=1)
+            return process, f"http://127.0.0.1:{port}"
+        except httpx.TransportError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("app did not start")
+
+
+async def bench_info(base, kind, total, concurrency, offset):
+    latencies = []
+    failures = 0
+    sem = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base, timeout=60, limits=limits) as client:
+        async def one(i):
+            nonlocal failures
+            async with sem:
+                start = time.perf_counter()
+                response = await client.get("/api/info", params={"url": INFO_URLS[kind](offset + i)})
+                latencies.append(time.perf_counter() - start)
+                failures += response.status_code != 200
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": total,
+        "failures": failures,
+        "req_per_s": round(total / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "max_ms": round(latencies[-1] * 1000, 1),
+    }
+
+
+async def bench_download(base, cdn, clients, segments, pid):
+    peak = 0
+    running = True
+
+    def sample():
+        nonlocal peak
+        while running:
+            peak = max(peak, rss_kb(pid) or 0)
+            time.sleep(0.05)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    before = rss_kb(pid)
+    sampler.start()
+
+    async def one(client, i):
+        digest = hashlib.sha256()
+        received = 0
+        start = time.perf_counter()
+        params = {"url": f"{cdn.url}/file-{i}.mp4", "segments": segments}
+        async with client.stream("GET", "/api/download", params=params) as response:
+            async for chunk in response.aiter_raw():
+                digest.update(chunk)
+                received += len(chunk)
+        elapsed = time.perf_counter() - start
+        return received, elapsed, digest.hexdigest() == cdn.sha256
+
+    limits = httpx.Limits(max_connections=clients)
+    async with httpx.AsyncClient(base_url=base, timeout=None, limits=limits) as client:
+        start = time.perf_counter()
+        runs = await asyncio.gather(*(one(client, i) for i in range(clients)))
+        elapsed = time.perf_counter() - start
+    running = False
+    sampler.join()
+
+    total = sum(received for received, _, _ in runs)
+    per_client = sorted(received / seconds / 1024 / 1024 for received, seconds, _ in runs)
+    return {
+        "clients": clients,
+        "segments": segments,
+        "mb_total": round(total / 1024 / 1024, 1),
+        "aggregate_mb_per_s": round(total / elapsed / 1024 / 1024, 2),
+        "client_mb_per_s_p50": round(percentile(per_client, 50), 2),
+        "client_mb_per_s_min": round(per_client[0], 2),
+        "intact": all(ok for _, _, ok in runs),
+        "rss_before_mb": round(before / 1024, 1) if before else None,
+        "rss_peak_mb": round(peak / 1024, 1) if peak else None,
+        "rss_hwm_mb": round(rss_kb(pid, "VmHWM") / 1024, 1) if rss_kb(pid, "VmHWM") else None,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", default=["info", "download"], choices=["info", "download"])
+    parser.add_argument("--clients", type=int, default=20, help="concurrent clients")
+    parser.add_argument("--info-requests", type=int, default=500, help="requests per info scenario")
+    parser.add_argument("--download-size-mb", type=float, default=16)
+    parser.add_argument("--segments", type=int, default=1)
+    parser.add_argument("--piped-instances", type=int, default=3)
+    parser.add_argument("--piped-latency", default="lognormal:0.15:0.4")
+    parser.add_argument("--piped-errors", type=float, default=0.05)
+    parser.add_argument("--cobalt-latency", default="lognormal:0.3:0.3")
+    parser.add_argument("--cobalt-errors", type=float, default=0.0)
+    parser.add_argument("--tikwm-latency", default="lognormal:0.2:0.3")
+    parser.add_argument("--tikwm-errors", type=float, default=0.0)
+    parser.add_argument("--cdn-rate-mbps", type=float, default=0, help="per-connection CDN rate in MB/s (0 = unthrottled)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    cdn = FakeCDN(size=int(args.download_size_mb * 1024 * 1024), rate=args.cdn_rate_mbps * 1024 * 1024)
+    pipeds = [FakePiped(cdn=cdn.url, latency=args.piped_latency, errors=args.piped_errors, seed=args.seed + i)
+              for i in range(args.piped_instances)]
+    cobalt = FakeCobalt(cdn=cdn.url, latency=args.cobalt_latency, errors=args.cobalt_errors, seed=args.seed)
+    tikwm = FakeTikwm(cdn=cdn.url, latency=args.tikwm_latency, errors=args.tikwm_errors, seed=args.seed)
+
+    process, base = start_app({
+        "PIPED_INSTANCES": ",".join(p.url for p in pipeds),
+        "COBALT_INSTANCES": f"{cobalt.url}/api/json",
+        "TIKWM_API_URL": f"{tikwm.url}/api/",
+        "PIPED_REGISTRY_URL": "",
+        "LOG_LEVEL": "WARNING",
+        # Every client is 127.0.0.1, so per-client limits would cap the run
+        "RATE_LIMIT_INFO_RATE": "0",
+        "RATE_LIMIT_DOWNLOAD_RATE": "0",
+    })
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "config": vars(args),
+    }
+    try:
+        if "info" in args.scenarios:
+            report["info"] = {
+                kind: asyncio.run(bench_info(base, kind, args.info_requests, args.clients, offset=n * args.info_requests))
+                for n, kind in enumerate(INFO_URLS)
+            }
+            report["info"]["upstream_requests"] = {
+                "piped": sum(p.requests for p in pipeds), "cobalt": cobalt.requests, "tikwm": tikwm.requests,
+            }
+        if "download" in args.scenarios:
+            report["download"] = asyncio.run(bench_download(base, cdn, args.clients, args.segments, process.pid))
+    finally:
+        process.terminate()
+        process.wait()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,266 @@
+"""
+Local stand-ins for the upstreams the API talks to, for offline benchmarks.
+
+Each fake is a keep-alive HTTP/1.1 server on its own event loop thread. Its
+behaviour is configurable:
+
+    latency  seconds before answering: "0.1", "uniform:0.05:0.2" or
+             "lognormal:0.1:0.5" (median, sigma)
+    errors   fraction of requests answered with a 500 error page, as a
+             failing instance (not one refusing a single video) would
+    rate     per-connection throttle for response bodies in bytes/s (0 = none)
+
+    cdn = FakeCDN(size=32 * 1024 * 1024, rate=4 * 1024 * 1024)
+    piped = FakePiped(latency="lognormal:0.15:0.4", errors=0.05, cdn=cdn.url)
+"""
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import threading
+
+
+def parse_latency(spec):
+    """Returns a function drawing one delay in seconds from the spec."""
+    kind, _, params = str(spec).partition(":")
+    if not params:
+        value = float(kind)
+        return lambda rng: value
+    args = [float(p) for p in params.split(":")]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(args[0], args[1])
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(math.log(args[0]), args[1])
+    raise ValueError(f"unknown latency distribution: {spec}")
+
+
+class FakeServer:
+    """Base server: parses requests, applies latency and errors, throttles bodies."""
+
+    def __init__(self, latency="0", errors=0.0, rate=0, seed=None):
+        self.delay = parse_latency(latency)
+        self.errors = errors
+        self.rate = rate
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.connections = 0
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(asyncio.start_server(self.handle, "127.0.0.1", 0, backlog=1024))
+        self.port = self.server.sockets[0].getsockname()[1]
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1")
+                request_line, *lines = head.split("\r\n")
+                method, path, _ = request_line.split(" ", 2)
+                headers = {}
+                for line in lines:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                body = b""
+                if headers.get("content-length"):
+                    body = await reader.readexactly(int(headers["content-length"]))
+                self.requests += 1
+
+                await asyncio.sleep(self.delay(self.rng))
+                if self.errors and self.rng.random() < self.errors:
+                    status, response_headers, payload = 500, {"Content-Type": "text/html"}, b"<html><body>Internal Server Error</body></html>"
+                else:
+                    status, response_headers, payload = self.respond(method, path, headers, body)
+
+                response_headers = {**response_headers, "Content-Length": str(len(payload))}
+                writer.write((f"HTTP/1.1 {status} X\r\n" + "".join(f"{k}: {v}\r\n" for k, v in response_headers.items()) + "\r\n").encode())
+                await self.write_body(writer, payload if method != "HEAD" else b"")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def write_body(self, writer, payload):
+        if not self.rate:
+            writer.write(payload)
+            await writer.drain()
+            return
+        step = 64 * 1024
+        view = memoryview(payload)
+        for offset in range(0, len(payload), step):
+            chunk = view[offset:offset + step]
+            writer.write(chunk)
+            await writer.drain()
+            await asyncio.sleep(len(chunk) / self.rate)
+
+    def respond(self, method, path, headers, body):
+        """Returns (status, headers, body bytes) for one request."""
+        raise NotImplementedError
+
+    def json(self, data, status=200):
+        return status, {"Content-Type": "application/json"}, json.dumps(data).encode()
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.server.close)
+
+
+class FakeCDN(FakeServer):
+    """Serves one file for every path, with Range support and a strong ETag."""
+
+    def __init__(self, data=None, size=8 * 1024 * 1024, **kwargs):
+        self.data = data if data is not None else os.urandom(size)
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+        super().__init__(**kwargs)
+
+    def respond(self, method, path, headers, body):
+        size = len(self.data)
+        response_headers = {"Content-Type": "video/mp4", "Accept-Ranges": "bytes", "ETag": '"bench"'}
+        match = re.match(r"bytes=(\d+)-(\d*)$", headers.get("range", ""))
+        if not match:
+            return 200, response_headers, self.data
+        lo = int(match.group(1))
+        hi = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+        if lo >= size:
+            return 416, {"Content-Range": f"bytes */{size}"}, b""
+        response_headers["Content-Range"] = f"bytes {lo}-{hi}/{size}"
+        return 206, response_headers, self.data[lo:hi + 1]
+
+
+class FakePiped(FakeServer):
+    """
+    Piped API: /streams/{id} with muxed, video-only and audio streams, and
+    /healthcheck. IDs in `unavailable` get Piped's JSON error answer, as a
+    private or removed video does.
+    """
+
+    def __init__(self, cdn="http://127.0.0.1", unavailable=(), **kwargs):
+        self.cdn = cdn
+        self.unavailable = set(unavailable)
+        super().__init__(**kwargs)
+
+    def respond(self, method, path, headers, body):
+        if path.startswith("/healthcheck"):
+            return 200, {}, b"OK"
+        video_id = path.split("?")[0].rsplit("/", 1)[-1]
+        if video_id in self.unavailable:
+            return self.json({"error": "Video unavailable", "message": "This video is private"}, status=500)
+
+        def stream(itag, height, bitrate, video_only=False, mime="video/mp4"):
+            return {
+                "url": f"{self.cdn}/{video_id}.mp4?itag={itag}",
+                "format": "MPEG-4" if mime.endswith("mp4") else "WEBM",
+                "mimeType": mime,
+                "quality": f"{height}p" if height else f"{bitrate // 1000} kbps",
+                "height": height,
+                "bitrate": bitrate,
+                "codec": "avc1.4d401f" if mime.startswith("video") else "mp4a.40.2",
+                "videoOnly": video_only,
+                "itag": itag,
+            }
+
+        return self.json({
+            "title": f"Video {video_id}",
+            "thumbnailUrl": f"{self.cdn}/{video_id}.jpg",
+            "duration": 212,
+            "videoStreams": [
+                stream(137, 1080, 4_000_000, video_only=True),
+                stream(22, 720, 2_000_000),
+                stream(18, 360, 500_000),
+            ],
+            "audioStreams": [stream(140, 0, 128_000, mime="audio/mp4")],
+        })
+
+
+class FakeCobalt(FakeServer):
+    """Cobalt API: POST /api/json answering a stream URL, and /api/serverInfo."""
+
+    def __init__(self, cdn="http://127.0.0.1", **kwargs):
+        self.cdn = cdn
+        super().__init__(**kwargs)
+
+    def respond(self, method, path, headers, body):
+        if path.startswith("/api/serverInfo"):
+            return self.json({"version": "bench"})
+        url = json.loads(body or b"{}").get("url", "")
+        name = hashlib.sha1(url.encode()).hexdigest()[:12]
+        return self.json({"status": "stream", "url": f"{self.cdn}/{name}.mp4", "filename": f"{name}.mp4"})
+
+
+class FakeTikwm(FakeServer):
+    """tikwm API: POST /api/ with a form-encoded url."""
+
+    def __init__(self, cdn="http://127.0.0.1", **kwargs):
+        self.cdn = cdn
+        super().__init__(**kwargs)
+
+    def respond(self, method, path, headers, body):
+        match = re.search(rb"video%2F(\d+)", body)
+        video_id = match.group(1).decode() if match else "0"
+        return self.json({"code": 0, "data": {
+            "id": video_id,
+            "title": f"TikTok {video_id}",
+            "cover": f"{self.cdn}/{video_id}.jpg",
+            "duration": 15,
+            "play": f"{self.cdn}/{video_id}.mp4",
+            "hdplay": f"{self.cdn}/{video_id}-hd.mp4",
+            "music": f"{self.cdn}/{video_id}.mp3",
+            "size": 2_000_000,
+            "hd_size": 5_000_000,
+        }})
+
+
+class FakeKV(FakeServer):
+    """
+    Redis over the Upstash REST protocol (as Vercel KV speaks it): POST
+    /multi-exec and /pipeline with GET, SET (NX, PX/EX), PTTL and DEL.
+    Requests need "Authorization: Bearer {token}".
+    """
+
+    def __init__(self, token="bench", **kwargs):
+        self.token = token
+        self.store = {}
+        super().__init__(**kwargs)
+
+    def respond(self, method, path, headers, body):
+        if headers.get("authorization") != f"Bearer {self.token}":
+            return self.json({"error": "Unauthorized"}, 401)
+        if method != "POST" or path.split("?")[0] not in ("/multi-exec", "/pipeline"):
+            return self.json({"error": "not found"}, 404)
+        return self.json([self.command(*command) for command in json.loads(body)])
+
+    def live(self, key):
+        value, expires = self.store.get(key, (None, None))
+        if expires is not None and expires <= self.loop.time():
+            del self.store[key]
+            return None, None
+        return value, expires
+
+    def command(self, name, *args):
+        name = name.upper()
+        if name == "GET":
+            return {"result": self.live(args[0])[0]}
+        if name == "DEL":
+            return {"result": int(self.store.pop(args[0], None) is not None)}
+        if name == "PTTL":
+            value, expires = self.live(args[0])
+            if value is None:
+                return {"result": -2}
+            return {"result": -1 if expires is None else int((expires - self.loop.time()) * 1000)}
+        if name == "SET":
+            key, value, options = args[0], args[1], [str(a).upper() for a in args[2:]]
+            expires = None
+            for unit, scale in (("PX", 0.001), ("EX", 1)):
+                if unit in options:
+                    expires = self.loop.time() + float(options[options.index(unit) + 1]) * scale
+            if "NX" in options and self.live(key)[0] is not None:
+                return {"result": None}
+            self.store[key] = (value, expires)
+            return {"result": "OK"}
+        return {"error": f"ERR unknown command '{name}'"}
@@ -1,7 +1,7 @@
 import React from 'react';
 import { Download, Play, Clock, AlertTriangle, ShieldCheck } from 'lucide-react';
 import { VideoData } from '../types';
-import { getDownloadLink } from '../services/api';
+import { getDownloadLink, getThumbnailLink, getThumbnailSrcSet } from '../services/api';
 
 interface VideoCardProps {
   data: VideoData;
@@ -9,6 +9,8 @@ interface VideoCardProps {
 
 const VideoCard: React.FC<VideoCardProps> = ({ data }) => {
   const downloadLink = getDownloadLink(data);
+  // Resized copies come from our API; demo data is shown while it is offline
+  const proxied = !data.isMock && !!data.thumbnail;
 
   // Helper to format duration seconds into MM:SS
   const formatDuration = (seconds: number | null) => {
@@ -44,7 +46,9 @@ const VideoCard: React.FC<VideoCardProps> = ({ data }) => {
             <div className="md:w-5/12 relative overflow-hidden">
               <div className="absolute inset-0 bg-gradient-to-t from-black/80 via-transparent to-transparent z-10"></div>
               <img 
-                src={data.thumbnail} 
+                src={proxied ? getThumbnailLink(data.thumbnail, 480) : data.thumbnail}
+                srcSet={proxied ? getThumbnailSrcSet(data.thumbnail) : undefined}
+                sizes="(min-width: 768px) 320px, 100vw"
                 alt={data.title} 
                 className="w-full h-full object-cover min-h-[240px] group-hover:scale-110 transition-transform duration-700 ease-out"
               />
@@ -4,18 +4,23 @@ import { VideoData } from '../types';
 const isLocal = window.location.hostname === 'localhost' || window.location.hostname === '127.0.0.1';
 const API_BASE_URL = isLocal ? 'http://localhost:8000/api' : '/api';
 
+const REQUEST_TIMEOUT_MS = 30000; // 30 seconds for multi-instance retries
+// The server budget leaves headroom so it answers (or times out explicitly) before we give up
+const SERVER_DEADLINE_S = (REQUEST_TIMEOUT_MS - 3000) / 1000;
+
 export const apiClient = axios.create({
   baseURL: API_BASE_URL,
   headers: {
     'Content-Type': 'application/json',
   },
-  timeout: 30000, // Increased to 30 seconds for multi-instance retries
+  timeout: REQUEST_TIMEOUT_MS,
 });
 
 export const fetchVideoInfo = async (url: string): Promise<VideoData> => {
   try {
     const response = await apiClient.get<VideoData>('/info', {
       params: { url },
+      headers: { 'X-Request-Deadline': String(SERVER_DEADLINE_S) },
     });
     return response.data;
   } catch (error: any) {
@@ -36,3 +41,14 @@ export const getDownloadLink = (videoData: VideoData): string => {
   });
   return `${API_BASE_URL}/download?${params.toString()}`;
 };
+
+// Widths the server resizes to; other values are rounded up to one of these
+export const THUMBNAIL_WIDTHS = [320, 480, 640, 960];
+
+export const getThumbnailLink = (url: string, width: number): string => {
+  const params = new URLSearchParams({ url, width: String(width) });
+  return `${API_BASE_URL}/thumbnail?${params.toString()}`;
+};
+
+export const getThumbnailSrcSet = (url: string): string =>
+  THUMBNAIL_WIDTHS.map((width) => `${getThumbnailLink(url, width)} ${width}w`).join(', ');
@@ -0,0 +1,24 @@
+"""
+Tests for api/index.py. They run offline against the module's pure helpers
+and, for the mux, against the small fragmented MP4s in fixtures/.
+
+    pip install -r api/requirements.txt pytest
+    python -m pytest -q
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "api"))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+FIXTURES = os.path.join(ROOT, "tests", "fixtures")
+
+
+@pytest.fixture
+def fixture_bytes():
+    def read(name):
+        with open(os.path.join(FIXTURES, name), "rb") as f:
+            return f.read()
+    return read
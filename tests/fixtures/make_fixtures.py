@@ -0,0 +1,53 @@
+"""
+Regenerates the fragmented MP4 inputs used by test_mux.py: two seconds of
+64x64 H.264 video (a keyframe every half second) and two seconds of mono
+AAC, each cut into fragments of about half a second, as YouTube's DASH
+streams are. Needs PyAV and numpy, which the app itself doesn't.
+
+    python tests/fixtures/make_fixtures.py
+"""
+import fractions
+import os
+
+import av
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# default_base_moof keeps data offsets relative to each moof, which the mux requires
+FRAGMENTED = {"movflags": "empty_moov+default_base_moof+frag_keyframe", "frag_duration": "500000"}
+
+
+def video(path):
+    with av.open(path, "w", format="mp4", options=FRAGMENTED) as out:
+        stream = out.add_stream("libx264", rate=10)
+        stream.width = stream.height = 64
+        stream.pix_fmt = "yuv420p"
+        stream.options = {"g": "5", "preset": "ultrafast", "crf": "40"}
+        for i in range(20):
+            image = np.full((64, 64, 3), i * 12, dtype=np.uint8)
+            for packet in stream.encode(av.VideoFrame.from_ndarray(image, format="rgb24")):
+                out.mux(packet)
+        for packet in stream.encode():
+            out.mux(packet)
+
+
+def audio(path):
+    with av.open(path, "w", format="mp4", options=FRAGMENTED) as out:
+        stream = out.add_stream("aac", rate=8000)
+        stream.layout = "mono"
+        stream.bit_rate = 16000
+        for i in range(16):
+            t = np.arange(i * 1024, (i + 1) * 1024) / 8000
+            frame = av.AudioFrame.from_ndarray((0.2 * np.sin(2 * np.pi * 440 * t)).astype(np.float32)[None], format="fltp", layout="mono")
+            frame.sample_rate = 8000
+            frame.pts = i * 1024
+            frame.time_base = fractions.Fraction(1, 8000)
+            for packet in stream.encode(frame):
+                out.mux(packet)
+        for packet in stream.encode():
+            out.mux(packet)
+
+
+if __name__ == "__main__":
+    video(os.path.join(HERE, "video.mp4"))
+    audio(os.path.join(HERE, "audio.m4a"))
@@ -0,0 +1,47 @@
+import asyncio
+import json
+
+import pytest
+
+import index
+
+
+def entry(n):
+    return {"id": f"video{n:06d}", "title": f"Video {n}", "url": f"https://www.youtube.com/watch?v=video{n:06d}"}
+
+
+def listing(first_page, *later_pages, limit=100):
+    async def pages():
+        for page in later_pages:
+            yield page
+
+    async def collect():
+        body = index.stream_collection("playlist", pages(), first_page, False, 4, limit)
+        return [json.loads(line) async for line in body]
+
+    return asyncio.run(collect())
+
+
+FIRST = {"name": "Mix", "thumbnailUrl": "https://i.example/mix.jpg", "uploader": "Someone", "videos": 3}
+
+
+@pytest.mark.parametrize("first_entries", [[], [entry(0)]])
+def test_header_is_sent_once_from_the_first_page(first_entries):
+    lines = listing((FIRST, first_entries), ({"nextpage": "x"}, []), ({}, [entry(1), entry(2)]))
+
+    headers = [line for line in lines if line["type"] == "playlist"]
+    assert headers == [{"type": "playlist", "title": "Mix", "thumbnail": "https://i.example/mix.jpg", "uploader": "Someone", "video_count": 3}]
+    assert lines[0] == headers[0]
+    entries = [line for line in lines if line["type"] == "entry"]
+    assert [e["index"] for e in entries] == list(range(len(first_entries) + 2))
+    assert lines[-1] == {"type": "end", "count": len(entries)}
+
+
+def test_empty_listing_still_has_header_and_end():
+    lines = listing((FIRST, []))
+    assert [line["type"] for line in lines] == ["playlist", "end"]
+
+
+def test_limit_stops_paging():
+    lines = listing((FIRST, [entry(0), entry(1)]), ({}, [entry(2)]), limit=2)
+    assert [line["type"] for line in lines] == ["playlist", "entry", "entry", "end"]
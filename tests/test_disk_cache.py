@@ -0,0 +1,99 @@
+import asyncio
+import os
+import subprocess
+import sys
+
+import pytest
+from starlette.requests import Request
+
+import index
+
+API = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api")
+
+
+def store(cache, key, data):
+    path, f = cache.open_temp()
+    with f:
+        f.write(data)
+    asyncio.run(cache.commit(key, path))
+
+
+def entries(root):
+    return sorted(n for n in os.listdir(root) if n != "tmp")
+
+
+def test_commit_evicts_least_recently_used(tmp_path):
+    cache = index.DiskLRU(str(tmp_path), 250)
+    store(cache, "a", b"a" * 100)
+    store(cache, "b", b"b" * 100)
+    assert cache.get("a")
+    store(cache, "c", b"c" * 100)
+
+    assert cache.get("b") is None
+    assert open(cache.get("a"), "rb").read() == b"a" * 100
+    assert entries(tmp_path) == sorted(cache.name(k) for k in "ac")
+    assert cache.stats()["bytes"] == 200
+    assert cache.stats()["evictions"] == 1
+
+
+def test_budget_holds_across_processes(tmp_path):
+    cache = index.DiskLRU(str(tmp_path), 3000)
+    # Another worker stores into the same directory
+    subprocess.run([sys.executable, "-c", (
+        "import asyncio, index\n"
+        f"cache = index.DiskLRU({str(tmp_path)!r}, 3000)\n"
+        "path, f = cache.open_temp()\n"
+        "f.write(b'y' * 1000)\n"
+        "f.close()\n"
+        "asyncio.run(cache.commit('other', path))\n"
+    )], cwd=API, env={**os.environ, "LOG_LEVEL": "ERROR"}, check=True)
+    assert cache.get("other")
+
+    cache.RESCAN_INTERVAL = 0
+    for i in range(3):
+        store(cache, f"k{i}", b"z" * 1000)
+    sizes = [os.path.getsize(tmp_path / n) for n in entries(tmp_path)]
+    assert sum(sizes) <= 3000
+    assert cache.stats()["bytes"] == sum(sizes)
+
+
+def test_stale_temp_directories_are_cleared(tmp_path):
+    stale = tmp_path / "tmp" / "999999999"
+    stale.mkdir(parents=True)
+    (stale / "partial").write_bytes(b"x")
+    cache = index.DiskLRU(str(tmp_path), 1000)
+    assert os.listdir(tmp_path / "tmp") == [str(os.getpid())]
+    assert cache.stats()["entries"] == 0
+
+
+def serve(path, headers=()):
+    request = Request({"type": "http", "method": "GET", "path": "/", "headers": [(k.lower().encode(), v.encode()) for k, v in headers]})
+    response = index.CachedFileResponse(str(path), request, "application/octet-stream", {})
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(response({"type": "http"}, None, send))
+    return messages
+
+
+@pytest.mark.parametrize("data, headers, status, body", [
+    (b"", (), 200, b""),
+    (b"0123456789", (), 200, b"0123456789"),
+    (b"0123456789", (("Range", "bytes=2-4"),), 206, b"234"),
+    (b"0123456789", (("Range", "bytes=20-"),), 416, b""),
+])
+def test_cached_file_response_always_ends(tmp_path, data, headers, status, body):
+    path = tmp_path / "entry"
+    path.write_bytes(data)
+    messages = serve(path, headers)
+
+    assert messages[0]["type"] == "http.response.start"
+    assert messages[0]["status"] == status
+    # Every response, an empty one included, ends with a final body message
+    assert len(messages) >= 2
+    assert all(m["type"] == "http.response.body" for m in messages[1:])
+    assert not messages[-1].get("more_body", False)
+    assert all(m["more_body"] for m in messages[1:-1])
+    assert b"".join(m["body"] for m in messages[1:]) == body
@@ -0,0 +1,158 @@
+import asyncio
+import io
+import struct
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import index
+
+
+def boxes(data, start=0, end=None):
+    return list(index.mp4_boxes(data, start, len(data) if end is None else end))
+
+
+def children(data, box):
+    _, offset, header, size = box
+    return boxes(data, offset + header, offset + size)
+
+
+def full_box_u32(data, box, offset_v0, offset_v1):
+    # A 32-bit field of a full box, by its offset after version/flags
+    _, offset, header, _ = box
+    version = data[offset + header]
+    return struct.unpack_from(">I", data, offset + header + 4 + (offset_v1 if version == 1 else offset_v0))[0]
+
+
+def find(data, box, kind):
+    return next(b for b in children(data, box) if b[0] == kind)
+
+
+def fragments(data):
+    """(track id, decode time, sequence number, mdat payload) for each fragment of a file."""
+    timescales = {}
+    moov = next(b for b in boxes(data) if b[0] == "moov")
+    for trak in (b for b in children(data, moov) if b[0] == "trak"):
+        track_id = full_box_u32(data, find(data, trak, "tkhd"), 8, 16)
+        timescales[track_id] = full_box_u32(data, find(data, find(data, trak, "mdia"), "mdhd"), 8, 16)
+    result = []
+    top = boxes(data)
+    for box, following in zip(top, top[1:]):
+        if box[0] != "moof":
+            continue
+        assert following[0] == "mdat"
+        traf = find(data, box, "traf")
+        track_id = full_box_u32(data, find(data, traf, "tfhd"), 0, 0)
+        tfdt = find(data, traf, "tfdt")
+        _, offset, header, _ = tfdt
+        fmt = ">Q" if data[offset + header] == 1 else ">I"
+        decode_time = struct.unpack_from(fmt, data, offset + header + 4)[0] / timescales.get(track_id, 1)
+        sequence = full_box_u32(data, find(data, box, "mfhd"), 0, 0)
+        _, offset, header, size = following
+        result.append((track_id, decode_time, sequence, data[offset + header:offset + size]))
+    return result
+
+
+def upstream(data):
+    return httpx.Response(200, content=data)
+
+
+async def mux(video, audio):
+    inputs = [index.MuxInput(index.BoxReader(upstream(data)), track_id) for track_id, data in ((1, video), (2, audio))]
+    await asyncio.gather(*(i.read_init() for i in inputs))
+    return b"".join([chunk async for chunk in index.stream_mux(*inputs)])
+
+
+def test_mux_output_has_both_tracks(fixture_bytes):
+    video, audio = fixture_bytes("video.mp4"), fixture_bytes("audio.m4a")
+    out = asyncio.run(mux(video, audio))
+
+    top = boxes(out)
+    assert [b[0] for b in top[:2]] == ["ftyp", "moov"]
+    assert {b[0] for b in top[2:]} == {"moof", "mdat"}
+    assert sum(b[3] for b in top) == len(out)
+
+    moov = top[1]
+    traks = [b for b in children(out, moov) if b[0] == "trak"]
+    assert [full_box_u32(out, find(out, t, "tkhd"), 8, 16) for t in traks] == [1, 2]
+    handlers = [out[h[1] + h[2] + 8:h[1] + h[2] + 12] for h in (find(out, find(out, t, "mdia"), "hdlr") for t in traks)]
+    assert handlers == [b"vide", b"soun"]
+    trexs = [b for b in children(out, find(out, moov, "mvex")) if b[0] == "trex"]
+    assert [full_box_u32(out, t, 0, 0) for t in trexs] == [1, 2]
+    mvhd = find(out, moov, "mvhd")
+    assert struct.unpack_from(">I", out, mvhd[1] + mvhd[3] - 4)[0] == 3
+
+
+def test_mux_interleaves_fragments_by_decode_time(fixture_bytes):
+    video, audio = fixture_bytes("video.mp4"), fixture_bytes("audio.m4a")
+    out = fragments(asyncio.run(mux(video, audio)))
+
+    assert [f[2] for f in out] == list(range(1, len(out) + 1))
+    times = [f[1] for f in out]
+    assert times == sorted(times)
+    # Every input fragment comes through once, media data untouched
+    assert [f[3] for f in out if f[0] == 1] == [f[3] for f in fragments(video)]
+    assert [f[3] for f in out if f[0] == 2] == [f[3] for f in fragments(audio)]
+
+
+def test_mux_output_decodes(fixture_bytes):
+    av = pytest.importorskip("av")
+
+    def frame_counts(data):
+        counts = {}
+        with av.open(io.BytesIO(data)) as container:
+            for frame in container.decode(*container.streams):
+                kind = "audio" if isinstance(frame, av.AudioFrame) else "video"
+                counts[kind] = counts.get(kind, 0) + 1
+        return counts
+
+    video, audio = fixture_bytes("video.mp4"), fixture_bytes("audio.m4a")
+    out = asyncio.run(mux(video, audio))
+    assert frame_counts(out) == {**frame_counts(video), **frame_counts(audio)}
+
+
+def test_open_mux_streams_both_inputs(fixture_bytes, monkeypatch):
+    files = {"video": fixture_bytes("video.mp4"), "audio": fixture_bytes("audio.m4a")}
+
+    async def open_upstream(url, headers):
+        return upstream(files[url])
+
+    async def body():
+        response = await index.open_mux("video", "audio", {})
+        return b"".join([chunk async for chunk in response.body_iterator])
+
+    monkeypatch.setattr(index, "open_upstream", open_upstream)
+    out = asyncio.run(body())
+    assert sorted({f[0] for f in fragments(out)}) == [1, 2]
+
+
+@pytest.mark.parametrize("video, status", [(b"not an mp4 at all", 200), (None, 404)])
+def test_open_mux_rejects_unusable_inputs(fixture_bytes, monkeypatch, video, status):
+    async def open_upstream(url, headers):
+        if url == "audio":
+            return upstream(fixture_bytes("audio.m4a"))
+        return httpx.Response(status, content=video or b"")
+
+    monkeypatch.setattr(index, "open_upstream", open_upstream)
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(index.open_mux("video", "audio", {}))
+    assert raised.value.status_code == 502
+
+
+def test_unfragmented_input_is_rejected(fixture_bytes):
+    # The same movie without mvex, as a progressive MP4 would be
+    video = bytearray(fixture_bytes("video.mp4"))
+    moov = next(b for b in boxes(video) if b[0] == "moov")
+    mvex = find(video, moov, "mvex")
+    video[mvex[1] + 4:mvex[1] + 8] = b"free"
+
+    async def init():
+        reader = index.BoxReader(upstream(bytes(video)))
+        try:
+            await index.MuxInput(reader, 1).read_init()
+        finally:
+            reader.close()
+
+    with pytest.raises(ValueError, match="not a fragmented MP4"):
+        asyncio.run(init())
@@ -0,0 +1,67 @@
+import asyncio
+
+import httpx
+import pytest
+
+import index
+
+INSTANCES = ["http://piped-a", "http://piped-b", "http://piped-c"]
+UNAVAILABLE = httpx.Response(500, json={"error": "Video unavailable", "message": "This video is private"})
+
+
+@pytest.fixture
+def piped(monkeypatch):
+    """A fresh pool of fake instances, all answering with `piped.answer`."""
+    class Piped:
+        answer = UNAVAILABLE
+        requests = 0
+
+    state = Piped()
+
+    def handler(request):
+        state.requests += 1
+        return state.answer
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(index, "PIPED_POOL", index.InstancePool("piped", INSTANCES, lambda base: f"{base}/healthcheck"))
+    monkeypatch.setattr(index, "get_client", lambda kind="api": client)
+    return state
+
+
+def breaker_states():
+    return {h["state"] for h in index.PIPED_POOL.stats()}
+
+
+def lookup(video_id):
+    return asyncio.run(index.process_youtube_piped(f"https://youtu.be/{video_id}", index.Deadline(5)))
+
+
+@pytest.mark.parametrize("answer", [
+    UNAVAILABLE,
+    httpx.Response(200, json={"error": "Could not get video"}),
+    httpx.Response(404, text="Not Found"),
+])
+def test_bad_video_ids_leave_breakers_closed(piped, answer):
+    piped.answer = answer
+    for _ in range(index.BREAKER_THRESHOLD * 2):
+        assert lookup("privateXXXX") is None
+    assert piped.requests >= index.BREAKER_THRESHOLD * 2
+    assert breaker_states() == {"closed"}
+    assert len(index.PIPED_POOL.ranked()) == len(INSTANCES)
+
+
+def test_bad_listings_leave_breakers_closed(piped):
+    for _ in range(index.BREAKER_THRESHOLD * 2):
+        assert asyncio.run(index.fetch_piped_page("/playlists/PLbogusbogus")) is None
+    assert breaker_states() == {"closed"}
+
+
+@pytest.mark.parametrize("answer", [
+    httpx.Response(502, text="<html>Bad Gateway</html>"),
+    httpx.Response(200, text="<html>Captive portal</html>"),
+])
+def test_broken_instances_still_open_their_breakers(piped, answer):
+    piped.answer = answer
+    for _ in range(index.BREAKER_THRESHOLD):
+        assert asyncio.run(index.fetch_piped_page("/playlists/PLsomething")) is None
+    assert breaker_states() == {"open"}
@@ -0,0 +1,44 @@
+import httpx
+import pytest
+
+import index
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=900-5000", (900, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=-5000", (0, 999)),
+    (" bytes=0-0 ", (0, 0)),
+    # Unsatisfiable
+    ("bytes=1000-", None),
+    ("bytes=500-400", None),
+    # Served as the full file
+    ("bytes=0-99,200-299", ()),
+    ("bytes=-", ()),
+    ("items=0-99", ()),
+])
+def test_parse_byte_range(header, expected):
+    assert index.parse_byte_range(header, 1000) == expected
+
+
+UPSTREAM = httpx.Headers({"ETag": '"abc123"', "Last-Modified": "Wed, 21 Oct 2015 07:28:00 GMT"})
+
+
+@pytest.mark.parametrize("if_range, expected", [
+    ('"abc123"', True),
+    (' "abc123" ', True),
+    ('"other"', False),
+    # Weak validators never match (RFC 9110 13.1.5)
+    ('W/"abc123"', False),
+    ("Wed, 21 Oct 2015 07:28:00 GMT", True),
+    ("Wed, 21 Oct 2015 07:28:01 GMT", False),
+])
+def test_if_range_matches(if_range, expected):
+    assert index.if_range_matches(if_range, UPSTREAM) is expected
+
+
+def test_if_range_without_upstream_validators():
+    assert not index.if_range_matches('"abc123"', httpx.Headers())
+    assert not index.if_range_matches("Wed, 21 Oct 2015 07:28:00 GMT", httpx.Headers())
@@ -0,0 +1,58 @@
+import pytest
+
+import index
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A monotonic clock that only moves when the test advances it."""
+    class Clock:
+        now = 1000.0
+
+        def advance(self, seconds):
+            self.now += seconds
+
+    clock = Clock()
+    monkeypatch.setattr(index.time, "monotonic", lambda: clock.now)
+    return clock
+
+
+def test_burst_then_refill(clock):
+    limiter = index.RateLimiter("test", rate=1, burst=3, max_clients=100)
+    assert [limiter.take("a") for _ in range(3)] == [0, 0, 0]
+    assert limiter.take("a") == pytest.approx(1)
+    # Other clients have their own bucket
+    assert limiter.take("b") == 0
+    clock.advance(1)
+    assert limiter.take("a") == 0
+    assert limiter.take("a") > 0
+    assert limiter.stats()["limited"] == 2
+
+
+def test_costly_request_goes_into_debt(clock):
+    limiter = index.RateLimiter("test", rate=1, burst=3, max_clients=100)
+    assert limiter.take("a", cost=5) == 0
+    assert limiter.take("a") == pytest.approx(3)
+    clock.advance(3)
+    assert limiter.take("a") == 0
+
+
+def test_full_buckets_are_forgotten(clock):
+    limiter = index.RateLimiter("test", rate=1, burst=3, max_clients=100)
+    limiter.take("a")
+    clock.advance(2)
+    limiter.take("b")
+    assert limiter.stats()["clients"] == 1
+
+
+def test_clients_are_bounded(clock):
+    limiter = index.RateLimiter("test", rate=1, burst=3, max_clients=2)
+    for client in "abc":
+        limiter.take(client)
+    assert limiter.stats() == {"clients": 2, "limited": 0, "evicted": 1}
+
+
+def test_zero_rate_disables_the_limit(clock):
+    limiter = index.RateLimiter("test", rate=0, burst=1, max_clients=100)
+    assert all(limiter.take("a", cost=100) == 0 for _ in range(10))
+    assert limiter.stats()["clients"] == 0
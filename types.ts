@@ -1,3 +1,15 @@
+export interface VideoFormat {
+  id: string;
+  url: string;
+  ext: string;
+  height: number | null;
+  bitrate: number | null;
+  codec: string | null;
+  size: number | null;
+  audio_only: boolean;
+  video_only: boolean;
+}
+
 export interface VideoData {
   id: string;
   title: string;
@@ -6,6 +18,8 @@ export interface VideoData {
   platform: string;
   download_url: string;
   ext: string;
+  // Ranked best first; absent when the provider returns a single stream
+  formats?: VideoFormat[];
   isMock?: boolean;
 }
 